@@ -6,13 +6,47 @@ Usage:
     python main_devices.py simulate_device_state_stream <event-count> <iterations> <flag-args>
     python main_devices.py simulate_device_state_stream 100 10 
     python main_devices.py simulate_device_state_stream 100 10 --simulate-az-function
+    python main_devices.py simulate_device_state_stream 100 10 --simulate-az-function --batch-writes
+    python main_devices.py simulate_device_state_stream 100 10 --upsert-updates
+    python main_devices.py simulate_device_state_stream 100 10 --etag-pipeline
+    python main_devices.py simulate_device_state_stream 100 10 --current-state
+    python main_devices.py simulate_device_state_stream 100 10 --full-flow
+    python main_devices.py simulate_device_state_stream 100 10 --full-flow --cache-size 10000
+    python main_devices.py simulate_device_state_stream 1000 10 --workers 32 --queue-depth 100
+    python main_devices.py simulate_device_state_stream 1000 10 --ops-log-format ndjson --ops-log-max-mb 16
+    python main_devices.py simulate_device_state_stream 1000 10 --partition-strategy did_hash:8
+    python main_devices.py drive_device_state_load 500:60 --in-memory --partition-strategy did_day --current-state
+    python main_devices.py drive_device_state_load 500:60 --in-memory --partition-strategy did_hour --max-lookback-buckets 48
+    python main_devices.py drive_device_state_load 100:30,100-1000:60,1000:60
+    python main_devices.py drive_device_state_load 500:60 --arrivals constant --full-flow
+    python main_devices.py drive_device_state_load 500:60 --in-memory --latency-ms 5 --throttle-pct 1
     python main_devices.py test_initialize_data 
+    python main_devices.py rebuild_device_data
+    python main_devices.py rebuild_device_data 42
+    python main_devices.py benchmark_diffs 1000000
+    python main_devices.py analyze_ru_costs 5000
+    python main_devices.py analyze_ru_costs 5000 --change-rate 0.05 --headroom 1.5 --ops-log "tmp/dsc_operations-*.csv"
+    python main_devices.py simulate_throughput 10000 --events-per-second 500 --event-count 100000
+    python main_devices.py simulate_throughput 20000 --ops-log "tmp/dsc_operations-*.csv" --events-per-second 1000
+    python main_devices.py simulate_throughput 40000 --schemes did,first_letter --physical-partitions 8 --skew hotset
+    python main_devices.py simulate_throughput 40000 --schemes did,did_hour,did_hash:16 --skew hotset
+    python main_devices.py export_device_states tmp/device_states_export.ndjson --fields ser,cid,host
+    python main_devices.py device_states_as_of 1739733895 --dids 5b0f6e1ab2c3,8cf5c21f8a7d
+    python main_devices.py device_states_as_of 1739733895 --export tmp/device_states_export.ndjson
+    python main_devices.py device_states_as_of 1739733895 --change-feed --fields ser,cid,host
+    python main_devices.py resolve_device_identities --event-count 1000000
+    python main_devices.py resolve_device_identities --event-count 1000000 --strong-attrs ser,cid
+    python main_devices.py resolve_device_identities --export tmp/device_states_export.ndjson --incremental
+    python main_devices.py benchmark_event_generator 10000000 zipf
+    python main_devices.py benchmark_event_generator 10000000 hotset
 Options:
   -h --help     Show this screen.
   --version     Show version.
 """
 
 import asyncio
+import glob
+import itertools
 import json
 import random
 import sys
@@ -24,12 +58,28 @@ import uuid
 from docopt import docopt
 from dotenv import load_dotenv
 
+from src.dao.device_state_history import DeviceStateHistory
 from src.services.config_service import ConfigService
 from src.services.cosmos_nosql_service import CosmosNoSQLService
+from src.services.change_feed_processor import ChangeFeedProcessor, LeaseStore
+from src.services.device_event_pipeline import DeviceEventPipeline
+from src.services.in_memory_nosql_service import InMemoryNoSQLService
+from src.services.load_driver import LoadDriver
+from src.services.write_batcher import WriteBatcher
 from src.models.device_data import DeviceData
+from src.models.device_event_generator import DeviceEventGenerator
+from src.models.device_identity_resolver import DeviceIdentityResolver
+from src.models.device_state_batch_changes import DeviceStateBatchChanges
 from src.models.device_state_changes import DeviceStateChanges
 from src.models.device_state_change_operations import DeviceStateChangeOperations
+from src.models.device_state_interval_index import DeviceStateIntervalIndex
+from src.models.partition_key_strategy import PartitionKeyStrategy
+from src.models.ru_cost_model import RUCostModel
+from src.models.throughput_simulator import ThroughputSimulator
 from src.util.fs import FS
+from src.util.lru_cache import LRUCache
+from src.util.operations_log import OperationsLog
+from src.util.template import Template
 
 # get the Cosmos DB database and container names from environment variables, with defaults
 dbname = ConfigService.envvar("COSMOSDB_NOSQL_DB", "devices")
@@ -37,6 +87,7 @@ d1_container = ConfigService.envvar("COSMOSDB_NOSQL_D1_CONTAINER", "DeviceSingle
 d_container  = ConfigService.envvar("COSMOSDB_NOSQL_D_CONTAINER",  "Devices")
 ds_container = ConfigService.envvar("COSMOSDB_NOSQL_DS_CONTAINER", "DeviceState")
 da_container = ConfigService.envvar("COSMOSDB_NOSQL_DA_CONTAINER", "DeviceAttributes")
+dc_container = ConfigService.envvar("COSMOSDB_NOSQL_DC_CONTAINER", "DeviceStateCurrent")
 
 
 def print_options(msg):
@@ -55,6 +106,211 @@ def test_initialize_data():
         size = len(json.dumps(ds))
         print("device state: {} size:{}".format(ds, size))
 
+def benchmark_diffs(count: int, chunk_size: int = 100_000):
+    """
+    Compare the per-object DeviceStateChanges with the DeviceStateBatchChanges
+    engine over count (current, incoming) pairs, in chunks to bound memory.
+    """
+    DeviceData.initialize()
+    per_object_seconds, batch_seconds, per_object_changes, batch_changes = 0.0, 0.0, 0, 0
+    remaining = count
+    while remaining > 0:
+        n = min(chunk_size, remaining)
+        remaining = remaining - n
+        curr_docs, ds_docs = list(), list()
+        for i in range(n):
+            idx = random.randint(0, len(DeviceData.deviceStatesKeys) - 1)
+            curr_doc = dict(DeviceData.deviceStates[DeviceData.deviceStatesKeys[idx]])
+            curr_doc['_etag'] = 'etag'
+            ds_doc = dict(curr_doc)
+            del ds_doc['_etag']
+            make_random_device_state_changes(ds_doc)
+            curr_docs.append(curr_doc)
+            ds_docs.append(ds_doc)
+
+        start_time = time.perf_counter()
+        for i in range(n):
+            if DeviceStateChanges(curr_docs[i], ds_docs[i]).has_changes():
+                per_object_changes = per_object_changes + 1
+        per_object_seconds = per_object_seconds + (time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        batch = DeviceStateBatchChanges(curr_docs, ds_docs)
+        for i in range(n):
+            if batch.has_changes(i):
+                batch.patch_operations(i)
+        batch_changes = batch_changes + batch.change_count()
+        batch_seconds = batch_seconds + (time.perf_counter() - start_time)
+
+    results = dict()
+    results['count'] = count
+    results['per_object_seconds'] = per_object_seconds
+    results['per_object_changes'] = per_object_changes
+    results['batch_seconds'] = batch_seconds
+    results['batch_changes'] = batch_changes
+    results['speedup'] = per_object_seconds / batch_seconds if batch_seconds > 0 else 0.0
+    print(json.dumps(results, sort_keys=False, indent=2))
+    FS.write_json(results, "tmp/benchmark_diffs.json")
+
+def analyze_ru_costs(events_per_second: float):
+    """
+    Fit an RU cost model to the operations logs of a simulation, and write
+    a capacity report projecting the RU/s for the given events per second.
+    """
+    paths = sorted(glob.glob(ConfigService.arg_value("--ops-log", "tmp/dsc_operations-*.csv")))
+    if len(paths) == 0:
+        print("no operations log files found")
+        return
+    change_rate = None
+    if ConfigService.arg_value("--change-rate") is not None:
+        change_rate = ConfigService.float_arg("--change-rate", 0.0)
+    model = RUCostModel()
+    start_time = time.perf_counter()
+    model.process_files(paths, ConfigService.int_arg("--chunk-rows", 1_000_000))
+    report = model.capacity_report(
+        events_per_second, change_rate,
+        headroom=ConfigService.float_arg("--headroom", 1.2),
+        readme_ru_estimates=DeviceStateChangeOperations.readme_ru_estimates)
+    report['files'] = paths
+    report['elapsed_seconds'] = time.perf_counter() - start_time
+    FS.write_json(report, "tmp/ru_capacity_report.json")
+    print("events: {} mean_event_ru: {} change_rate: {}".format(
+        report['events'], report['mean_event_ru'], report['change_rate']))
+    print("projected RU/s: {} recommended manual RU/s: {} autoscale max RU/s: {}".format(
+        report['projected_ru_per_second'], report['recommended_manual_ru_per_second'],
+        report['recommended_autoscale_max_ru_per_second']))
+
+def simulate_throughput(provisioned_ru: float):
+    """
+    Simulate the given provisioned RU/s with the recorded operations logs of
+    --ops-log, or with synthetic events, for each of the partition schemes;
+    and write the throttling, backlog, and latency curves of each.
+    """
+    events_per_second = ConfigService.float_arg("--events-per-second", 1000.0)
+    arrivals = ConfigService.arg_value("--arrivals", "constant")
+    schemes = ConfigService.arg_value("--schemes", "did,first_letter").split(",")
+    ops_log = ConfigService.arg_value("--ops-log")
+    if ops_log is not None:
+        paths = sorted(glob.glob(ops_log))
+        if len(paths) == 0:
+            print("no operations log files found")
+            return
+        source = "operations logs: {}".format(paths)
+        def requests_function():
+            return ThroughputSimulator.log_requests(paths, events_per_second, arrivals)
+    else:
+        event_count = ConfigService.int_arg("--event-count", 100_000)
+        skew = ConfigService.arg_value("--skew", "zipf")
+        estimates = DeviceStateChangeOperations.readme_ru_estimates
+        source = "synthetic: {} {} events".format(event_count, skew)
+        def requests_function():
+            return ThroughputSimulator.synthetic_requests(
+                DeviceEventGenerator(skew=skew), event_count, events_per_second,
+                estimates['minimum'], estimates['with_updates'], arrivals)
+    physical_partitions = None
+    if ConfigService.arg_value("--physical-partitions") is not None:
+        physical_partitions = ConfigService.int_arg("--physical-partitions", 1)
+    start_time = time.perf_counter()
+    results = ThroughputSimulator.compare_schemes(
+        requests_function, schemes, provisioned_ru,
+        physical_partitions=physical_partitions,
+        max_retries=ConfigService.int_arg("--max-retries", 9))
+    results['source'] = source
+    results['elapsed_seconds'] = time.perf_counter() - start_time
+    FS.write_json(results, "tmp/throughput_simulation.json")
+    for scheme in schemes:
+        stats = results[scheme]
+        print("{}: partitions: {} keys: {} throttled_pct: {:.2f} failed_pct: {:.2f} p99 ms: {:.1f} hot_partition_ratio: {:.2f}".format(
+            scheme, stats['physical_partitions'], stats['partition_keys'], stats['throttled_pct'],
+            stats['failed_pct'], stats['latency_ms']['p99'], stats['hot_partition_ratio']))
+
+def resolve_device_identities():
+    """
+    Cluster the devices that share strong attribute values, from the DeviceStates
+    of an --export file or from generated events; in bulk, or with --incremental
+    one event at a time.  Write the cluster stats and the largest clusters.
+    """
+    strong_attrs = DeviceData.strong_attrs
+    if ConfigService.arg_value("--strong-attrs") is not None:
+        strong_attrs = ConfigService.arg_value("--strong-attrs").split(",")
+    weak_attrs = [attr for attr in DeviceData.strong_attrs + DeviceData.weak_attrs if attr not in strong_attrs]
+    resolver = DeviceIdentityResolver(strong_attrs, weak_attrs)
+    attrs = resolver.attrs
+    columns = dict()
+    for name in ["did"] + attrs:
+        columns[name] = list()
+    export_file = ConfigService.arg_value("--export")
+    if export_file is not None:
+        with open(export_file, "rt", encoding="utf-8") as f:
+            for line in f:
+                if len(line.strip()) > 0:
+                    doc = json.loads(line)
+                    for name in columns.keys():
+                        columns[name].append(doc.get(name, None))
+    else:
+        generator = DeviceEventGenerator(skew=ConfigService.arg_value("--skew", "zipf"))
+        dids = generator.pool_list("deviceIDs")
+        pools = dict()
+        for attr in attrs:
+            if attr in DeviceEventGenerator.attr_pools:
+                pools[attr] = generator.pool_list(DeviceEventGenerator.attr_pools[attr])
+        for batch in generator.batches(ConfigService.int_arg("--event-count", 1_000_000)):
+            columns["did"].extend([dids[d] for d in batch.column("device")])
+            for attr in attrs:
+                values = batch.column(attr)
+                if attr in pools:
+                    pool = pools[attr]
+                    values = [pool[v] for v in values]
+                columns[attr].extend(values)
+
+    start_time = time.perf_counter()
+    if ConfigService.boolean_arg("--incremental"):
+        names = list(columns.keys())
+        for row in zip(*[columns[name] for name in names]):
+            resolver.observe(dict(zip(names, row)))
+    else:
+        resolver.bulk_resolve(columns)
+    stats = resolver.get_stats()
+    stats['numpy'] = resolver.use_numpy
+    stats['incremental'] = ConfigService.boolean_arg("--incremental")
+    stats['elapsed_seconds'] = time.perf_counter() - start_time
+    stats['largest_clusters'] = resolver.largest_clusters(10)
+    FS.write_json(stats, "tmp/device_identity_clusters.json")
+    print("devices: {} clusters: {} multi_device_clusters: {} largest_cluster: {} seconds: {}".format(
+        stats['devices'], stats['clusters'], stats['multi_device_clusters'],
+        stats['largest_cluster'], stats['elapsed_seconds']))
+
+def benchmark_event_generator(count: int, skew: str):
+    """
+    Measure the rate of the DeviceEventGenerator in columnar batches,
+    and the rate of materializing its events as dicts.
+    """
+    generator = DeviceEventGenerator(skew=skew)
+    start_time = time.perf_counter()
+    changes = 0
+    for batch in generator.batches(count):
+        changes = changes + batch.change_count()
+    batch_seconds = time.perf_counter() - start_time
+
+    dict_count = min(count, 1_000_000)
+    start_time = time.perf_counter()
+    for event in generator.events(dict_count):
+        pass
+    dict_seconds = time.perf_counter() - start_time
+
+    results = dict()
+    results['count'] = count
+    results['skew'] = skew
+    results['numpy'] = generator.use_numpy
+    results['changed_events'] = changes
+    results['batch_seconds'] = batch_seconds
+    results['batch_events_per_second'] = count / batch_seconds if batch_seconds > 0 else 0.0
+    results['dict_count'] = dict_count
+    results['dict_seconds'] = dict_seconds
+    results['dict_events_per_second'] = dict_count / dict_seconds if dict_seconds > 0 else 0.0
+    print(json.dumps(results, sort_keys=False, indent=2))
+    FS.write_json(results, "tmp/benchmark_event_generator.json")
+
 async def simulate_device_state_stream(
         event_count: int, iterations: int, simulate_azure_function: bool):
     """
@@ -65,6 +321,7 @@ async def simulate_device_state_stream(
     logging.info("simulate_device_state_stream, d_container:  {}".format(d_container))
     logging.info("simulate_device_state_stream, ds_container: {}".format(ds_container))
     logging.info("simulate_device_state_stream, da_container: {}".format(da_container))
+    logging.info("simulate_device_state_stream, dc_container: {}".format(dc_container))
     DeviceData.initialize()
 
     try:
@@ -93,25 +350,67 @@ async def simulate_device_state_stream(
         for i in range(event_count):
             events_list.append(DeviceData.random_device_state())
 
+        # optionally coalesce the DeviceState inserts into per-partition batches;
+        # only when the pipeline just inserts, as an event's operations follow its insert
+        write_batcher = None
+        if ConfigService.boolean_arg("--batch-writes"):
+            if simulate_azure_function:
+                write_batcher = WriteBatcher(nosql_svc)
+            else:
+                logging.info("--batch-writes applies only with --simulate-az-function")
+
+        # with --simulate-az-function the events are only ingested by the
+        # pipeline, and a change feed processor of the DeviceState container
+        # executes the DeviceStateChangeOperations, like an Azure Function
+        cf_processor, cf_task, cf_stop_event = None, None, None
+        if simulate_azure_function:
+            cf_processor = ChangeFeedProcessor(
+                nosql_svc, LeaseStore("tmp/change_feed_leases.json"),
+                process_change_feed_batch(nosql_svc),
+                max_item_count=ConfigService.int_arg("--cf-batch-size", 100),
+                start_time="Now",
+                max_batch_attempts=ConfigService.int_arg("--cf-max-attempts", 5),
+                dead_letter_path="tmp/change_feed_dead_letters.ndjson")
+            await cf_processor.run_once()  # checkpoint the starting point of each range
+            cf_stop_event = asyncio.Event()
+            cf_task = asyncio.create_task(cf_processor.run(cf_stop_event))
+
+        # process the events concurrently, sharded by did into bounded worker queues
+        pipeline = DeviceEventPipeline(
+            nosql_svc, write_batcher,
+            workers=ConfigService.int_arg("--workers", 8),
+            queue_depth=ConfigService.int_arg("--queue-depth", 100),
+            execute_operations=(simulate_azure_function == False),
+            partition_strategy=DeviceStateChangeOperations.partition_strategy)
+        pipeline.start()
+
         for i in range(iterations):
-            await stream_device_state_events(i, events_list, nosql_svc)
+            await stream_device_state_events(i, events_list, pipeline)
             await asyncio.sleep(5)
 
-        # create the DB Operations JSON and CSV files
-        FS.write_json(
-            DeviceStateChangeOperations.all_operations,
-            "tmp/device_state_change_operations.json")
-        csv_lines = list()
-        csv_lines.append("did,operation,ru,doc_size")
-        for doc in DeviceStateChangeOperations.all_operations:
-            line = "{},{},{},{}".format(
-                doc['did'], doc['operation'], doc['ru'], doc['doc_size'])
-            csv_lines.append(line)
-        FS.write_lines(csv_lines, "tmp/dsc_operations.csv")
+        await pipeline.close()
+        if cf_processor is not None:
+            cf_stop_event.set()
+            await cf_task
+            logging.info("change feed processor stats: {}".format(cf_processor.get_stats()))
+        FS.write_json(pipeline.get_stats(), "tmp/device_event_pipeline_stats.json")
+
+        if write_batcher is not None:
+            await write_batcher.close()
+            logging.info("write_batcher stats: {}".format(write_batcher.get_stats()))
+
+        # the DB Operations were streamed to tmp/dsc_operations-*.csv or .ndjson
+        DeviceStateChangeOperations.operations_log.close()
+        logging.info("operations log files: {}".format(
+            DeviceStateChangeOperations.operations_log.paths))
+        FS.write_json(DeviceStateChangeOperations.ru_summary(), "tmp/dsc_ru_summary.json")
+        if DeviceStateChangeOperations.state_cache is not None:
+            logging.info("state_cache stats: {}".format(
+                DeviceStateChangeOperations.state_cache.get_stats()))
 
         # create the DeviceStates-by-device CSV file
         results = await nosql_svc.query_items(
-            query_device_states_sql(), cross_partition=True, pk='/did', max_items=1000)
+            query_device_states_sql(), cross_partition=True, max_items=1000)
         csv_lines = list()
         csv_lines.append("zzzdid,evt_time,until,_ts,id")
         for result in results:
@@ -120,6 +419,11 @@ async def simulate_device_state_stream(
             csv_lines.append(line)
         FS.write_lines(sorted(csv_lines, reverse=True), "tmp/device_state_changes.csv")
 
+        # export the per-operation latency and RU histograms
+        FS.write_json(nosql_svc.metrics.to_dict(), "tmp/cosmos_operation_metrics.json")
+        FS.write("tmp/cosmos_operation_metrics.prom", nosql_svc.metrics.to_prometheus())
+        logging.info("single-flight point-reads: {}".format(nosql_svc.single_flight_stats()))
+
     except Exception as e:
         logging.info(str(e))
         logging.info(traceback.format_exc())
@@ -127,27 +431,219 @@ async def simulate_device_state_stream(
     logging.info("end of simulate_device_state_stream")
 
 
-async def stream_device_state_events(iteration: int, events_list: list, nosql_svc: CosmosNoSQLService):
+async def drive_device_state_load(stages_spec: str):
+    """
+    Drive the device state pipeline with an open-loop workload at the
+    rates of the given stages, and write a JSON and HTML report of the
+    latencies, RU per event, and error and throttle rates.
+    """
+    DeviceData.initialize()
+    stages = LoadDriver.parse_stages(stages_spec)
+    arrivals = ConfigService.arg_value("--arrivals", "poisson")
+    if ConfigService.boolean_arg("--in-memory"):
+        opts = dict()
+        opts["latency_ms"] = ConfigService.float_arg("--latency-ms", 0.0)
+        opts["throttle_pct"] = ConfigService.float_arg("--throttle-pct", 0.0)
+        nosql_svc = InMemoryNoSQLService(opts)
+        target = "in-memory, latency_ms: {}, throttle_pct: {}".format(
+            opts["latency_ms"], opts["throttle_pct"])
+    else:
+        nosql_svc = CosmosNoSQLService(dict())
+        target = "Cosmos DB {}/{}".format(dbname, ds_container)
+    try:
+        await nosql_svc.initialize()
+        nosql_svc.set_db(dbname)
+        nosql_svc.set_container(ds_container)
+
+        pipeline = DeviceEventPipeline(
+            nosql_svc,
+            workers=ConfigService.int_arg("--workers", 8),
+            queue_depth=ConfigService.int_arg("--queue-depth", 100),
+            partition_strategy=DeviceStateChangeOperations.partition_strategy)
+        pipeline.start()
+
+        events = DeviceEventGenerator(skew=ConfigService.arg_value("--skew", "zipf")).events(sys.maxsize)
+        events = itertools.chain([next(events)], events)  # decode the value pools before the clock starts
+        last_evt_times = dict()  # did -> evt_time, so the zipf-hot devices' events don't tie
+        def next_event():
+            event = next(events)
+            event['evt_time'] = LoadDriver.device_evt_time(last_evt_times, event['did'])
+            return event
+
+        driver = LoadDriver(pipeline, next_event, stages, arrivals)
+        await driver.run()
+        await pipeline.close()
+
+        stats = driver.get_stats(nosql_svc.metrics)
+        stats['target'] = target
+        stats['event_ru'] = DeviceStateChangeOperations.event_ru_histogram.summary()
+        FS.write_json(stats, "tmp/load_report.json")
+        DeviceStateChangeOperations.operations_log.close()
+        FS.write_json(DeviceStateChangeOperations.ru_summary(), "tmp/dsc_ru_summary.json")
+        latencies = list()
+        latencies.append(("end-to-end", stats['end_to_end_ms']))
+        latencies.append(("queue wait", stats['queue_wait_ms']))
+        latencies.append(("schedule lag", stats['schedule_lag_ms']))
+        latencies.append(("insert", stats['pipeline']['insert_ms']))
+        latencies.append(("operations", stats['pipeline']['operations_ms']))
+        values = dict()
+        values['run_time'] = time.strftime("%Y-%m-%d %H:%M:%S")
+        values['target'] = target
+        values['stats'] = stats
+        values['latencies'] = latencies
+        template = Template.get_template(".", "load_report.html")
+        FS.write("tmp/load_report.html", Template.render(template, values))
+        print("end-to-end ms: {}".format(json.dumps(stats['end_to_end_ms'])))
+        print("ru_per_event: {} error_rate: {} throttle_rate: {}".format(
+            stats['ru_per_event'], stats['error_rate'], stats['throttle_rate']))
+    except Exception as e:
+        logging.info(str(e))
+        logging.info(traceback.format_exc())
+    await nosql_svc.close()
+
+
+async def export_device_states(outfile: str):
+    """Export the interval attributes of the DeviceState documents to an NDJSON file."""
+    nosql_svc = CosmosNoSQLService(dict())
+    try:
+        await nosql_svc.initialize()
+        nosql_svc.set_db(dbname)
+        nosql_svc.set_container(ds_container)
+        history = DeviceStateHistory(nosql_svc)
+        count = await history.export(outfile, fields_arg())
+        print("exported {} DeviceState documents to {}".format(count, outfile))
+    except Exception as e:
+        logging.info(str(e))
+        logging.info(traceback.format_exc())
+    await nosql_svc.close()
+
+
+async def device_states_as_of(t: float):
+    """
+    Query the state of devices at the given epoch time; the --dids with
+    single-partition queries, or else all of the devices with an interval
+    index built from an --export file or from the --change-feed.
+    """
+    start_time = time.perf_counter()
+    dids = ConfigService.arg_value("--dids")
+    export_file = ConfigService.arg_value("--export")
+    if dids is None and export_file is not None:
+        index = DeviceStateIntervalIndex(fields_arg())
+        index.add_file(export_file)
+        write_device_states_as_of(index, t, start_time)
+        return
+    nosql_svc = CosmosNoSQLService(dict())
+    try:
+        await nosql_svc.initialize()
+        nosql_svc.set_db(dbname)
+        nosql_svc.set_container(ds_container)
+        if dids is not None:
+            history = DeviceStateHistory(nosql_svc, partition_strategy_arg())
+            states = await history.states_as_of(dids.split(","), t)
+            results = dict()
+            results['t'] = t
+            results['states'] = states
+            results['query_count'] = history.query_count
+            results['request_units'] = history.request_units
+            results['elapsed_seconds'] = time.perf_counter() - start_time
+            FS.write_json(results, "tmp/device_states_as_of.json")
+        elif ConfigService.boolean_arg("--change-feed"):
+            index = DeviceStateIntervalIndex(fields_arg())
+            async def index_batch(lease_key, docs):
+                index.add_all(docs)
+            cf_processor = ChangeFeedProcessor(
+                nosql_svc, LeaseStore(), index_batch,
+                max_item_count=ConfigService.int_arg("--cf-batch-size", 1000),
+                start_time="Beginning")
+            await cf_processor.run_until_idle()
+            logging.info("change feed processor stats: {}".format(cf_processor.get_stats()))
+            write_device_states_as_of(index, t, start_time)
+        else:
+            print("specify --dids, --export, or --change-feed")
+    except Exception as e:
+        logging.info(str(e))
+        logging.info(traceback.format_exc())
+    await nosql_svc.close()
+
+
+def write_device_states_as_of(index: DeviceStateIntervalIndex, t: float, start_time: float):
+    """Write the state of every device at time t to an NDJSON file, and the index stats."""
+    count = 0
+    with open("tmp/device_states_as_of.ndjson", "wt", encoding="utf-8") as f:
+        for state in index.snapshot(t):
+            f.write(json.dumps(state))
+            f.write("\n")
+            count = count + 1
+    stats = index.get_stats()
+    stats['t'] = t
+    stats['states'] = count
+    stats['elapsed_seconds'] = time.perf_counter() - start_time
+    FS.write_json(stats, "tmp/device_states_as_of.json")
+    print("{} of {} devices had a state at {}".format(count, stats['devices'], t))
+
+
+def partition_strategy_arg() -> PartitionKeyStrategy:
+    """Return the PartitionKeyStrategy of the --partition-strategy spec, or None for the did."""
+    spec = ConfigService.arg_value("--partition-strategy")
+    if spec is None:
+        return None
+    return PartitionKeyStrategy.parse(
+        spec,
+        max_lookback_buckets=ConfigService.int_arg("--max-lookback-buckets", 90),
+        max_empty_buckets=ConfigService.int_arg("--max-empty-buckets", 7))
+
+
+def fields_arg() -> list:
+    """Return the list of the comma-separated --fields, or None."""
+    fields = ConfigService.arg_value("--fields")
+    if fields is None:
+        return None
+    return fields.split(",")
+
+
+def configure_operations_from_args():
+    """Set the DeviceStateChangeOperations modes from the command-line flags."""
+    if ConfigService.boolean_arg("--upsert-updates"):
+        DeviceStateChangeOperations.use_patch_updates = False
+    if ConfigService.boolean_arg("--etag-pipeline"):
+        DeviceStateChangeOperations.use_etag_pipeline = True
+    if ConfigService.boolean_arg("--current-state"):
+        DeviceStateChangeOperations.use_current_state_docs = True
+    if ConfigService.boolean_arg("--full-flow"):
+        DeviceStateChangeOperations.use_full_flow = True
+    DeviceStateChangeOperations.partition_strategy = partition_strategy_arg()
+    cache_size = ConfigService.int_arg("--cache-size", 0)
+    if cache_size > 0:
+        DeviceStateChangeOperations.state_cache = LRUCache(cache_size)
+    DeviceStateChangeOperations.operations_log = OperationsLog(
+        "tmp/dsc_operations",
+        fmt=ConfigService.arg_value("--ops-log-format", "csv"),
+        max_bytes=ConfigService.int_arg("--ops-log-max-mb", 64) * 1024 * 1024)
+
+
+async def stream_device_state_events(
+        iteration: int, events_list: list, pipeline: DeviceEventPipeline):
+    """
+    Submit the events of one iteration to the pipeline, which processes
+    them concurrently across devices and in order within each device.
+    """
     for obj in events_list:
-        print('----------')
         obj['id'] = str(uuid.uuid4())
         obj['evt_time'] = int(time.time())
-        print("iter: {} streaming device_state event: did: {} id: {}".format(
-            iteration, event_count, obj['did'], obj['id']))
-        
         if iteration > 0:
             make_random_device_state_changes(obj)
+        # submit a copy, as obj is modified again in the next iteration
+        await pipeline.submit(dict(obj))
+    await pipeline.drain()
+    print("iteration: {} pipeline stats: {}".format(iteration, json.dumps(pipeline.get_stats())))
 
-        ds_doc = await nosql_svc.upsert_item(obj)
-        insert_ru = nosql_svc.last_request_charge()
-        print("ds_doc doc: {}".format(ds_doc))
-        print("ds_doc doc size: {}".format(len(json.dumps(ds_doc))))
-        print("ds_doc insert request_charge: {}".format(insert_ru))
-        time.sleep(0.1)
 
-        if True:
-            ops = DeviceStateChangeOperations(nosql_svc, ds_doc, insert_ru)
-            await ops.execute()
+def process_change_feed_batch(nosql_svc: CosmosNoSQLService):
+    """Return the async batch function for the DeviceState ChangeFeedProcessor."""
+    async def process_batch(lease_key, docs):
+        count = await DeviceStateChangeOperations.execute_change_feed_batch(nosql_svc, docs)
+        print("change feed batch: docs: {} executed: {}".format(len(docs), count))
+    return process_batch
 
 
 def make_random_device_state_changes(obj):
@@ -193,11 +689,47 @@ if __name__ == "__main__":
             elif func == "test_initialize_data":
                 FS.delete_files_in_dir("tmp")
                 test_initialize_data()
+            elif func == "rebuild_device_data":
+                seed = None
+                if len(sys.argv) > 2:
+                    seed = int(sys.argv[2])
+                print("rebuilt: {}".format(DeviceData.rebuild(seed)))
+            elif func == "benchmark_diffs":
+                count = 1_000_000
+                if len(sys.argv) > 2:
+                    count = int(sys.argv[2])
+                benchmark_diffs(count)
+            elif func == "analyze_ru_costs":
+                analyze_ru_costs(float(sys.argv[2]))
+            elif func == "simulate_throughput":
+                simulate_throughput(float(sys.argv[2]))
+            elif func == "export_device_states":
+                outfile = "tmp/device_states_export.ndjson"
+                if len(sys.argv) > 2:
+                    outfile = sys.argv[2]
+                asyncio.run(export_device_states(outfile))
+            elif func == "device_states_as_of":
+                asyncio.run(device_states_as_of(float(sys.argv[2])))
+            elif func == "resolve_device_identities":
+                resolve_device_identities()
+            elif func == "benchmark_event_generator":
+                count = 1_000_000
+                skew = "zipf"
+                if len(sys.argv) > 2:
+                    count = int(sys.argv[2])
+                if len(sys.argv) > 3:
+                    skew = sys.argv[3]
+                benchmark_event_generator(count, skew)
+            elif func == "drive_device_state_load":
+                FS.delete_files_in_dir("tmp")
+                configure_operations_from_args()
+                asyncio.run(drive_device_state_load(sys.argv[2]))
             elif func == "simulate_device_state_stream":
                 FS.delete_files_in_dir("tmp")
                 event_count = int(sys.argv[2])
                 iterations = int(sys.argv[3])
                 simulate_azure_function = ConfigService.boolean_arg("--simulate-az-function")
+                configure_operations_from_args()
                 asyncio.run(simulate_device_state_stream(
                     event_count, iterations, simulate_azure_function))
             else:
@@ -8,11 +8,14 @@ Usage:
     python main_pylibraries.py test_cosmos_service graph test --bulk-load
     python main_pylibraries.py load_python_libraries_graph <dbname> <cname> <max_docs>
     python main_pylibraries.py load_python_libraries_graph graph graph 999999 --bulk-load
+    python main_pylibraries.py load_python_libraries_graph graph graph 999999 --bulk-load --workers 4
     python main_pylibraries.py point_read <dbname> <cname> <doc_id> <pk>
     python main_pylibraries.py point_read graph graph flask f
     python main_pylibraries.py query <dbname> <cname> <query_name>
     python main_pylibraries.py query graph graph count_documents
     python main_pylibraries.py query graph graph docs_in_pk_2
+    python main_pylibraries.py query graph graph all_library_ids --page-size 500 --max-pages 3
+    python main_pylibraries.py query graph graph all_library_ids --continuation-token <token>
     python main_pylibraries.py traverse_dependencies <dbname> <cname> <libname> <depth>
     python main_pylibraries.py traverse_dependencies graph graph flask 1
     python main_pylibraries.py traverse_dependencies graph graph flask 3
@@ -22,12 +25,19 @@ Options:
 """
 
 import asyncio
+import concurrent.futures
+import itertools
 import json
+import multiprocessing
+import os
+import queue
+import shutil
 import sys
 import time
 import logging
 import traceback
 import uuid
+import zipfile
 
 from docopt import docopt
 from dotenv import load_dotenv
@@ -42,6 +52,9 @@ from src.util.fs import FS
 
 fake = Faker()
 
+PYTHON_LIBS_JSON_FILE = "../data/python_libs/python_libs.json"
+PYTHON_LIBS_ZIP_FILE = "../data/python_libs/python_libs.zip"
+
 
 def print_options(msg):
     print(msg)
@@ -125,8 +138,8 @@ async def test_cosmos_service(dbname, cname):
         for idx, result in enumerate(results):
             print("select * query result {}: {}".format(idx, result))
 
-        results = await nosql_svc.query_items(
-            "select * from c where c.pk = 'bulk_pk'", False
+        results = await nosql_svc.query_partition(
+            "select * from c where c.pk = 'bulk_pk'", "bulk_pk"
         )
         for idx, result in enumerate(results):
             print("test pk query result {}: {}".format(idx, result))
@@ -161,79 +174,272 @@ async def load_python_libraries_graph(dbname, cname, max_docs):
             dbname, cname, max_docs
         )
     )
+    nosql_svc = None
     try:
         opts = dict()
         nosql_svc = CosmosNoSQLService(opts)
         await nosql_svc.initialize()
         nosql_svc.set_db(dbname)
         nosql_svc.set_container(cname)
-        doc_dict = FS.read_json("../data/python_libs/python_libs.json")
-        partition_key_values = collect_partition_key_values(doc_dict)
-        print(
-            "partition_keys: {} {}".format(
-                len(partition_key_values), partition_key_values
+        # the documents are streamed from the dataset file one at a time,
+        # so memory use doesn't grow with the size of the dataset
+        docs = itertools.islice(python_libs_docs(), max_docs)
+        status_counter = await batch_load_docs(nosql_svc, docs)
+        logging.info(
+            "load_python_libraries_graph, results: {}".format(
+                json.dumps(status_counter.get_data())
             )
         )
+    except Exception as e:
+        logging.info(str(e))
+        logging.info(traceback.format_exc())
+    if nosql_svc is not None:
+        await nosql_svc.close()
 
-        for pk_value in partition_key_values:
-            pk_docs = select_docs_in_pk(doc_dict, pk_value)
-            print("pk_value: {}, docs: {}".format(pk_value, len(pk_docs)))
-            await batch_load_docs(nosql_svc, pk_docs, pk_value)
 
+def load_python_libraries_graph_sharded(dbname, cname, max_docs, workers):
+    """
+    Load the graph with the given number of worker processes, each with
+    its own CosmosNoSQLService client and asyncio event loop.
+    The dataset file is split into byte ranges of whole entries (see
+    FS.json_object_ranges), and each worker decodes and loads the documents
+    of its own range, up to its share of max_docs; so the decoding is also
+    parallel, and no documents are passed between the processes.  The
+    dataset is sorted by library name, so each partition key is mostly in
+    one range.  The parent process logs the progress that the workers
+    report, and merges their status counters.
+    """
+    logging.info(
+        "load_python_libraries_graph_sharded, dbname: {}, cname: {}, max_docs: {}, workers: {}".format(
+            dbname, cname, max_docs, workers
+        )
+    )
+    start_time = time.time()
+    datafile = python_libs_json_datafile()
+    ranges = FS.json_object_ranges(datafile, workers)
+    status_counter, worker_docs = Counter(), Counter()
+    progress_counter, progress_docs = Counter(), Counter()
+    progress_queue = multiprocessing.Queue()
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max(1, len(ranges)),
+        initializer=init_shard_worker,
+        initargs=(progress_queue,),
+    ) as executor:
+        futures = list()
+        for idx, (start, end) in enumerate(ranges):
+            futures.append(
+                executor.submit(
+                    load_shard, dbname, cname, idx, datafile, start, end,
+                    shard_max_docs(max_docs, len(ranges), idx),
+                )
+            )
+        pending = set(futures)
+        while len(pending) > 0:
+            done, pending = concurrent.futures.wait(pending, timeout=1.0)
+            merge_shard_progress(progress_queue, progress_counter, progress_docs)
+            for future in done:
+                if future.exception() is not None:
+                    logging.info("worker exception: {}".format(future.exception()))
+                else:
+                    result = future.result()
+                    worker_docs.increment_by(result["worker"], result["docs"])
+                    for status_code in result["status_codes"].keys():
+                        status_counter.increment_by(status_code, result["status_codes"][status_code])
+
+    elapsed = time.time() - start_time
+    total_docs = sum(worker_docs.get_data().values())
+    logging.info(
+        "load_python_libraries_graph_sharded, docs: {}, seconds: {:.3f}, docs/sec: {:.1f}, docs per worker: {}, results: {}".format(
+            total_docs,
+            elapsed,
+            total_docs / elapsed if elapsed > 0 else 0.0,
+            json.dumps(worker_docs.get_data()),
+            json.dumps(status_counter.get_data()),
+        )
+    )
+
+
+def shard_max_docs(max_docs, shard_count, shard_number) -> int:
+    """Return the given shard's share of max_docs; the remainder goes to the first shards."""
+    share = max_docs // shard_count
+    if shard_number < (max_docs % shard_count):
+        share = share + 1
+    return share
+
+
+def partition_key_batches(docs, batch_size=10):
+    """
+    Return a generator of (batch_number, pk, batch_operations) tuples of
+    the given docs, with up to batch_size upserts of one partition key per
+    batch; only one pending batch per partition key is held in memory.
+    The last, partial batch of each partition key is yielded at the end.
+    """
+    batch_numbers, pending_batches = Counter(), dict()
+    for doc in docs:
+        pk_value = doc["pk"]
+        if pk_value not in pending_batches.keys():
+            pending_batches[pk_value] = list()
+        batch_operations = pending_batches[pk_value]
+        batch_operations.append(("upsert", (doc,)))
+        if len(batch_operations) >= batch_size:
+            batch_numbers.increment(pk_value)
+            yield (batch_numbers.get_value(pk_value), pk_value, batch_operations)
+            pending_batches[pk_value] = list()
+    for pk_value in sorted(pending_batches.keys()):
+        batch_operations = pending_batches[pk_value]
+        if len(batch_operations) > 0:
+            batch_numbers.increment(pk_value)
+            yield (batch_numbers.get_value(pk_value), pk_value, batch_operations)
+
+
+def merge_shard_progress(progress_queue, status_counter, worker_docs) -> None:
+    """Drain the worker progress messages and merge them into the given counters."""
+    merged = False
+    while True:
+        try:
+            msg = progress_queue.get_nowait()
+        except queue.Empty:
+            break
+        worker_docs.increment_by(msg["worker"], msg["docs"])
+        for status_code in msg["status_codes"].keys():
+            status_counter.increment_by(status_code, msg["status_codes"][status_code])
+        merged = True
+    if merged:
+        logging.info(
+            "progress, docs: {}, results: {}".format(
+                sum(worker_docs.get_data().values()),
+                json.dumps(status_counter.get_data()),
+            )
+        )
+
+
+# the progress queue of a worker process, set by init_shard_worker; a
+# multiprocessing.Queue can only be passed to a process when it's created
+shard_progress_queue = None
+
+
+def init_shard_worker(progress_queue) -> None:
+    global shard_progress_queue
+    shard_progress_queue = progress_queue
+    logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+
+def load_shard(dbname, cname, worker_number, datafile, start, end, max_docs) -> dict:
+    """
+    Worker process entry point; decode and load up to max_docs documents
+    of the given byte range of the datafile.  Return a dict with the
+    worker number, the number of documents, and the status code counts.
+    """
+    return asyncio.run(
+        load_shard_async(
+            dbname, cname, worker_number, datafile, start, end, max_docs, shard_progress_queue
+        )
+    )
+
+
+async def load_shard_async(
+    dbname, cname, worker_number, datafile, start, end, max_docs, progress_queue=None
+) -> dict:
+    nosql_svc = None
+    status_counter, doc_counter = Counter(), Counter()
+    try:
+        opts = dict()
+        nosql_svc = CosmosNoSQLService(opts)
+        await nosql_svc.initialize()
+        nosql_svc.set_db(dbname)
+        nosql_svc.set_container(cname)
+
+        def range_docs():
+            entries = FS.json_entries_in_range(datafile, start, end)
+            for _, doc in itertools.islice(entries, max_docs):
+                doc_counter.increment("docs")
+                yield doc
+
+        status_counter = await batch_load_docs(nosql_svc, range_docs(), progress_queue, worker_number)
     except Exception as e:
         logging.info(str(e))
         logging.info(traceback.format_exc())
-    await nosql_svc.close()
+    if nosql_svc is not None:
+        await nosql_svc.close()
+    result = dict()
+    result["worker"] = str(worker_number)
+    result["docs"] = doc_counter.get_value("docs")
+    result["status_codes"] = status_counter.get_data()
+    return result
 
 
-def collect_partition_key_values(doc_dict) -> list:
+def python_libs_datafile() -> str:
     """
-    Iterate the set of documents to be loaded into Cosmos DB.
-    Collect their unique set of partition key values and
-    return them as a sorted list.
+    Return the path to the python libraries dataset; the unzipped json
+    file if it's present, otherwise the zip file in the GitHub repo.
+    Both can be streamed with FS.json_entries_iterator.
     """
-    doc_names = list(doc_dict.keys())
-    partition_keys = dict()
-    for doc_name in doc_names:
-        pk = doc_dict[doc_name]["pk"]
-        partition_keys[pk] = 1
-    return sorted(partition_keys.keys())
-
-
-def select_docs_in_pk(doc_dict, pk_value):
-    selected = list()
-    doc_names = list(doc_dict.keys())
-    for doc_name in doc_names:
-        doc = doc_dict[doc_name]
-        if doc["pk"] == pk_value:
-            selected.append(doc)
-    return selected
-
-
-async def batch_load_docs(nosql_svc, pk_docs, pk_value):
-    batch_number, batch_size, batch_operations = 0, 10, list()
-    print("batch_load_docs, pk_value: {}, docs: {}".format(pk_value, len(pk_docs)))
-
-    # batch load cosmos db in batches of 10 documents
-    for doc in pk_docs:
-        try:
-            op = ("upsert", (doc,))
-            batch_operations.append(op)
-            if len(batch_operations) >= batch_size:
-                batch_number = batch_number + 1
-                await load_batch(nosql_svc, batch_number, batch_operations, pk_value)
-                batch_operations = list()
-        except Exception as e:
-            logging.info(traceback.format_exc())
-            return
+    if os.path.isfile(PYTHON_LIBS_JSON_FILE):
+        return PYTHON_LIBS_JSON_FILE
+    return PYTHON_LIBS_ZIP_FILE
+
+
+def python_libs_json_datafile() -> str:
+    """
+    Return the path to the unzipped python libraries dataset, extracting
+    it from the zip file to the tmp directory first if necessary, as the
+    sharded load reads byte ranges of it.
+    """
+    datafile = python_libs_datafile()
+    if not zipfile.is_zipfile(datafile):
+        return datafile
+    outfile = "tmp/python_libs.json"
+    if not os.path.isfile(outfile):
+        with zipfile.ZipFile(datafile) as zf:
+            member = [n for n in zf.namelist() if n.endswith(".json")][0]
+            with zf.open(member, mode="r") as src, open("{}.tmp".format(outfile), "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        os.replace("{}.tmp".format(outfile), outfile)
+    return outfile
+
+
+def python_libs_docs():
+    """Return a generator of the library documents in the dataset."""
+    for _, doc in FS.json_entries_iterator(python_libs_datafile()):
+        yield doc
+
+
+async def batch_load_docs(nosql_svc, docs, progress_queue=None, worker_number=0) -> Counter:
+    """
+    Load the given stream of documents in batches of 10 documents per
+    partition key.  Only one pending batch per partition key is held
+    in memory as the documents are iterated.  Return a Counter of the
+    batch result status codes.  If a progress_queue is given, a progress
+    message is put on it after each batch for the parent process.
+    """
+    status_counter, batch_numbers = Counter(), Counter()
+    try:
+        for batch_number, pk_value, batch_operations in partition_key_batches(docs):
+            batch_numbers.increment(pk_value)
+            counter = await load_batch(
+                nosql_svc, batch_number, batch_operations, pk_value
+            )
+            report_batch_progress(
+                progress_queue, worker_number, batch_operations, counter
+            )
+            status_counter.merge(counter)
+    except Exception as e:
+        logging.info(traceback.format_exc())
+        return status_counter
+    print("batch_load_docs, batches per pk: {}".format(batch_numbers.get_data()))
+    return status_counter
 
-    # load the last batch of documents, if any
-    if len(batch_operations) > 0:
-        batch_number = batch_number + 1
-        await load_batch(nosql_svc, batch_number, batch_operations, pk_value)
 
+def report_batch_progress(progress_queue, worker_number, batch_operations, counter) -> None:
+    if progress_queue is not None:
+        msg = dict()
+        msg["worker"] = str(worker_number)
+        msg["docs"] = len(batch_operations)
+        msg["status_codes"] = counter.get_data()
+        progress_queue.put(msg)
 
-async def load_batch(nosql_svc, batch_number, batch_operations, pk):
+
+async def load_batch(nosql_svc, batch_number, batch_operations, pk) -> Counter:
     counter = Counter()
     # the --bulk-load flag enables testing/debugging this logic
     # without actually loading the data into Cosmos DB
@@ -250,7 +456,7 @@ async def load_batch(nosql_svc, batch_number, batch_operations, pk):
                 batch_number, pk, len(batch_operations), json.dumps(counter.get_data())
             )
         )
-    await asyncio.sleep(0.1)
+    return counter
 
 
 def create_random_person_document(pk="") -> dict:
@@ -301,6 +507,12 @@ async def point_read(dbname, cname, doc_id, doc_pk):
 
 
 async def query(dbname, cname, query_name):
+    """
+    Execute the named query, paging through the results with the optional
+    --page-size, --max-pages, and --continuation-token command-line flags.
+    The continuation token of the last page is displayed so that a large
+    result set can be resumed in a later invocation.
+    """
     nosql_svc = None
     try:
         opts = dict()
@@ -309,22 +521,18 @@ async def query(dbname, cname, query_name):
         nosql_svc.set_db(dbname)
         nosql_svc.set_container(cname)
 
+        sql, pk, print_docs = None, None, False
         if query_name == "count_documents":
             sql = "select value count(1) from c"
-            print("SQL: {}".format(sql))
-            results = await nosql_svc.query_items(sql, False)
-            for idx, result in enumerate(results):
-                print("count_documents result: {}".format(result))
-            print("request unit charge: {}".format(nosql_svc.last_request_charge()))
         elif query_name == "docs_in_pk_2":
             sql = "select * from c where c.pk = '2'"
-            print("SQL: {}".format(sql))
-            results = await nosql_svc.query_items(sql, False)
-            for idx, doc in enumerate(results):
-                print("doc {}: {}".format(idx, json.dumps(doc, indent=2)))
-            print("request unit charge: {}".format(nosql_svc.last_request_charge()))
+            pk, print_docs = "2", True
+        elif query_name == "all_library_ids":
+            sql = "select c.id, c.pk from c"
         else:
             print("query_name '{}' is not recognized".format(query_name))
+        if sql is not None:
+            await query_in_pages(nosql_svc, sql, pk, query_name, print_docs)
     except Exception as e:
         logging.info(str(e))
         logging.info(traceback.format_exc())
@@ -333,6 +541,36 @@ async def query(dbname, cname, query_name):
         await nosql_svc.close()
 
 
+async def query_in_pages(nosql_svc, sql, pk, query_name, print_docs):
+    page_size = ConfigService.int_arg("--page-size", 100)
+    max_pages = ConfigService.int_arg("--max-pages", -1)
+    continuation_token = ConfigService.arg_value("--continuation-token")
+    print("SQL: {}".format(sql))
+
+    total_items, total_ru, last_token = 0, 0.0, None
+    async for page in nosql_svc.query_pages(
+        sql, page_size=page_size, continuation_token=continuation_token, pk=pk
+    ):
+        for idx, doc in enumerate(page["items"]):
+            if print_docs == True:
+                print("doc {}: {}".format(total_items + idx, json.dumps(doc, indent=2)))
+            elif query_name == "count_documents":
+                print("count_documents result: {}".format(doc))
+        total_items = total_items + page["item_count"]
+        total_ru = total_ru + page["ru"]
+        last_token = page["continuation_token"]
+        print(
+            "page {}: items: {}, request unit charge: {}".format(
+                page["page_number"], page["item_count"], page["ru"]
+            )
+        )
+        if page["page_number"] == max_pages:
+            break
+    print("total items: {}, total request units: {}".format(total_items, total_ru))
+    if last_token is not None:
+        print("continuation token: {}".format(last_token))
+
+
 async def traverse_dependencies(dbname, cname, libname, depth):
     nosql_svc = None
     try:
@@ -347,18 +585,24 @@ async def traverse_dependencies(dbname, cname, libname, depth):
         # libraries while the sample dataset only has ~10k libraries.
         # This can result in many non-found cases when traversing
         # the graph.
-        doc_dict = FS.read_json("../data/python_libs/python_libs.json")
-        known_libs = doc_dict.keys()
+        known_libs = set()
+        for known_name, _ in FS.json_entries_iterator(python_libs_datafile()):
+            known_libs.add(known_name)
         dg = DependencyGraph(nosql_svc, known_libs)
 
         results = await dg.traverse_dependencies(libname, depth)
         print(
-            "traverse_dependencies, seconds {}, docs: {}".format(
-                results["elapsed_time"], len(results["collected_libs"])
+            "traverse_dependencies, seconds {}, docs: {}, request units: {}".format(
+                results["elapsed_time"],
+                len(results["collected_libs"]),
+                results["request_units"],
             )
         )
         outfile = "traversals/{}_{}.json".format(libname, depth)
         FS.write_json(results, outfile)
+        print("operation metrics: {}".format(
+            json.dumps(nosql_svc.metrics.to_dict(), indent=2)))
+        print("single-flight point-reads: {}".format(nosql_svc.single_flight_stats()))
     except Exception as e:
         logging.info(str(e))
         logging.info(traceback.format_exc())
@@ -385,7 +629,11 @@ if __name__ == "__main__":
                 dbname = sys.argv[2]
                 cname = sys.argv[3]
                 max_docs = int(sys.argv[4])
-                asyncio.run(load_python_libraries_graph(dbname, cname, max_docs))
+                workers = ConfigService.int_arg("--workers", 1)
+                if workers > 1:
+                    load_python_libraries_graph_sharded(dbname, cname, max_docs, workers)
+                else:
+                    asyncio.run(load_python_libraries_graph(dbname, cname, max_docs))
             elif func == "point_read":
                 dbname = sys.argv[2]
                 cname = sys.argv[3]
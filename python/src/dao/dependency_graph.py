@@ -26,6 +26,7 @@ class DependencyGraph:
         self.nosql_svc = nosql_svc
         self.ctrproxy = nosql_svc.current_ctrproxy()
         self.known_libs = known_libs
+        self.request_units = 0.0
 
     async def traverse_dependencies(self, root_library_name: str, depth: int) -> dict:
         """
@@ -55,14 +56,20 @@ class DependencyGraph:
             logging.info(str(e))
             logging.info(traceback.format_exc())
         result_object["elapsed_time"] = time.time() - result_object["start_time"]
+        result_object["request_units"] = self.request_units
         return result_object
 
     async def find_by_name(self, name) -> dict | None:
+        """
+        Find the library with the given name with a single-partition query,
+        since the partition key of a library is the first character of its name.
+        """
         try:
             sql = self.lookup_by_name_sql(name)
-            query_results = self.ctrproxy.query_items(query=sql)
-            async for item in query_results:
-                return item
+            pk = self.partition_key_for_name(name)
+            results = await self.nosql_svc.query_partition(sql, pk, max_items=1)
+            if len(results) > 0:
+                return results[0]
         except Exception as e:
             logging.info(str(e))
             logging.info(traceback.format_exc())
@@ -71,6 +78,9 @@ class DependencyGraph:
     def lookup_by_name_sql(self, name):
         return "select * from c where c.name = '{}' offset 0 limit 1".format(name)
 
+    def partition_key_for_name(self, name):
+        return name[0:1]
+
     async def traverse_at_depth(self, collected_libs, depth):
         # get the list of libraries at the previous depth, then execute
         # a a single query with an 'in' cause to fetch them.
@@ -90,6 +100,9 @@ class DependencyGraph:
                             libs_to_get[dep_id_pk] = dep_id_pk
         libs_to_get_keys = sorted(libs_to_get.keys())
         if len(libs_to_get_keys) > 0:
+            # read the whole frontier at this depth with one read_many call,
+            # rather than awaiting a point-read for each library in turn
+            id_pk_tuples = list()
             for key in libs_to_get_keys:
                 id, pk = key.split("|")
                 do_point_read = True
@@ -97,7 +110,12 @@ class DependencyGraph:
                     if id not in self.known_libs:
                         do_point_read = False
                 if do_point_read == True:
-                    doc = await self.nosql_svc.point_read(id, pk)
-                    if doc is not None:
+                    id_pk_tuples.append((id, pk))
+            if len(id_pk_tuples) > 0:
+                read_results = await self.nosql_svc.read_many(id_pk_tuples)
+                self.request_units = self.request_units + read_results["ru"]
+                for id_pk in id_pk_tuples:
+                    if id_pk in read_results["docs"]:
+                        doc = read_results["docs"][id_pk]
                         doc["__traversal_depth"] = depth
                         collected_libs[doc["id"]] = doc
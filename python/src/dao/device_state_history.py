@@ -0,0 +1,191 @@
+# This class implements the historical "state of device at time T" queries
+# of the DeviceState container.  Each DeviceState document is the state of
+# its device from its evt_time until its 'until' time (-1 while current),
+# and by default the container is partitioned by did, so the state of a
+# device at a given time is a single-partition query with range predicates.
+# For bulk queries over many devices, see class DeviceStateIntervalIndex.
+#
+# With a synthetic PartitionKeyStrategy, such as did plus a day bucket, the
+# states of a device are in several logical partitions; the queries are
+# routed to the keys that the strategy returns, fanned out concurrently,
+# and the results are merged in evt_time order.
+
+import asyncio
+import json
+import logging
+import traceback
+
+from src.models.partition_key_strategy import PartitionKeyStrategy
+from src.services.cosmos_nosql_service import CosmosNoSQLService
+
+
+class DeviceStateHistory:
+
+    def __init__(
+        self,
+        nosql_svc: CosmosNoSQLService,
+        strategy: PartitionKeyStrategy = None,
+        max_concurrency: int = 16,
+    ):
+        """
+        The given nosql_svc has been previously created, initialized,
+        and is pointing to the DeviceState container.  The strategy is
+        that of the container's partition keys, by default the did; at most
+        max_concurrency queries of a fan-out are in flight at once.
+        """
+        self.nosql_svc = nosql_svc
+        self.strategy = PartitionKeyStrategy() if strategy is None else strategy
+        self.max_concurrency = max_concurrency
+        self.request_units = 0.0
+        self.query_count = 0
+
+    async def state_as_of(self, did: str, t: float) -> dict | None:
+        """
+        Return the DeviceState document of the given device at time t, or
+        None if it had no state then.  The latest document with an evt_time
+        at or before t is selected, so a lagging 'until' patch is harmless.
+        """
+        parameters = [{"name": "@did", "value": did}, {"name": "@t", "value": t}]
+        results = await self.query_newest_first(
+            self.state_as_of_sql(), self.strategy.keys_before(did, t), 1, parameters)
+        if len(results) > 0:
+            return results[0]
+        return None
+
+    async def recent_states(self, did: str, t: float, sql: str, count: int = 2) -> list:
+        """
+        Return up to count of the most recent DeviceStates of the given device
+        at or before time t, with the given single-partition query sql.
+        This is on the ingest path, so with time buckets the walk stops after
+        the strategy's max_empty_buckets consecutive empty buckets; a device
+        with no history then costs 1 + max_empty_buckets queries rather than
+        max_lookback_buckets, and a state older than that gap isn't found.
+        """
+        max_empty_keys = None
+        if self.strategy.is_time_bucketed():
+            max_empty_keys = self.strategy.max_empty_buckets
+        return await self.query_newest_first(
+            sql, self.strategy.keys_before(did, t), count, max_empty_keys=max_empty_keys)
+
+    async def query_newest_first(
+        self, sql: str, keys: list, count: int, parameters: list = None, max_empty_keys: int = None
+    ) -> list:
+        """
+        Query the given partition keys, most recent bucket first, in windows
+        of concurrent queries until count results are found; return the count
+        most recent results.  The windows double from one key up to
+        max_concurrency keys, as the latest bucket usually has the results.
+        With a hash strategy all of the keys are in the first window.
+        If max_empty_keys is given, the walk also stops once that many
+        consecutive keys have had no results.
+        """
+        results = list()
+        window = 1
+        if self.strategy.name == "did_hash":
+            window = len(keys)
+        idx, empty_keys = 0, 0
+        while idx < len(keys):
+            if max_empty_keys is not None:
+                window = max(1, min(window, max_empty_keys - empty_keys))
+            window_results = await self.query_keys(sql, keys[idx : idx + window], parameters, count)
+            results.extend(window_results)
+            if len(results) >= count:
+                break
+            idx = idx + window
+            empty_keys = 0 if len(window_results) > 0 else empty_keys + window
+            if max_empty_keys is not None and empty_keys >= max_empty_keys:
+                break
+            window = min(window * 2, self.max_concurrency)
+        results = sorted(results, key=lambda doc: doc.get("evt_time", 0), reverse=True)
+        return results[0:count]
+
+    async def query_keys(
+        self, sql: str, keys: list, parameters: list = None, max_items: int = 100, descending: bool = True
+    ) -> list:
+        """
+        Execute the given query in each of the given partition keys
+        concurrently, and return the merged results in evt_time order.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        pages = list()
+
+        async def query_key(pk):
+            async with semaphore:
+                results = await self.nosql_svc.query_partition(sql, pk, parameters, max_items=max_items)
+                self.add_request_charge()
+                pages.append(results)
+
+        await asyncio.gather(*[query_key(pk) for pk in keys])
+        merged = list()
+        for results in pages:
+            merged.extend(results)
+        return sorted(merged, key=lambda doc: doc.get("evt_time", 0), reverse=descending)
+
+    async def states_as_of(self, dids: list, t: float, max_concurrency: int = 16) -> dict:
+        """
+        Return a dict of did -> DeviceState document at time t (or None) for
+        the given dids, with at most max_concurrency queries in flight.
+        """
+        results = dict()
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def query_device(did):
+            async with semaphore:
+                try:
+                    results[did] = await self.state_as_of(did, t)
+                except Exception as e:
+                    logging.info(str(e))
+                    logging.info(traceback.format_exc())
+                    results[did] = None
+
+        await asyncio.gather(*[query_device(did) for did in dids])
+        return results
+
+    async def history(self, did: str, start: float, end: float, max_items: int = 100) -> list:
+        """Return the DeviceState documents of the given device that overlap [start, end), by evt_time."""
+        parameters = [
+            {"name": "@did", "value": did},
+            {"name": "@start", "value": start},
+            {"name": "@end", "value": end},
+        ]
+        keys = self.strategy.keys_for_range(did, start, end)
+        return await self.query_keys(self.history_sql(), keys, parameters, max_items, descending=False)
+
+    async def export(self, outfile: str, fields: list = None) -> int:
+        """
+        Write the id, did, evt_time, until, and the given fields of every
+        DeviceState document to the given NDJSON file, one page at a time,
+        for DeviceStateIntervalIndex#add_file; return the document count.
+        """
+        count = 0
+        with open(outfile, "wt", encoding="utf-8") as f:
+            async for doc in self.nosql_svc.query_iter(self.export_sql(fields), page_size=1000):
+                f.write(json.dumps(doc))
+                f.write("\n")
+                count = count + 1
+        return count
+
+    def add_request_charge(self) -> None:
+        self.query_count = self.query_count + 1
+        self.request_units = self.request_units + self.nosql_svc.last_request_charge()
+
+    def state_as_of_sql(self) -> str:
+        parts = list()
+        parts.append("select * from c where c.did = @did and c.dt = 'ds'")
+        parts.append("and c.evt_time <= @t and (c.until = -1 or c.until > @t)")
+        parts.append("order by c.evt_time desc offset 0 limit 1")
+        return " ".join(parts).strip()
+
+    def history_sql(self) -> str:
+        parts = list()
+        parts.append("select * from c where c.did = @did and c.dt = 'ds'")
+        parts.append("and c.evt_time < @end and (c.until = -1 or c.until > @start)")
+        parts.append("order by c.evt_time asc")
+        return " ".join(parts).strip()
+
+    def export_sql(self, fields: list = None) -> str:
+        attrs = ["id", "did", "evt_time", "until"]
+        if fields is not None:
+            attrs.extend(fields)
+        projection = ", ".join(["c.{}".format(attr) for attr in attrs])
+        return "select {} from c where c.dt = 'ds'".format(projection)
@@ -1,12 +1,14 @@
 
 import logging
+import os
 import random
 import time
 import uuid
 
 from faker import Faker
 
-from src.util.fs import FS
+from src.services.config_service import ConfigService
+from src.util.string_pool_file import StringPoolFile
 
 fake = Faker()
 
@@ -20,134 +22,145 @@ class DeviceData:
 
     @classmethod
     def random_device_state(cls) -> dict:
+        """
+        Return a new DeviceState event, a copy of the in-memory state of a
+        random device with a new id and evt_time.  About 5% of the calls first
+        change one attribute of the device's state, which then persists in
+        its later events.  See class DeviceEventGenerator for high-rate,
+        skewed event generation.
+        """
         idx = random.randint(0, len(DeviceData.deviceStatesKeys) - 1)
         key = DeviceData.deviceStatesKeys[idx]
-        print("DeviceData#random_device_state, idx/key: {}".format(idx,key))
-        ds = DeviceData.deviceStates[key]
-        ds['id'] = str(uuid.uuid4())
-        ds['evt_time'] = int(time.time())
+        state = DeviceData.deviceStates[key]
 
         # randomly simulate changes to the DeviceState
         change = random.randint(0, 100)
         if change < 5:
-            print("DeviceData#random_device_state, idx/key/change: {}".format(idx,key,change))
             what_changed = random.randint(0, 5)
             # Strong: serialNum, computerID, hostname 
             # Weak: osName, ipAddress, macAddress, buildId
             if what_changed == 0:
-                ds['ser'] = cls.random_serial_number()
+                state['ser'] = cls.random_serial_number()
             elif what_changed == 1:
-                ds['cid'] = cls.random_computer_id()
+                state['cid'] = cls.random_computer_id()
             elif what_changed == 2:
-                ds['host'] = cls.random_hostname()
+                state['host'] = cls.random_hostname()
             elif what_changed == 3:
-                ds['ip'] = cls.random_ip_address()
+                state['ip'] = cls.random_ip_address()
             elif what_changed == 4:
-                ds['mac'] = cls.random_mac_address()
+                state['mac'] = cls.random_mac_address()
             elif what_changed == 5:
-                ds['build'] = random.randint(1000, 1_000_000)
-            # update the DeviceState in memory as it may be emitted multiple times
-            DeviceData.deviceStates[idx] = ds
+                state['build'] = random.randint(1000, 1_000_000)
+
+        ds = dict(state)
+        ds['id'] = str(uuid.uuid4())
+        ds['evt_time'] = int(time.time())
         return ds
 
     @classmethod
     def simulated_etag(cls):
         return str(fake.hexify(text='^^^^^^^^^^^^'))
 
+    # the value pools are generated deterministically from a seed, and cached
+    # in a memory-mapped StringPoolFile that is reused while the seed, sizes,
+    # and format version match; see methods initialize and rebuild
+    pool_format_version = 1
+    pools = None
+    pool_path = None
+    pool_sizes = {
+        "deviceIDs": 100_000,
+        "serialNumbers": 100_000,
+        "computerIDs": 100_000,
+        "hostNames": 100_000,
+        "producerIDs": 1_000,
+        "ipAddresses": 100_000,
+        "macAddresses": 100_000,
+    }
+
     @classmethod
-    def initialize(cls) -> None:
-        # Strong: deviceID, serialNum, computerID, hostname 
-        # Weak: osName, ipAddress, macAddress, phoneNum, emailAddr, appUser, buildId
+    def default_seed(cls) -> int:
+        return int(ConfigService.envvar("DEVICE_DATA_SEED", "42"))
 
-        # deviceIDs
-        values = dict()
-        for i in range(100_000):
-            #value = str(uuid.uuid4())
-            value = str(fake.hexify(text='^^^^^^^^^^^^'))
-            values[value] = 0
-        DeviceData.deviceIDs = sorted(values.keys())
-        FS.write_json(DeviceData.deviceIDs, "tmp/deviceIDs.json")
-
-        # serialNumbers
-        values = dict()
-        for i in range(100_000):
-            value = str(i + 1)
-            values[value] = 0
-        DeviceData.serialNumbers = sorted(values.keys())
-        FS.write_json(DeviceData.serialNumbers, "tmp/serialNumbers.json")
-
-        # computerIDs
-        values = dict()
-        for i in range(100_000):
-            value = str(random.randint(0, 1_000_000))
-            values[value] = 0
-        DeviceData.computerIDs = sorted(values.keys())
-        FS.write_json(DeviceData.computerIDs, "tmp/computerIDs.json")
-
-        # hostNames
-        values = dict()
-        for i in range(100_000):
-            value = fake.hostname(0)
-            values[value] = 0
-        DeviceData.hostNames = sorted(values.keys())
-        FS.write_json(DeviceData.hostNames, "tmp/hostNames.json")
-
-        # producerIDs
-        values = dict()
-        for i in range(1_000):
-            value = str(fake.company()).lower()
-            values[value] = 0
-        DeviceData.producerIDs = sorted(values.keys())
-        FS.write_json(DeviceData.producerIDs, "tmp/producerIDs.json")
-
-        # ipAddresses
-        values = dict()
-        for i in range(100_000):
-            part1 = random.randint(0, 255) + 1
-            part2 = random.randint(0, 255) + 1
-            part3 = random.randint(0, 255) + 1
-            part4 = random.randint(0, 255) + 1
-            ip = "{}.{}.{}.{}".format(part1, part2, part3, part4)
-            values[ip] = 0
-        DeviceData.ipAddresses = sorted(values.keys())
-        FS.write_json(DeviceData.ipAddresses, "tmp/ipAddresses.json")
-
-        # macAddresses
-        values = dict()
-        for i in range(100000):
-            #  It's a 12-digit hexadecimal number that's usually found on a device's network interface card (NIC). 
-            value = str(fake.hexify(text='^^:^^:^^:^^:^^:^^'))
-            values[value] = 0
-        DeviceData.macAddresses = sorted(values.keys())
-        FS.write_json(DeviceData.macAddresses, "tmp/macAddresses.json")
-
-        # create the in-memory deviceStates
-        # the random_device_state() method will add the 'id' and 'epoch' attributes
+    @classmethod
+    def initialize(cls, seed: int = None) -> None:
+        """
+        Load the value pools for the given seed (default DEVICE_DATA_SEED or 42)
+        from the cache file, generating and caching them first if necessary.
+        The DeviceState of each device is created when it's first accessed.
+        """
+        seed = cls.default_seed() if seed is None else seed
+        path = cls.pool_file_path(seed)
+        metadata, pools = StringPoolFile.read(path)
+        if metadata != cls.pool_metadata(seed):
+            # unmap the stale file first, as Windows can't replace a mapped file
+            StringPoolFile.close(pools)
+            cls.rebuild(seed)
+            metadata, pools = StringPoolFile.read(path)
+        DeviceData.pools = pools
+        DeviceData.pool_path = path
+        DeviceData.seed = seed
+        DeviceData.deviceIDs = pools["deviceIDs"]
+        DeviceData.serialNumbers = pools["serialNumbers"]
+        DeviceData.computerIDs = pools["computerIDs"]
+        DeviceData.hostNames = pools["hostNames"]
+        DeviceData.producerIDs = pools["producerIDs"]
+        DeviceData.ipAddresses = pools["ipAddresses"]
+        DeviceData.macAddresses = pools["macAddresses"]
+        # the random_device_state() method will add the 'id' and 'evt_time' attributes
         # as well as randomly change various attribute values
-        DeviceData.deviceStates = dict()
-        for did in DeviceData.deviceIDs:
-            producerID = cls.random_producer_id()
-            ser = cls.random_serial_number()
-            cid = cls.random_computer_id()
-            host = cls.random_hostname()
-            mac = cls.random_mac_address()
-            build = random.randint(1000, 1_000_000)
-            evt_time = int(time.time()) - 5  # 5-seconds from device emitting to current time
-            doc = {
-                "did": did,
-                "pid": producerID,
-                "extId": str(uuid.uuid4()),
-                "ser": ser,
-                "cid": cid,
-                "host": host,
-                "mac": mac,
-                "build": build,
-                "evt_time": evt_time,
-                "until": -1,
-                "dt": "ds"
-            }
-            DeviceData.deviceStates[did] = doc
-        DeviceData.deviceStatesKeys = sorted(DeviceData.deviceStates.keys())
+        DeviceData.deviceStates = _DeviceStates(seed)
+        DeviceData.deviceStatesKeys = DeviceData.deviceIDs  # sorted
+
+    @classmethod
+    def rebuild(cls, seed: int = None) -> str:
+        """
+        Generate the value pools for the given seed, write the cache file, and
+        return its path.  If the loaded pools are mapped from that file they
+        are closed, so call method initialize again before generating events.
+        """
+        seed = cls.default_seed() if seed is None else seed
+        # Strong: deviceID, serialNum, computerID, hostname
+        # Weak: osName, ipAddress, macAddress, phoneNum, emailAddr, appUser, buildId
+        rng = random.Random(seed)
+        seeded_fake = Faker()
+        seeded_fake.seed_instance(seed)
+        sizes = cls.pool_sizes
+        pools = dict()
+        pools["deviceIDs"] = [
+            str(seeded_fake.hexify(text='^^^^^^^^^^^^')) for i in range(sizes["deviceIDs"])]
+        pools["serialNumbers"] = [str(i + 1) for i in range(sizes["serialNumbers"])]
+        pools["computerIDs"] = [
+            str(rng.randint(0, 1_000_000)) for i in range(sizes["computerIDs"])]
+        pools["hostNames"] = [seeded_fake.hostname(0) for i in range(sizes["hostNames"])]
+        pools["producerIDs"] = [
+            str(seeded_fake.company()).lower() for i in range(sizes["producerIDs"])]
+        pools["ipAddresses"] = [
+            "{}.{}.{}.{}".format(
+                rng.randint(1, 256), rng.randint(1, 256), rng.randint(1, 256), rng.randint(1, 256))
+            for i in range(sizes["ipAddresses"])]
+        #  It's a 12-digit hexadecimal number that's usually found on a device's network interface card (NIC).
+        pools["macAddresses"] = [
+            str(seeded_fake.hexify(text='^^:^^:^^:^^:^^:^^')) for i in range(sizes["macAddresses"])]
+        for name in pools.keys():
+            pools[name] = sorted(set(pools[name]))  # unique and sorted values
+
+        path = cls.pool_file_path(seed)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if DeviceData.pool_path == path:
+            StringPoolFile.close(DeviceData.pools)
+            DeviceData.pools, DeviceData.pool_path, DeviceData.seed = None, None, None
+        StringPoolFile.write(path, cls.pool_metadata(seed), pools)
+        logging.info("DeviceData#rebuild, seed: {} file: {}".format(seed, path))
+        return path
+
+    @classmethod
+    def pool_metadata(cls, seed: int) -> dict:
+        return {"seed": seed, "sizes": cls.pool_sizes, "version": cls.pool_format_version}
+
+    @classmethod
+    def pool_file_path(cls, seed: int) -> str:
+        cache_dir = ConfigService.envvar("DEVICE_DATA_CACHE_DIR", "tmp/cache")
+        return os.path.join(cache_dir, "device_data_pools_{}.bin".format(seed))
 
     # private/random methods below
 
@@ -178,11 +191,41 @@ class DeviceData:
     
     @classmethod
     def random_ip_address(cls) -> dict:
-        idx = random.randint(0, len(DeviceData.deviceIDs) - 1)
-        return DeviceData.deviceIDs[idx]
+        idx = random.randint(0, len(DeviceData.ipAddresses) - 1)
+        return DeviceData.ipAddresses[idx]
     
     @classmethod
     def random_mac_address(cls) -> dict:
-        idx = random.randint(0, len(DeviceData.deviceIDs) - 1)
-        return DeviceData.deviceIDs[idx]
-    
\ No newline at end of file
+        idx = random.randint(0, len(DeviceData.macAddresses) - 1)
+        return DeviceData.macAddresses[idx]
+    
+
+
+class _DeviceStates(dict):
+    """
+    The in-memory DeviceState per did, each created on first access from
+    the value pools with a per-device seeded random, so they're deterministic
+    for a given seed without building all of them at startup.
+    """
+
+    def __init__(self, seed: int):
+        super().__init__()
+        self.seed = seed
+
+    def __missing__(self, did):
+        rng = random.Random("{}-{}".format(self.seed, did))
+        doc = {
+            "did": did,
+            "pid": DeviceData.producerIDs[rng.randrange(len(DeviceData.producerIDs))],
+            "extId": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            "ser": DeviceData.serialNumbers[rng.randrange(len(DeviceData.serialNumbers))],
+            "cid": DeviceData.computerIDs[rng.randrange(len(DeviceData.computerIDs))],
+            "host": DeviceData.hostNames[rng.randrange(len(DeviceData.hostNames))],
+            "mac": DeviceData.macAddresses[rng.randrange(len(DeviceData.macAddresses))],
+            "build": rng.randint(1000, 1_000_000),
+            "evt_time": int(time.time()) - 5,  # 5-seconds from device emitting to current time
+            "until": -1,
+            "dt": "ds"
+        }
+        self[did] = doc
+        return doc
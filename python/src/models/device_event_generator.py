@@ -0,0 +1,322 @@
+import random
+import time
+import uuid
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from src.models.device_data import DeviceData
+
+# Instances of this class generate high-rate synthetic DeviceState events
+# for offline pipeline benchmarks.  Events are generated in columnar
+# batches: the device of each event is drawn with a uniform, Zipf, or
+# hot-set skew, and each attribute of the device changes with its own
+# probability.  The generated values are indexes into the DeviceData value
+# pools, and are only materialized as dicts when requested.
+#
+# NumPy is used when it's installed, otherwise a pure-Python implementation
+# of the same model; the events are reproducible for a given seed and
+# implementation, but the two implementations generate different events.
+
+
+class DeviceEventBatch:
+    """
+    A batch of generated events as parallel columns; 'device' (the device
+    index), 'evt_time', 'changes' (a bit-mask over DeviceEventGenerator.attrs),
+    and one column per attribute with its value (pool index) in the event.
+    """
+
+    def __init__(self, generator, start_seq: int, columns: dict):
+        self.generator = generator
+        self.start_seq = start_seq
+        self.columns = columns
+        self.count = len(columns["device"])
+
+    def __len__(self) -> int:
+        return self.count
+
+    def column(self, name: str) -> list:
+        """Return the named column as a list."""
+        values = self.columns[name]
+        if isinstance(values, list):
+            return values
+        return values.tolist()
+
+    def change_count(self) -> int:
+        """Return the number of events with at least one changed attribute."""
+        return sum([1 for mask in self.column("changes") if mask != 0])
+
+    def to_dicts(self) -> list:
+        """Return the events as DeviceState dicts, like DeviceData.random_device_state."""
+        g = self.generator
+        devices, evt_times = self.column("device"), self.column("evt_time")
+        sers, cids, hosts = self.column("ser"), self.column("cid"), self.column("host")
+        ips, macs, builds = self.column("ip"), self.column("mac"), self.column("build")
+        pids = g.device_pids
+        dids, producer_ids = g.pool_list("deviceIDs"), g.pool_list("producerIDs")
+        ser_pool, cid_pool = g.pool_list("serialNumbers"), g.pool_list("computerIDs")
+        host_pool, ip_pool = g.pool_list("hostNames"), g.pool_list("ipAddresses")
+        mac_pool = g.pool_list("macAddresses")
+        events = list()
+        for i in range(self.count):
+            d = devices[i]
+            events.append({
+                "id": g.event_id(self.start_seq + i),
+                "did": dids[d],
+                "pid": producer_ids[pids[d]],
+                "extId": g.ext_id(d),
+                "ser": ser_pool[sers[i]],
+                "cid": cid_pool[cids[i]],
+                "host": host_pool[hosts[i]],
+                "ip": ip_pool[ips[i]],
+                "mac": mac_pool[macs[i]],
+                "build": builds[i],
+                "evt_time": evt_times[i],
+                "until": -1,
+                "dt": "ds"
+            })
+        return events
+
+
+class DeviceEventGenerator:
+
+    # the generated attributes; attribute i is bit (1 << i) in the change masks
+    attrs = "ser,cid,host,ip,mac,build".split(",")
+
+    # attribute name -> DeviceData value pool; 'build' is a random int instead
+    attr_pools = {
+        "ser": "serialNumbers",
+        "cid": "computerIDs",
+        "host": "hostNames",
+        "ip": "ipAddresses",
+        "mac": "macAddresses",
+    }
+    build_range = (1000, 1_000_000)
+
+    # the default probability that an event changes each strong or weak attribute
+    strong_change_prob = 0.005
+    weak_change_prob = 0.01
+
+    def __init__(
+        self,
+        seed: int = None,
+        device_count: int = None,
+        skew: str = "zipf",
+        zipf_s: float = 1.1,
+        hot_fraction: float = 0.01,
+        hot_weight: float = 0.9,
+        change_probs: dict = None,
+        start_time: int = None,
+        events_per_second: int = 1000,
+        use_numpy: bool = None,
+    ):
+        """
+        The skew is 'uniform', 'zipf' (device rank r has weight 1 / r ** zipf_s),
+        or 'hotset' (hot_fraction of the devices get hot_weight of the events).
+        The change_probs dict overrides the per-attribute change probabilities.
+        The evt_time of the events advances from start_time at events_per_second.
+        """
+        self.seed = DeviceData.default_seed() if seed is None else seed
+        if getattr(DeviceData, "seed", None) != self.seed:
+            DeviceData.initialize(self.seed)
+        self.use_numpy = (np is not None) if use_numpy is None else use_numpy
+        if self.use_numpy and np is None:
+            raise ValueError("numpy is not installed")
+        pool_count = len(DeviceData.deviceIDs)
+        self.device_count = pool_count if device_count is None else min(device_count, pool_count)
+        self.skew = skew
+        self.change_probs = dict()
+        for attr in DeviceEventGenerator.attrs:
+            if attr in DeviceData.strong_attrs:
+                self.change_probs[attr] = DeviceEventGenerator.strong_change_prob
+            else:
+                self.change_probs[attr] = DeviceEventGenerator.weak_change_prob
+        if change_probs is not None:
+            for attr, prob in change_probs.items():
+                if attr not in self.change_probs:
+                    raise ValueError("unknown attribute: {}".format(attr))
+                self.change_probs[attr] = prob
+        self.start_time = int(time.time()) if start_time is None else start_time
+        self.events_per_second = max(1, events_per_second)
+        self.sequence = 0
+        self.pool_lists = dict()  # pool name -> decoded list of its values
+        self.ext_ids = dict()  # device index -> extId
+
+        # per-generator random streams for the event ids and device extIds
+        id_rng = random.Random("{}-ids".format(self.seed))
+        self.id_base = id_rng.getrandbits(128)
+        self.ext_id_base = id_rng.getrandbits(128)
+
+        cdf = self.device_cdf(zipf_s, hot_fraction, hot_weight)
+        if self.use_numpy:
+            self.rng = np.random.default_rng(self.seed)
+            self.cdf = np.array(cdf)
+            self.device_pids = self.rng.integers(
+                0, len(DeviceData.producerIDs), self.device_count).tolist()
+            self.state = dict()
+            for attr in DeviceEventGenerator.attrs:
+                self.state[attr] = self.random_values(attr, self.device_count)
+        else:
+            self.rng = random.Random(self.seed)
+            self.cdf = cdf
+            self.device_range = range(self.device_count)
+            self.device_pids = self.random_values("pid", self.device_count)
+            self.state = dict()
+            for attr in DeviceEventGenerator.attrs:
+                self.state[attr] = self.random_values(attr, self.device_count)
+
+    def device_cdf(self, zipf_s: float, hot_fraction: float, hot_weight: float) -> list:
+        """
+        Return the cumulative distribution over the device indexes for the skew.
+        The device ranks are a seeded permutation, so the hottest devices are
+        spread over the sorted device ids.
+        """
+        count = self.device_count
+        ranks = list(range(count))
+        random.Random("{}-ranks".format(self.seed)).shuffle(ranks)
+        if self.skew == "uniform":
+            weights = [1.0] * count
+        elif self.skew == "zipf":
+            weights = [1.0 / ((rank + 1) ** zipf_s) for rank in ranks]
+        elif self.skew == "hotset":
+            hot_count = max(1, int(count * hot_fraction))
+            cold_count = count - hot_count
+            hot, cold = hot_weight / hot_count, 0.0
+            if cold_count > 0:
+                cold = (1.0 - hot_weight) / cold_count
+            weights = [hot if rank < hot_count else cold for rank in ranks]
+        else:
+            raise ValueError("unknown skew: {}".format(self.skew))
+        cdf, total = list(), 0.0
+        for weight in weights:
+            total = total + weight
+            cdf.append(total)
+        return [value / total for value in cdf]
+
+    def random_values(self, attr: str, n: int):
+        """Return n random values of the given attribute; pool indexes, or builds."""
+        if attr == "build":
+            low, high = DeviceEventGenerator.build_range
+        elif attr == "pid":
+            low, high = 0, len(DeviceData.producerIDs) - 1
+        else:
+            low, high = 0, len(getattr(DeviceData, DeviceEventGenerator.attr_pools[attr])) - 1
+        if self.use_numpy:
+            return self.rng.integers(low, high + 1, n)
+        randint = self.rng.randint
+        return [randint(low, high) for i in range(n)]
+
+    def batches(self, event_count: int, batch_size: int = 100_000):
+        """Yield DeviceEventBatch objects with a total of event_count events."""
+        remaining = event_count
+        while remaining > 0:
+            n = min(batch_size, remaining)
+            remaining = remaining - n
+            yield self.next_batch(n)
+
+    def events(self, event_count: int, batch_size: int = 10_000):
+        """Yield event_count DeviceState dicts."""
+        for batch in self.batches(event_count, batch_size):
+            for event in batch.to_dicts():
+                yield event
+
+    def next_batch(self, n: int) -> DeviceEventBatch:
+        start_seq = self.sequence
+        self.sequence = self.sequence + n
+        if self.use_numpy:
+            columns = self.numpy_batch(start_seq, n)
+        else:
+            columns = self.python_batch(start_seq, n)
+        return DeviceEventBatch(self, start_seq, columns)
+
+    def numpy_batch(self, start_seq: int, n: int) -> dict:
+        """
+        Generate the columns of a batch with array operations.  The events of
+        a device are grouped with a stable sort, and within each group an
+        attribute's value is carried forward from its last change, so the
+        events of a device are consistent with its sequence of changes.
+        """
+        devices = np.searchsorted(self.cdf, self.rng.random(n), side="right")
+        np.minimum(devices, self.device_count - 1, out=devices)
+        seqs = np.arange(start_seq, start_seq + n)
+        columns = dict()
+        columns["device"] = devices
+        columns["evt_time"] = self.start_time + (seqs // self.events_per_second)
+        changes = np.zeros(n, dtype=np.int64)
+        order, sorted_devices, group_starts, group_ends = None, None, None, None
+        positions = np.arange(n)
+        for bit, attr in enumerate(DeviceEventGenerator.attrs):
+            state = self.state[attr]
+            prob = self.change_probs[attr]
+            changed = None
+            if prob > 0:
+                changed = self.rng.random(n) < prob
+            if changed is None or not changed.any():
+                columns[attr] = state[devices]
+                continue
+            changes[changed] |= 1 << bit
+            if order is None:
+                order = np.argsort(devices, kind="stable")
+                sorted_devices = devices[order]
+                group_starts = np.ones(n, dtype=bool)
+                group_starts[1:] = sorted_devices[1:] != sorted_devices[:-1]
+                group_ends = np.ones(n, dtype=bool)
+                group_ends[:-1] = group_starts[1:]
+            sorted_changed = changed[order]
+            values = state[sorted_devices]
+            values[sorted_changed] = self.random_values(attr, int(sorted_changed.sum()))
+            # the index of the last change, or the group start, of each event
+            last = np.where(sorted_changed | group_starts, positions, 0)
+            np.maximum.accumulate(last, out=last)
+            filled = values[last]
+            state[sorted_devices[group_ends]] = filled[group_ends]
+            column = np.empty_like(filled)
+            column[order] = filled
+            columns[attr] = column
+        columns["changes"] = changes
+        return columns
+
+    def python_batch(self, start_seq: int, n: int) -> dict:
+        rng = self.rng
+        devices = rng.choices(self.device_range, cum_weights=self.cdf, k=n)
+        eps = self.events_per_second
+        columns = dict()
+        columns["device"] = devices
+        columns["evt_time"] = [self.start_time + ((start_seq + i) // eps) for i in range(n)]
+        changes = [0] * n
+        for bit, attr in enumerate(DeviceEventGenerator.attrs):
+            state = self.state[attr]
+            prob = self.change_probs[attr]
+            if prob <= 0:
+                columns[attr] = [state[d] for d in devices]
+                continue
+            column = list()
+            for i, d in enumerate(devices):
+                if rng.random() < prob:
+                    state[d] = self.random_values(attr, 1)[0]
+                    changes[i] = changes[i] | (1 << bit)
+                column.append(state[d])
+            columns[attr] = column
+        columns["changes"] = changes
+        return columns
+
+    def event_id(self, seq: int) -> str:
+        """Return the deterministic, unique id of the event with the given sequence."""
+        return str(uuid.UUID(int=(self.id_base + seq) % (1 << 128), version=4))
+
+    def ext_id(self, device: int) -> str:
+        if device not in self.ext_ids:
+            self.ext_ids[device] = str(
+                uuid.UUID(int=(self.ext_id_base + device) % (1 << 128), version=4))
+        return self.ext_ids[device]
+
+    def pool_list(self, name: str) -> list:
+        """
+        Return the values of the named DeviceData pool as a list, decoded
+        once on first use, as materializing events reads them repeatedly.
+        """
+        if name not in self.pool_lists:
+            self.pool_lists[name] = list(getattr(DeviceData, name))
+        return self.pool_lists[name]
@@ -0,0 +1,314 @@
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from src.models.device_data import DeviceData
+from src.util.counter import Counter
+
+# Instances of this class resolve which devices are the same physical device,
+# or are otherwise related, by the identifying attributes that they share.
+#
+# An inverted index from each attribute value to the devices that have had
+# it is maintained for the strong (ser, cid, host) and weak (ip, mac, build)
+# attributes, and the devices that share a strong attribute value are
+# merged into one cluster by a union-find.  The clusters are updated
+# incrementally as events are observed, and can be computed in bulk from
+# exported columns; with NumPy by label propagation over the value groups.
+#
+# The dids and attribute values are interned as ints, and all of the
+# per-device and per-value state is in flat int arrays, so the memory per
+# device is a few dozen bytes plus its interned did.  Clusters only grow;
+# a strong value that moves to another device links the two devices, and
+# a bulk recomputation over the current values starts new clusters.
+
+
+class DeviceIdentityResolver:
+
+    def __init__(self, strong_attrs: list = None, weak_attrs: list = None, use_numpy: bool = None):
+        self.strong_attrs = DeviceData.strong_attrs if strong_attrs is None else strong_attrs
+        self.weak_attrs = DeviceData.weak_attrs if weak_attrs is None else weak_attrs
+        self.attrs = self.strong_attrs + self.weak_attrs
+        self.use_numpy = (np is not None) if use_numpy is None else use_numpy
+        if self.use_numpy and np is None:
+            raise ValueError("numpy is not installed")
+        self.device_codes = dict()  # did -> device int
+        self.device_names = list()  # device int -> did
+        self.parent = array("i")  # the union-find forest
+        self.size = array("i")  # cluster size, at the roots
+        self.next_member = array("i")  # a circular list of the members of each cluster
+        self.current = dict()  # attr -> array of the current value int of each device, or -1
+        self.value_codes = dict()  # attr -> dict of value -> value int
+        self.value_names = dict()  # attr -> list of the values
+        self.value_heads = dict()  # attr -> array of the last posting of each value, or -1
+        for attr in self.attrs:
+            self.current[attr] = array("i")
+            self.value_codes[attr] = dict()
+            self.value_names[attr] = list()
+            self.value_heads[attr] = array("i")
+        # the postings of all values; linked lists of (device, next posting)
+        self.posting_devices = array("i")
+        self.posting_next = array("i")
+        self.counter = Counter()
+
+    def intern_device(self, did: str) -> int:
+        code = self.device_codes.get(did, None)
+        if code is None:
+            code = len(self.device_names)
+            self.device_codes[did] = code
+            self.device_names.append(did)
+            self.parent.append(code)
+            self.size.append(1)
+            self.next_member.append(code)
+            for attr in self.attrs:
+                self.current[attr].append(-1)
+        return code
+
+    def intern_value(self, attr: str, value: str) -> int:
+        codes = self.value_codes[attr]
+        code = codes.get(value, None)
+        if code is None:
+            code = len(codes)
+            codes[value] = code
+            self.value_names[attr].append(value)
+            self.value_heads[attr].append(-1)
+        return code
+
+    def observe(self, doc: dict) -> int:
+        """
+        Index the attribute values of the given DeviceState event, and merge
+        its device's cluster with those that share a strong value with it.
+        Return the number of cluster merges.
+        """
+        device = self.intern_device(doc["did"])
+        self.counter.increment("events")
+        merges = 0
+        for attr in self.attrs:
+            value = doc.get(attr, None)
+            if value is None or value == "":
+                continue
+            if self.observe_value(attr, device, self.intern_value(attr, str(value))):
+                merges = merges + 1
+        return merges
+
+    def observe_value(self, attr: str, device: int, code: int) -> bool:
+        """Index a device's value of an attribute, if it changed; return True if clusters merged."""
+        current = self.current[attr]
+        if current[device] == code:
+            return False
+        current[device] = code
+        heads = self.value_heads[attr]
+        head = heads[code]
+        heads[code] = len(self.posting_devices)
+        self.posting_devices.append(device)
+        self.posting_next.append(head)
+        if head != -1 and attr in self.strong_attrs:
+            return self.union(device, self.posting_devices[head])
+        return False
+
+    def find(self, device: int) -> int:
+        parent = self.parent
+        while parent[device] != device:
+            parent[device] = parent[parent[device]]  # path halving
+            device = parent[device]
+        return device
+
+    def union(self, a: int, b: int) -> bool:
+        ra, rb = self.find(a), self.find(b)
+        if ra == rb:
+            return False
+        if self.size[ra] < self.size[rb]:
+            ra, rb = rb, ra
+        self.parent[rb] = ra
+        self.size[ra] = self.size[ra] + self.size[rb]
+        # splice the two circular member lists into one
+        next_member = self.next_member
+        next_member[ra], next_member[rb] = next_member[rb], next_member[ra]
+        self.counter.increment("merges")
+        return True
+
+    def bulk_resolve(self, columns: dict) -> None:
+        """
+        Index the given columns of exported DeviceStates, the 'did' column and
+        a column per attribute, and compute the clusters in bulk.  The rows of
+        a device are in time order, so its last value is its current value.
+        This resolver must be empty.
+        """
+        if len(self.device_names) > 0:
+            raise ValueError("bulk_resolve requires an empty resolver")
+        if self.use_numpy:
+            self.bulk_resolve_numpy(columns)
+        else:
+            for i, did in enumerate(columns["did"]):
+                device = self.intern_device(did)
+                for attr in self.attrs:
+                    if attr in columns:
+                        value = columns[attr][i]
+                        if value is not None and value != "":
+                            self.observe_value(attr, device, self.intern_value(attr, str(value)))
+            self.counter.increment_by("events", len(columns["did"]))
+
+    def intern_column(self, attr: str, values: list) -> list:
+        """Return the value ints of the given column of an attribute; -1 for missing values."""
+        codes = self.value_codes[attr]
+        setdefault = codes.setdefault
+        result = list()
+        append = result.append
+        for value in values:
+            if value is None or value == "":
+                append(-1)
+            elif value.__class__ is str:
+                append(setdefault(value, len(codes)))
+            else:
+                append(setdefault(str(value), len(codes)))
+        self.value_names[attr] = list(codes.keys())  # in the order of their ints
+        return result
+
+    def bulk_resolve_numpy(self, columns: dict) -> None:
+        device_codes = self.device_codes
+        setdefault = device_codes.setdefault
+        row_devices = [setdefault(did, len(device_codes)) for did in columns["did"]]
+        self.device_names = list(device_codes.keys())
+        n = len(self.device_names)
+        devices = np.array(row_devices, dtype=np.int64)
+        labels = np.arange(n, dtype=np.int64)
+        strong_groups = list()
+        for attr in self.attrs:
+            if attr not in columns:
+                self.current[attr] = array("i", [-1]) * n
+                continue
+            codes = np.array(self.intern_column(attr, columns[attr]), dtype=np.int64)
+            value_count = len(self.value_names[attr])
+            rows = np.nonzero(codes >= 0)[0]
+            codes, attr_devices = codes[rows], devices[rows]
+
+            # the current value of each device is the value of its last row
+            last_rows = np.full(n, -1, dtype=np.int64)
+            np.maximum.at(last_rows, attr_devices, np.arange(len(attr_devices)))
+            current = np.full(n, -1, dtype=np.int64)
+            has_value = last_rows >= 0  # none if the column is all missing
+            current[has_value] = codes[last_rows[has_value]]
+            self.current[attr] = array("i", current.tolist())
+
+            # the unique (value, device) postings, linked per value in device order
+            pairs = np.sort(codes * n + attr_devices)
+            if len(pairs) > 1:
+                pairs = pairs[np.concatenate(([True], pairs[1:] != pairs[:-1]))]
+            pair_codes, pair_devices = pairs // n, pairs % n
+            start = len(self.posting_devices)
+            same = np.zeros(len(pairs), dtype=bool)
+            same[1:] = pair_codes[1:] == pair_codes[:-1]
+            next_posting = np.where(same, np.arange(len(pairs)) - 1 + start, -1)
+            heads = np.full(value_count, -1, dtype=np.int64)
+            heads[pair_codes] = np.arange(len(pairs)) + start  # the last posting of each value
+            self.value_heads[attr] = array("i", heads.tolist())
+            self.posting_devices.extend(array("i", pair_devices.tolist()))
+            self.posting_next.extend(array("i", next_posting.tolist()))
+            if attr in self.strong_attrs:
+                strong_groups.append((pair_codes, pair_devices, value_count))
+
+        # label propagation; each device takes the minimum label of the
+        # devices that share a strong value with it, until none change
+        while True:
+            previous = labels.copy()
+            for codes, group_devices, value_count in strong_groups:
+                minimums = np.full(value_count, n, dtype=np.int64)
+                np.minimum.at(minimums, codes, labels[group_devices])
+                np.minimum.at(labels, group_devices, minimums[codes])
+            labels = labels[labels]
+            if np.array_equal(labels, previous):
+                break
+        while not np.array_equal(labels, labels[labels]):
+            labels = labels[labels]
+
+        # the roots are the minimum devices of the clusters; link the members in device order
+        order = np.argsort(labels, kind="stable")
+        sorted_labels = labels[order]
+        next_member = np.empty(n, dtype=np.int64)
+        if n > 0:
+            last_of_group = np.ones(n, dtype=bool)
+            last_of_group[:-1] = sorted_labels[1:] != sorted_labels[:-1]
+            following = np.empty(n, dtype=np.int64)
+            following[:-1] = order[1:]
+            following[last_of_group] = sorted_labels[last_of_group]  # back to the root
+            next_member[order] = following
+        self.parent = array("i", labels.tolist())
+        self.size = array("i", np.bincount(labels, minlength=n).tolist())
+        self.next_member = array("i", next_member.tolist())
+        self.counter.increment_by("events", len(columns["did"]))
+        self.counter.increment_by("merges", int(n - np.count_nonzero(labels == np.arange(n))))
+
+    def cluster(self, did: str) -> list:
+        """Return the sorted dids of the cluster of the given device."""
+        device = self.device_codes.get(did, None)
+        if device is None:
+            return list()
+        members = [self.device_names[device]]
+        member = self.next_member[device]
+        while member != device:
+            members.append(self.device_names[member])
+            member = self.next_member[member]
+        return sorted(members)
+
+    def largest_clusters(self, count: int = 10) -> list:
+        """Return the dids of the members of the given number of largest clusters."""
+        roots = [device for device in range(len(self.device_names)) if self.parent[device] == device]
+        roots = sorted(roots, key=lambda device: -self.size[device])[0:count]
+        return [self.cluster(self.device_names[root]) for root in roots]
+
+    def cluster_key(self, did: str) -> str:
+        """Return the did of the root of the given device's cluster; it changes as clusters merge."""
+        return self.device_names[self.find(self.device_codes[did])]
+
+    def same_device(self, did1: str, did2: str) -> bool:
+        return self.cluster_key(did1) == self.cluster_key(did2)
+
+    def devices_with(self, attr: str, value) -> list:
+        """Return the sorted dids of the devices that have had the given attribute value."""
+        code = self.value_codes[attr].get(str(value), None)
+        if code is None:
+            return list()
+        devices = dict()
+        posting = self.value_heads[attr][code]
+        while posting != -1:
+            devices[self.device_names[self.posting_devices[posting]]] = 1
+            posting = self.posting_next[posting]
+        return sorted(devices.keys())
+
+    def shared_attributes(self, did: str) -> dict:
+        """Return a dict of other did -> the attributes whose current value it shares with the device."""
+        device = self.device_codes[did]
+        shared = dict()
+        for attr in self.attrs:
+            code = self.current[attr][device]
+            if code == -1:
+                continue
+            for other in self.devices_with(attr, self.value_names[attr][code]):
+                if other != did and self.current[attr][self.device_codes[other]] == code:
+                    if other not in shared:
+                        shared[other] = list()
+                    shared[other].append(attr)
+        return shared
+
+    def get_stats(self) -> dict:
+        cluster_sizes = Counter()
+        largest = 0
+        for device in range(len(self.device_names)):
+            if self.parent[device] == device:
+                cluster_sizes.increment(str(self.size[device]))
+                largest = max(largest, self.size[device])
+        stats = dict()
+        stats["devices"] = len(self.device_names)
+        stats["events"] = self.counter.get_value("events")
+        stats["clusters"] = sum(cluster_sizes.get_data().values())
+        stats["multi_device_clusters"] = stats["clusters"] - cluster_sizes.get_value("1")
+        stats["largest_cluster"] = largest
+        stats["cluster_sizes"] = cluster_sizes.get_data()
+        stats["merges"] = self.counter.get_value("merges")
+        stats["postings"] = len(self.posting_devices)
+        stats["values"] = dict()
+        for attr in self.attrs:
+            stats["values"][attr] = len(self.value_names[attr])
+        return stats
@@ -0,0 +1,127 @@
+from src.models.device_state_changes import DeviceStateChanges
+
+# Instances of this class detect the changes between N (current, incoming)
+# pairs of DeviceState objects at once.  The changes of each pair are an
+# int bit-mask over the attributes of the fixed device schema, kept in a
+# masks list parallel to the input lists, and the minimal patch operations
+# per pair.  This is a batch alternative to the per-object DeviceStateChanges
+# class, which remains for compatibility.
+
+
+class DeviceStateBatchChanges:
+
+    # the fixed device schema; attribute i is bit (1 << i) in the masks
+    schema = "did,pid,extId,ser,cid,host,mac,ip,build,evt_time,until,dt".split(",")
+
+    # attributes that are never compared or patched
+    ignored_attrs = ["id"] + DeviceStateChanges.cosmos_generated_attrs
+
+    def __init__(self, curr_docs: list, ds_docs: list, schema: list = None):
+        """
+        Compare curr_docs[i] with ds_docs[i] for each i; a None or empty
+        current doc means that the incoming doc is new.  Attributes outside
+        the schema are compared per document, as DeviceStateChanges does.
+        """
+        if len(curr_docs) != len(ds_docs):
+            raise ValueError("curr_docs and ds_docs must have the same length")
+        self.schema = DeviceStateBatchChanges.schema if schema is None else schema
+        self.schema_bits = dict()  # attr name -> mask bit
+        self.schema_paths = list()  # (mask bit, attr name, patch path) tuples
+        for bit, attr in enumerate(self.schema):
+            self.schema_bits[attr] = 1 << bit
+            self.schema_paths.append((1 << bit, attr, "/" + attr))
+        self.count = len(ds_docs)
+        self.curr_docs = curr_docs
+        self.ds_docs = ds_docs
+        self.new = [(c is None) or (len(c) == 0) for c in curr_docs]
+        self.masks = [0] * self.count  # bits of the changed, added, or removed attrs
+        self.removed_masks = [0] * self.count  # bits of the removed attrs
+        self.extra_changes = dict()  # index -> (changed attr names, removed attr names)
+        self.compare()
+
+    def compare(self) -> None:
+        """
+        Compare each pair with C-level dict view operations rather than one
+        attribute at a time.  An unchanged pair costs an items() containment
+        test and a keys() difference; a changed pair's attributes come from
+        the difference of its items() views, and are mapped to mask bits.
+        """
+        ignored = frozenset(DeviceStateBatchChanges.ignored_attrs)
+        for i, (curr_doc, ds_doc) in enumerate(zip(self.curr_docs, self.ds_docs)):
+            if self.new[i]:
+                curr_doc = dict()
+            elif ds_doc.items() <= curr_doc.items():
+                if (curr_doc.keys() - ds_doc.keys()) <= ignored:
+                    continue  # unchanged
+            try:
+                changed = [key for key, value in (ds_doc.items() - curr_doc.items())]
+            except TypeError:
+                # unhashable values, such as lists; compare them one at a time
+                changed = [key for key in ds_doc.keys()
+                           if key not in curr_doc or curr_doc[key] != ds_doc[key]]
+            removed = curr_doc.keys() - ds_doc.keys()
+            self.add_changes(i, changed, removed, ignored)
+
+    def add_changes(self, i: int, changed, removed, ignored) -> None:
+        bits = self.schema_bits
+        mask, removed_mask = 0, 0
+        extra_changed, extra_removed = list(), list()
+        for attr in changed:
+            if attr in bits:
+                mask |= bits[attr]
+            elif attr not in ignored:
+                extra_changed.append(attr)
+        for attr in removed:
+            if attr in bits:
+                mask |= bits[attr]
+                removed_mask |= bits[attr]
+            elif attr not in ignored:
+                extra_removed.append(attr)
+        self.masks[i] = mask
+        self.removed_masks[i] = removed_mask
+        if len(extra_changed) + len(extra_removed) > 0:
+            self.extra_changes[i] = (sorted(extra_changed), sorted(extra_removed))
+
+    def is_new(self, i: int) -> bool:
+        return self.new[i]
+
+    def has_changes(self, i: int) -> bool:
+        return self.new[i] or self.masks[i] != 0 or i in self.extra_changes
+
+    def change_count(self) -> int:
+        """Return the number of pairs with changes."""
+        return sum([1 for i in range(self.count) if self.has_changes(i)])
+
+    def changed_attrs(self, i: int) -> list:
+        """Return the names of the changed, added, or removed attributes of pair i."""
+        attrs = self.mask_attrs(self.masks[i])
+        if i in self.extra_changes:
+            attrs = attrs + self.extra_changes[i][0] + self.extra_changes[i][1]
+        return attrs
+
+    def mask_attrs(self, mask: int) -> list:
+        return [attr for bit, attr in enumerate(self.schema) if mask & (1 << bit)]
+
+    def patch_operations(self, i: int) -> list:
+        """
+        Return the minimal patch operations that change current doc i into
+        incoming doc i; 'set' for changed or added attributes and 'remove'
+        for removed attributes.  See CosmosNoSQLService.patch_item.
+        """
+        ops = list()
+        ds_doc = self.ds_docs[i]
+        mask, removed_mask = self.masks[i], self.removed_masks[i]
+        if mask != 0:
+            for flag, attr, path in self.schema_paths:
+                if mask & flag:
+                    if removed_mask & flag:
+                        ops.append({"op": "remove", "path": path})
+                    else:
+                        ops.append({"op": "set", "path": path, "value": ds_doc[attr]})
+        if i in self.extra_changes:
+            changed, removed = self.extra_changes[i]
+            for attr in changed:
+                ops.append({"op": "set", "path": "/" + attr, "value": ds_doc[attr]})
+            for attr in removed:
+                ops.append({"op": "remove", "path": "/" + attr})
+        return ops
@@ -1,8 +1,20 @@
-import json
+import asyncio
+import time
 
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosResourceNotFoundError,
+)
+
+from src.dao.device_state_history import DeviceStateHistory
 from src.services.config_service import ConfigService
 from src.services.cosmos_nosql_service import CosmosNoSQLService
+from src.models.device_data import DeviceData
 from src.models.device_state_changes import DeviceStateChanges
+from src.util.doc_size import DocSize
+from src.util.histogram import Histogram
+from src.util.lru_cache import LRUCache
+from src.util.operations_log import OperationAggregates
 
 # Instances of this class implement the database mutation logic
 # for a given DeviceState event.
@@ -10,7 +22,43 @@ from src.models.device_state_changes import DeviceStateChanges
 
 class DeviceStateChangeOperations:
 
-    all_operations = list()
+    # the running per-operation aggregates of all events, and an optional
+    # OperationsLog to which each operation is appended; see add_operation
+    operation_aggregates = OperationAggregates()
+    operations_log = None
+
+    # update the previous DeviceState 'until' value with a partial document
+    # patch rather than upserting the whole document; False for comparison
+    use_patch_updates = True
+
+    # optimistic-concurrency pipeline mode; the id and _etag of the latest
+    # DeviceState per did are kept, so the previous DeviceState can be
+    # patched with If-Match instead of being found with a query
+    use_etag_pipeline = False
+    last_known_states = LRUCache(100_000)  # did -> dict with the id and _etag
+
+    # DeviceStateCurrent (DC) mode; the current state of each pid-did is
+    # point-read from, and overlaid onto, its DC document, which also points
+    # to the latest DeviceState, so no recent-events query is needed
+    use_current_state_docs = False
+    max_write_attempts = 3
+
+    # optional write-through LRUCache of the DC, D1, PD, and DA documents,
+    # keyed by (container name, id), so hot devices skip their point-reads
+    state_cache = None
+
+    # the full README ingestion flow; DC, D1, PD, and DA for each event
+    use_full_flow = False
+
+    # the PartitionKeyStrategy of the DeviceState documents, if not the did;
+    # the previous DeviceState is then found by a fan-out over its keys, and
+    # is patched in its own partition
+    partition_strategy = None
+
+    # the README_DEVICES per-event RU estimates, see method ru_summary
+    readme_ru_estimates = {'minimum': 16, 'with_updates': 29}
+    event_ru_histogram = Histogram()
+    event_latency_histogram = Histogram()
 
     def __init__(self, nosql_svc: CosmosNoSQLService, ds_doc: dict, insert_ru: float):
         self.nosql_svc = nosql_svc
@@ -22,41 +70,366 @@ class DeviceStateChangeOperations:
         self.d_container  = ConfigService.envvar("COSMOSDB_NOSQL_D_CONTAINER",  "Devices")
         self.ds_container = ConfigService.envvar("COSMOSDB_NOSQL_DS_CONTAINER", "DeviceState")
         self.da_container = ConfigService.envvar("COSMOSDB_NOSQL_DA_CONTAINER", "DeviceAttributes")
+        self.dc_container = ConfigService.envvar("COSMOSDB_NOSQL_DC_CONTAINER", "DeviceStateCurrent")
         self.add_operation('insert device state', insert_ru, ds_doc)
 
     async def execute(self) -> None:
-        await self.read_update_previous_device_state()
+        start_time = time.perf_counter()
+        if DeviceStateChangeOperations.use_full_flow:
+            await self.execute_full_flow()
+        elif DeviceStateChangeOperations.use_current_state_docs:
+            await self.update_current_device_state()
+        elif DeviceStateChangeOperations.use_etag_pipeline:
+            await self.conditional_update_previous_device_state()
+        else:
+            await self.read_update_previous_device_state()
+        elapsed_ms = (time.perf_counter() - start_time) * 1000.0
+        DeviceStateChangeOperations.event_ru_histogram.record(self.get_total_ru())
+        DeviceStateChangeOperations.event_latency_histogram.record(elapsed_ms)
         print("DSCO_execute_completed, ru: {} op_count: {} ops: {}".format(
             self.get_total_ru(), self.get_op_count(), self.operations))
 
     async def read_update_previous_device_state(self) -> None:
         sql = self.recent_events_for_device_sql(self.ds_doc)
         print(sql)
-        results = await self.nosql_svc.query_items(
-            sql, cross_partition=False, pk='/did', max_items=2)
-        ru = self.nosql_svc.last_request_charge()
+        strategy = DeviceStateChangeOperations.partition_strategy
+        if strategy is None:
+            # the DeviceState container is partitioned by did, so this is
+            # a single-partition query rather than a cross-partition fan-out
+            results = await self.nosql_svc.query_partition(sql, self.ds_did, max_items=2)
+            ru = self.nosql_svc.last_request_charge()
+        else:
+            # the device's states are in several partitions; query the keys
+            # that the strategy routes to, rather than every partition
+            history = DeviceStateHistory(self.nosql_svc, strategy)
+            results = await history.recent_states(self.ds_did, self.ds_doc['evt_time'], sql, 2)
+            ru = history.request_units
         self.add_operation('read device states', ru)
         print('read device states results: rows: {} sql: {}'.format(len(results), sql))
         for result in results:
             print("read device state result: {}".format(result))
-        if len(results) == 2:
-            self.previous_ds_doc = results[1]
+        self.previous_ds_doc = self.previous_device_state(results)
+        if self.previous_ds_doc is not None:
             self.previous_ds_doc['until'] = self.ds_doc['evt_time']
-            self.previous_ds_doc = await self.nosql_svc.upsert_item(self.previous_ds_doc)
-            ru = self.nosql_svc.last_request_charge()
-            self.add_operation('update previous device state', ru, self.previous_ds_doc)
+            if DeviceStateChangeOperations.use_patch_updates:
+                await self.patch_previous_device_state_until(
+                    self.previous_ds_doc['id'], self.previous_ds_doc['until'],
+                    self.device_state_pk(self.previous_ds_doc))
+            else:
+                await self.upsert_previous_device_state()
+
+    async def conditional_update_previous_device_state(self) -> None:
+        """
+        Patch the 'until' of the last-known previous DeviceState with If-Match
+        on its _etag, so the common case costs a single write and no query.
+        The recent-events query is only executed for the first event of a
+        device in this process, or when the patch fails with a 412 or 404
+        because the previous DeviceState was modified or deleted elsewhere.
+        """
+        last_known = DeviceStateChangeOperations.last_known_states.get(self.ds_did)
+        if last_known is None or last_known['id'] == self.ds_doc['id']:
+            await self.read_update_previous_device_state()
+        else:
+            patch_ops = [
+                CosmosNoSQLService.patch_op('set', '/until', self.ds_doc['evt_time'])]
+            try:
+                await self.nosql_svc.patch_item(
+                    last_known['id'], last_known['pk'], patch_ops, etag=last_known['_etag'])
+                ru = self.nosql_svc.last_request_charge()
+                self.add_operation('conditional patch previous device state', ru, patch_ops)
+            except (CosmosAccessConditionFailedError, CosmosResourceNotFoundError) as e:
+                ru = self.nosql_svc.last_request_charge()
+                self.add_operation('conditional patch failed {}'.format(e.status_code), ru)
+                DeviceStateChangeOperations.last_known_states.invalidate(self.ds_did)
+                await self.read_update_previous_device_state()
+        DeviceStateChangeOperations.remember_device_state(self.ds_doc)
+
+    @classmethod
+    def remember_device_state(cls, ds_doc: dict) -> None:
+        if ds_doc is not None and '_etag' in ds_doc.keys():
+            last_known = dict()
+            last_known['id'] = ds_doc['id']
+            last_known['_etag'] = ds_doc['_etag']
+            last_known['pk'] = ds_doc.get('pk', ds_doc['did'])
+            cls.last_known_states.put(ds_doc['did'], last_known)
+
+    async def execute_full_flow(self) -> None:
+        """
+        Execute the README_DEVICES ingestion flow for this event.  The DC,
+        D1, PD, and each DA update are independent of each other, so they
+        run concurrently and the event's latency is that of the longest
+        chain (the DC read, write, and previous DeviceState patch) rather
+        than the sum of all of the steps.  Each step is a point-read, and a
+        write only if the document is new or changed.  The PD and DA ids are
+        their own partition keys, so CosmosNoSQLService#read_many would also
+        point-read each of them; their reads stay in their read-diff-write
+        steps, with the state_cache and the retries on conflicts.
+        """
+        steps = list()
+        steps.append(self.update_current_device_state())
+        steps.append(self.update_device_singleton())
+        steps.append(self.update_producer_device())
+        for name in DeviceData.strong_attrs:
+            if name in self.ds_doc.keys():
+                steps.append(self.update_device_attribute(name, self.ds_doc[name]))
+        await asyncio.gather(*steps)
+
+    async def update_device_singleton(self) -> None:
+        """The DeviceSingleton (D1) id and pk are the did."""
+        did = self.ds_did
+
+        def device_singleton_doc(curr_doc):
+            doc = dict()
+            doc['id'] = did
+            doc['pk'] = did
+            doc['dt'] = 'd1'
+            doc['label'] = 'device'
+            doc['firstEventEpoch'] = self.ds_doc['evt_time']
+            if curr_doc is not None and 'firstEventEpoch' in curr_doc.keys():
+                doc['firstEventEpoch'] = min(curr_doc['firstEventEpoch'], doc['firstEventEpoch'])
+            return doc
+
+        await self.read_diff_write(self.d1_container, 'device singleton', did, device_singleton_doc)
+
+    async def update_producer_device(self) -> None:
+        """The ProducerDevice (PD) id and pk are 'pid-did'."""
+        pd_id = self.current_device_state_id(self.ds_doc)
+
+        def producer_device_doc(curr_doc):
+            doc = dict()
+            doc['id'] = pd_id
+            doc['pk'] = pd_id
+            doc['dt'] = 'pd'
+            doc['did'] = self.ds_did
+            doc['pid'] = self.ds_doc['pid']
+            doc['extId'] = self.ds_doc.get('extId', None)
+            return doc
+
+        await self.read_diff_write(self.d_container, 'producer device', pd_id, producer_device_doc)
+
+    async def update_device_attribute(self, name: str, value) -> None:
+        """
+        The DeviceAttribute (DA) id and pk are 'name-value', and its 'dids'
+        are the devices that have had this attribute value.
+        """
+        da_id = "{}-{}".format(name, value)
+
+        def device_attribute_doc(curr_doc):
+            dids = list()
+            if curr_doc is not None:
+                dids = list(curr_doc.get('dids', list()))
+            if self.ds_did not in dids:
+                dids.append(self.ds_did)
+            doc = dict()
+            doc['id'] = da_id
+            doc['pk'] = da_id
+            doc['dt'] = 'da'
+            doc['name'] = name
+            doc['value'] = value
+            doc['dids'] = dids
+            return doc
+
+        await self.read_diff_write(self.da_container, 'device attribute', da_id, device_attribute_doc)
+
+    async def update_current_device_state(self) -> None:
+        """
+        Point-read the DeviceStateCurrent document of this event's pid-did,
+        diff it with the event, and overlay it (If-Match on its _etag) or
+        create it.  The DC document's 'dsid' is the id of the previous
+        DeviceState, whose 'until' is then patched without a query.
+        """
+        dc_id = self.current_device_state_id(self.ds_doc)
+
+        def current_state_doc(curr_doc):
+            if curr_doc is not None and curr_doc.get('evt_time', 0) > self.ds_doc['evt_time']:
+                return None  # an out-of-order event; keep the newer current state
+            return self.current_device_state_doc(self.ds_doc, dc_id)
+
+        curr_doc, written = await self.read_diff_write(
+            self.dc_container, 'device state current', dc_id, current_state_doc)
+        if written is None or curr_doc is None:
+            return
+        if curr_doc.get('dsid', None) is not None:
+            await self.patch_previous_device_state_until(
+                curr_doc['dsid'], self.ds_doc['evt_time'], curr_doc.get('dspk', None))
+
+    async def read_diff_write(self, cname: str, entity: str, id: str, build_doc) -> tuple:
+        """
+        Point-read the document with the given id (which is also its pk) in
+        the given container, and call build_doc(curr_doc) for the desired
+        document, or None to leave it unchanged.  The document is created if
+        absent, replaced with If-Match on its _etag if DeviceStateChanges
+        reports changes, and not written at all otherwise.  Conflicting
+        concurrent writes cause a re-read and another attempt.
+        Return a tuple of the document as read and the written doc, if any.
+
+        With a state_cache the read may be served from the cache, written
+        documents are put in the cache, and the cached entry is invalidated
+        on a conflict so that the next attempt re-reads it from Cosmos DB.
+        """
+        svc = self.nosql_svc.for_container(cname)
+        cache = DeviceStateChangeOperations.state_cache
+        cache_key = (cname, id)
+        for attempt in range(DeviceStateChangeOperations.max_write_attempts):
+            curr_doc = await self.read_document(svc, entity, id, cache_key)
+            doc = build_doc(curr_doc)
+            if doc is None:
+                return curr_doc, None
+            changes = DeviceStateChanges(curr_doc, doc)
+            try:
+                if changes.is_new():
+                    written = await svc.create_item_if_absent(changes.updated_doc)
+                    ru = svc.last_request_charge()
+                    if written is None:
+                        self.add_operation('create {} conflict'.format(entity), ru)
+                        if cache is not None:
+                            cache.invalidate(cache_key)
+                        continue
+                    self.add_operation('create {}'.format(entity), ru, written)
+                    if cache is not None:
+                        cache.put(cache_key, written)
+                    return curr_doc, written
+                elif changes.has_changes():
+                    written = await svc.replace_item_if_match(
+                        changes.updated_doc, curr_doc['_etag'])
+                    self.add_operation(
+                        'update {}'.format(entity), svc.last_request_charge(), written)
+                    if cache is not None:
+                        cache.put(cache_key, written)
+                    return curr_doc, written
+                else:
+                    return curr_doc, None
+            except CosmosAccessConditionFailedError:
+                self.add_operation(
+                    'update {} conflict'.format(entity), svc.last_request_charge())
+                if cache is not None:
+                    cache.invalidate(cache_key)
+        print("read_diff_write: too many conflicts for {} {}".format(entity, id))
+        return None, None
+
+    async def read_document(
+            self, svc: CosmosNoSQLService, entity: str, id: str, cache_key: tuple) -> dict:
+        """
+        Return the document with the given id and pk from the state_cache, if
+        present, else point-read it; return None if it doesn't exist.
+        """
+        cache = DeviceStateChangeOperations.state_cache
+        if cache is not None:
+            cached_doc = cache.get(cache_key)
+            if cached_doc is not None:
+                self.add_operation('read {} cache hit'.format(entity), 0.0)
+                return cached_doc
+        try:
+            curr_doc = await svc.point_read(id, id)
+        except CosmosResourceNotFoundError:
+            curr_doc = None
+        ru = svc.last_request_charge()
+        self.add_operation('read {}'.format(entity), ru)
+        if cache is not None:
+            cache.record_read_ru(ru)
+            if curr_doc is not None:
+                cache.put(cache_key, curr_doc)
+        return curr_doc
+
+    def device_state_pk(self, ds_doc: dict):
+        """The pk of a DeviceState; its synthetic 'pk' if it has one, else its did."""
+        return ds_doc.get('pk', ds_doc['did'])
+
+    def current_device_state_id(self, ds_doc: dict) -> str:
+        """The DeviceStateCurrent id and pk are 'pid-did'."""
+        return "{}-{}".format(ds_doc['pid'], ds_doc['did'])
+
+    def current_device_state_doc(self, ds_doc: dict, dc_id: str) -> dict:
+        """Return the DeviceStateCurrent application attributes for the given event."""
+        dc_doc = dict()
+        for key in ds_doc.keys():
+            if key not in DeviceStateChanges.cosmos_generated_attrs:
+                dc_doc[key] = ds_doc[key]
+        dc_doc['id'] = dc_id
+        dc_doc['pk'] = dc_id
+        dc_doc['dt'] = 'dc'
+        dc_doc['dsid'] = ds_doc['id']
+        if 'pk' in ds_doc.keys():
+            dc_doc['dspk'] = ds_doc['pk']  # the pk of a DeviceState with a synthetic key
+        dc_doc.pop('until', None)
+        return dc_doc
+
+    async def upsert_previous_device_state(self) -> None:
+        self.previous_ds_doc = await self.nosql_svc.upsert_item(self.previous_ds_doc)
+        ru = self.nosql_svc.last_request_charge()
+        self.add_operation('update previous device state', ru, self.previous_ds_doc)
+
+    async def patch_previous_device_state_until(self, previous_id: str, until, previous_pk=None) -> None:
+        """
+        Set only the 'until' attribute of the previous DeviceState, in the
+        given partition (default the did).  The operations log records the
+        size of the patch operations rather than of the whole document, so
+        patch and upsert costs can be compared.
+        """
+        patch_ops = [CosmosNoSQLService.patch_op('set', '/until', until)]
+        pk = self.ds_did if previous_pk is None else previous_pk
+        await self.nosql_svc.patch_item(previous_id, pk, patch_ops)
+        ru = self.nosql_svc.last_request_charge()
+        self.add_operation('patch previous device state', ru, patch_ops)
 
     def add_operation(self, operation_name: str, request_units: float, doc:dict = None) -> None:
         entry = { 
+            'event_id': self.ds_doc.get('id', ''),
             'did': self.ds_did,
             'operation': operation_name, 
             'ru': request_units,
             'doc_size': 0
         }
         if doc is not None:
-            entry['doc_size'] = len(json.dumps(doc))
+            entry['doc_size'] = DocSize.estimate(doc)
         self.operations.append(entry)
-        DeviceStateChangeOperations.all_operations.append(entry)
+        DeviceStateChangeOperations.operation_aggregates.record(
+            operation_name, request_units, entry['doc_size'])
+        if DeviceStateChangeOperations.operations_log is not None:
+            DeviceStateChangeOperations.operations_log.write(entry)
+
+    @classmethod
+    async def execute_change_feed_batch(
+            cls, nosql_svc: CosmosNoSQLService, docs: list) -> int:
+        """
+        Execute the operations for a batch of DeviceState documents from the
+        change feed.  Devices are processed concurrently, and each device's
+        documents in order.  Documents whose 'until' has been set are skipped;
+        they are earlier DeviceStates re-emitted by the change feed because
+        their 'until' was patched.  The insert RU were charged at ingestion,
+        so they are recorded as 0.0 here.  Return the number executed.
+        """
+        docs_by_did = dict()
+        for doc in docs:
+            if doc.get('dt', 'ds') != 'ds' or doc.get('until', -1) != -1:
+                continue
+            if doc['did'] not in docs_by_did.keys():
+                docs_by_did[doc['did']] = list()
+            docs_by_did[doc['did']].append(doc)
+
+        async def execute_device_docs(device_docs):
+            for doc in device_docs:
+                ops = cls(nosql_svc, doc, 0.0)
+                await ops.execute()
+
+        await asyncio.gather(*[execute_device_docs(dd) for dd in docs_by_did.values()])
+        return sum([len(dd) for dd in docs_by_did.values()])
+
+    @classmethod
+    def ru_summary(cls) -> dict:
+        """
+        Return the count, RU, and document size stats of each operation type,
+        and the per-event RU and latency, for comparison with the README
+        estimates of 16 RU (no updates) and 29 RU (PD, D1, and DA updated).
+        """
+        summary = dict()
+        summary['operations'] = cls.operation_aggregates.to_dict()
+        summary['event_ru'] = cls.event_ru_histogram.summary()
+        summary['event_latency_ms'] = cls.event_latency_histogram.summary()
+        summary['readme_ru_estimates'] = cls.readme_ru_estimates
+        if cls.state_cache is not None:
+            summary['state_cache'] = cls.state_cache.get_stats()
+        return summary
 
     def get_op_count(self) -> int:
         return len(self.operations)
@@ -67,10 +440,27 @@ class DeviceStateChangeOperations:
             total = total + entry['ru']
         return total
     
+    def previous_device_state(self, results: list) -> dict | None:
+        """
+        Return the previous DeviceState of this event among the given recent
+        states, or None.  This event's own document is excluded by its id,
+        rather than assumed to be the first result, as events of a device
+        may have the same evt_time.  Of the still-current states, the latest
+        by evt_time, then _ts, then id is the previous state.
+        """
+        candidates = list()
+        for doc in results:
+            if doc['id'] != self.ds_doc['id'] and doc.get('until', -1) == -1:
+                candidates.append(doc)
+        if len(candidates) == 0:
+            return None
+        return max(candidates, key=lambda doc: (doc.get('evt_time', 0), doc.get('_ts', 0), doc['id']))
+
     def recent_events_for_device_sql(self, doc: dict) -> str:
+        # only the current states; this event and the previous one
         parts = list()
         parts.append("select * from c where c.did = '{}'".format(doc['did']))
-        parts.append("and c.dt = 'ds'")
+        parts.append("and c.dt = 'ds' and c.until = -1")
         parts.append("order by c.evt_time desc offset 0 limit 2")
         return " ".join(parts).strip()
     
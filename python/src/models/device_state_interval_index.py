@@ -0,0 +1,159 @@
+import bisect
+import json
+
+from array import array
+from operator import itemgetter
+
+# Instances of this class are an in-memory index of the DeviceState
+# intervals; each DeviceState document is the state of its device from its
+# evt_time until its 'until' time (-1 while it's the current state).  The
+# index answers "state of device at time T" queries for millions of devices
+# without a query per device, so bulk audits are lookups rather than scans.
+#
+# The index is built from an export of the DeviceState documents (NDJSON,
+# see method add_file), or from change feed pages (see method add_all); a
+# document that appears more than once, such as after its 'until' was
+# patched, is indexed once with its last version.  The intervals are kept
+# in flat arrays sorted by did and evt_time, with the slice of each did.
+
+
+class DeviceStateIntervalIndex:
+
+    def __init__(self, fields: list = None):
+        """
+        The given fields, such as ['ser', 'cid', 'host'], are kept with each
+        interval and returned by the queries along with its id and times.
+        """
+        self.fields = list() if fields is None else list(fields)
+        self.pending = list()  # the added (did, evt_time, until, id, values) rows
+        self.slices = dict()  # did -> (lo, hi) indexes into the arrays below
+        self.evt_times = array("d")
+        self.untils = array("d")
+        self.ids = list()
+        self.values = list()  # per interval, a tuple of the field values
+        self.dids = list()  # per interval, its did
+        self.added = 0
+
+    def add(self, doc: dict) -> None:
+        """Add the interval of the given DeviceState document."""
+        values = tuple([doc.get(field, None) for field in self.fields])
+        self.pending.append((doc["did"], doc["evt_time"], doc.get("until", -1), doc["id"], values))
+        self.added = self.added + 1
+
+    def add_all(self, docs: list) -> None:
+        """Add the given documents; DeviceState documents (dt 'ds') are indexed, others ignored."""
+        for doc in docs:
+            if doc.get("dt", "ds") == "ds":
+                self.add(doc)
+
+    def add_file(self, path: str) -> int:
+        """Add the DeviceState documents of the given NDJSON export file; return their count."""
+        count = 0
+        with open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if len(line.strip()) > 0:
+                    self.add(json.loads(line))
+                    count = count + 1
+        return count
+
+    def build(self) -> None:
+        """
+        Merge the pending rows into the sorted arrays; the queries call this
+        as needed.  The last added version of each document id is kept.
+        """
+        if len(self.pending) == 0:
+            return
+        latest = dict()  # id -> row
+        for i in range(len(self.ids)):
+            latest[self.ids[i]] = (
+                self.dids[i], self.evt_times[i], self.untils[i], self.ids[i], self.values[i])
+        for row in self.pending:
+            latest[row[3]] = row
+        rows = sorted(latest.values(), key=itemgetter(0, 1, 3))
+        self.pending = list()
+        self.slices = dict()
+        self.evt_times = array("d", [row[1] for row in rows])
+        self.untils = array("d", [row[2] for row in rows])
+        self.ids = [row[3] for row in rows]
+        self.values = [row[4] for row in rows]
+        self.dids = [row[0] for row in rows]
+        lo = 0
+        for i in range(1, len(rows) + 1):
+            if i == len(rows) or rows[i][0] != rows[lo][0]:
+                self.slices[rows[lo][0]] = (lo, i)
+                lo = i
+
+    def as_of(self, did: str, t: float) -> dict:
+        """
+        Return the state of the given device at time t; a dict with its id,
+        did, evt_time, until, and fields, or None if it had no state then.
+        """
+        if len(self.pending) > 0:
+            self.build()
+        bounds = self.slices.get(did, None)
+        if bounds is None:
+            return None
+        return self.interval_at(did, bounds[0], bounds[1], t)
+
+    def interval_at(self, did: str, lo: int, hi: int, t: float) -> dict:
+        i = bisect.bisect_right(self.evt_times, t, lo, hi) - 1
+        if i < lo:
+            return None  # before the device's first event
+        until = self.untils[i]
+        if until == -1 and i + 1 < hi:
+            until = self.evt_times[i + 1]  # the 'until' patch of a superseded state may lag
+        if until != -1 and until <= t:
+            return None
+        state = dict()
+        state["id"] = self.ids[i]
+        state["did"] = did
+        state["evt_time"] = self.evt_times[i]
+        state["until"] = until
+        for field, value in zip(self.fields, self.values[i]):
+            state[field] = value
+        return state
+
+    def bulk_as_of(self, dids, t: float) -> dict:
+        """Return a dict of did -> state at time t (or None) for each of the given dids."""
+        if len(self.pending) > 0:
+            self.build()
+        results = dict()
+        for did in dids:
+            bounds = self.slices.get(did, None)
+            if bounds is None:
+                results[did] = None
+            else:
+                results[did] = self.interval_at(did, bounds[0], bounds[1], t)
+        return results
+
+    def snapshot(self, t: float):
+        """Yield the state at time t of each device that had one, in did order."""
+        if len(self.pending) > 0:
+            self.build()
+        for did, (lo, hi) in self.slices.items():
+            state = self.interval_at(did, lo, hi, t)
+            if state is not None:
+                yield state
+
+    def changed_between(self, t1: float, t2: float):
+        """Yield the dids whose state at time t2 is a different document than at time t1."""
+        if len(self.pending) > 0:
+            self.build()
+        for did, (lo, hi) in self.slices.items():
+            state1 = self.interval_at(did, lo, hi, t1)
+            state2 = self.interval_at(did, lo, hi, t2)
+            id1 = None if state1 is None else state1["id"]
+            id2 = None if state2 is None else state2["id"]
+            if id1 != id2:
+                yield did
+
+    def get_stats(self) -> dict:
+        if len(self.pending) > 0:
+            self.build()
+        stats = dict()
+        stats["added"] = self.added
+        stats["devices"] = len(self.slices)
+        stats["intervals"] = len(self.ids)
+        stats["open_intervals"] = sum([1 for until in self.untils if until == -1])
+        stats["fields"] = self.fields
+        return stats
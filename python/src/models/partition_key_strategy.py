@@ -0,0 +1,133 @@
+import time
+import zlib
+
+# Instances of this class compute the partition key of DeviceState events,
+# and route queries to the partition keys that they must touch.
+#
+# With the 'did' strategy the key is the did, so a chatty device is a hot
+# logical partition that grows toward the logical partition size limit.
+# The synthetic keys spread a device's events over several logical
+# partitions: 'did_day' and 'did_hour' append the UTC day or hour of the
+# evt_time, which bounds each partition's size and rotates the writes to a
+# new key each period; 'did_hash' appends a hash of the event id modulo N
+# (the spec 'did_hash:N'), which spreads even a single device's writes
+# over N keys at any time.  The DeviceState container is then partitioned
+# by /pk, which the assign method sets.
+#
+# A query of a device's states in a time range touches the keys of the
+# buckets that overlap the range (see keys_for_range), and a query of its
+# latest states before a time walks the buckets back from that time (see
+# keys_before); with 'did_hash' every query touches all N keys.  On the
+# ingest path the walk also stops after max_empty_buckets consecutive empty
+# buckets, so the first event of a device doesn't query every lookback key.
+
+
+class PartitionKeyStrategy:
+
+    names = ["did", "did_day", "did_hour", "did_hash"]
+
+    # the bucket length and key suffix format of the time-bucketed strategies
+    bucket_seconds = {"did_day": 86400, "did_hour": 3600}
+    bucket_formats = {"did_day": "%Y%m%d", "did_hour": "%Y%m%d%H"}
+
+    def __init__(
+        self,
+        name: str = "did",
+        hash_buckets: int = 8,
+        max_lookback_buckets: int = 90,
+        max_range_buckets: int = 10_000,
+        max_empty_buckets: int = 7,
+    ):
+        """
+        The max_lookback_buckets limits how far back keys_before walks, and
+        max_range_buckets is the most keys that keys_for_range returns.
+        The max_empty_buckets limits the walk for the previous state of an
+        ingested event, see DeviceStateHistory#recent_states.
+        """
+        if name not in PartitionKeyStrategy.names:
+            raise ValueError("unknown partition key strategy: {}".format(name))
+        if hash_buckets < 1:
+            raise ValueError("hash_buckets must be positive")
+        self.name = name
+        self.hash_buckets = hash_buckets
+        self.max_lookback_buckets = max_lookback_buckets
+        self.max_range_buckets = max_range_buckets
+        self.max_empty_buckets = max_empty_buckets
+
+    @classmethod
+    def parse(cls, spec: str, **kwargs):
+        """Return the strategy of the given spec; 'did', 'did_day', 'did_hour', or 'did_hash:N'."""
+        if spec.startswith("did_hash"):
+            parts = spec.split(":")
+            hash_buckets = 8
+            if len(parts) > 1:
+                hash_buckets = int(parts[1])
+            return PartitionKeyStrategy("did_hash", hash_buckets=hash_buckets, **kwargs)
+        return PartitionKeyStrategy(spec, **kwargs)
+
+    def spec(self) -> str:
+        if self.name == "did_hash":
+            return "did_hash:{}".format(self.hash_buckets)
+        return self.name
+
+    def is_time_bucketed(self) -> bool:
+        return self.name in PartitionKeyStrategy.bucket_seconds
+
+    def key_for(self, did: str, evt_time: float, salt) -> str:
+        """Return the partition key of an event of the given did, evt_time, and salt (its id)."""
+        if self.name == "did":
+            return did
+        if self.name == "did_hash":
+            suffix = zlib.crc32(str(salt).encode("utf-8")) % self.hash_buckets
+            return "{}-{}".format(did, suffix)
+        return self.bucket_key(did, self.bucket_start(evt_time))
+
+    def partition_key(self, doc: dict) -> str:
+        return self.key_for(doc["did"], doc.get("evt_time", 0), doc.get("id", ""))
+
+    def assign(self, doc: dict) -> str:
+        """Set and return the 'pk' of the given DeviceState document."""
+        pk = self.partition_key(doc)
+        doc["pk"] = pk
+        return pk
+
+    def bucket_start(self, t: float) -> int:
+        seconds = PartitionKeyStrategy.bucket_seconds[self.name]
+        return int(t // seconds) * seconds
+
+    def bucket_key(self, did: str, bucket_start: int) -> str:
+        fmt = PartitionKeyStrategy.bucket_formats[self.name]
+        return "{}-{}".format(did, time.strftime(fmt, time.gmtime(bucket_start)))
+
+    def keys_for_range(self, did: str, start: float, end: float) -> list:
+        """
+        Return the partition keys of the given device that may contain its
+        states with an evt_time in [start, end]; raise a ValueError if the
+        range spans more than max_range_buckets buckets.
+        """
+        if self.name == "did":
+            return [did]
+        if self.name == "did_hash":
+            return self.hash_keys(did)
+        seconds = PartitionKeyStrategy.bucket_seconds[self.name]
+        first, last = self.bucket_start(start), self.bucket_start(end)
+        count = ((last - first) // seconds) + 1
+        if count > self.max_range_buckets:
+            raise ValueError("the time range spans {} partition keys".format(count))
+        return [self.bucket_key(did, first + (i * seconds)) for i in range(max(0, count))]
+
+    def keys_before(self, did: str, t: float) -> list:
+        """
+        Return the partition keys of the given device that may contain its
+        states with an evt_time at or before t, most recent bucket first.
+        """
+        if self.name == "did":
+            return [did]
+        if self.name == "did_hash":
+            return self.hash_keys(did)
+        seconds = PartitionKeyStrategy.bucket_seconds[self.name]
+        last = self.bucket_start(t)
+        return [self.bucket_key(did, last - (i * seconds)) for i in range(self.max_lookback_buckets)]
+
+    def hash_keys(self, did: str) -> list:
+        return ["{}-{}".format(did, i) for i in range(self.hash_buckets)]
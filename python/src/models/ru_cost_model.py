@@ -0,0 +1,258 @@
+import math
+
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from src.util.histogram import Histogram
+from src.util.operations_log import OperationsLog
+
+# Instances of this class compute an RU cost model from the operations logs
+# written by DeviceStateChangeOperations (see class OperationsLog).  The logs
+# are processed in chunks of columns, so their size isn't limited by memory:
+#
+# - per operation type, RU is fit against document size by least squares,
+#   from running sums that are aggregated per chunk
+# - per event, the RU of its operations are summed, and the events are
+#   classified as 'changed' (a D1, PD, or DA document was created or updated)
+#   or 'unchanged', for per-event cost distributions
+# - the required RU/s for a given events/sec and change rate is projected
+#
+# NumPy is used for the per-chunk aggregation when it's installed.
+
+
+class RUCostModel:
+
+    # the sums per operation type, for the least squares fits
+    SUMS = ["n", "sx", "sy", "sxx", "sxy", "syy"]
+
+    # create or update operations of these entities make an event 'changed';
+    # the DeviceStateCurrent document is written for every event
+    changed_entities = ["device singleton", "producer device", "device attribute"]
+
+    def __init__(self, max_open_events: int = 100_000, use_numpy: bool = None):
+        """
+        The operations of an event are summed until max_open_events later
+        events have been seen; the log is in completion order, so an event's
+        operations are close together.
+        """
+        self.use_numpy = (np is not None) if use_numpy is None else use_numpy
+        if self.use_numpy and np is None:
+            raise ValueError("numpy is not installed")
+        self.max_open_events = max_open_events
+        self.operation_codes = dict()  # operation name -> int code
+        self.operation_names = list()
+        self.changed_codes = list()  # per code, 1 if it makes an event 'changed'
+        self.sums = list()  # per code, a list of the SUMS
+        self.open_events = OrderedDict()  # event_id -> [ru, op_count, changed]
+        self.event_histograms = dict()
+        for name in ["all", "changed", "unchanged"]:
+            self.event_histograms[name] = Histogram()
+        self.rows = 0
+        self.chunks = 0
+
+    def operation_code(self, name: str) -> int:
+        """Return the int code of the given operation name, interning it if new."""
+        code = self.operation_codes.get(name, None)
+        if code is None:
+            code = len(self.operation_names)
+            self.operation_codes[name] = code
+            self.operation_names.append(name)
+            changed = 0
+            for entity in RUCostModel.changed_entities:
+                if name in ["create {}".format(entity), "update {}".format(entity)]:
+                    changed = 1
+            self.changed_codes.append(changed)
+            self.sums.append([0.0] * len(RUCostModel.SUMS))
+        return code
+
+    def process_files(self, paths: list, chunk_rows: int = 1_000_000) -> None:
+        """Process the given operations log files, in chunks of chunk_rows entries."""
+        for path in paths:
+            columns = self.empty_columns()
+            for entry in OperationsLog.read(path):
+                columns["event_id"].append(entry["event_id"])
+                columns["operation"].append(entry["operation"])
+                columns["ru"].append(entry["ru"])
+                columns["doc_size"].append(entry["doc_size"])
+                if len(columns["ru"]) >= chunk_rows:
+                    self.add_chunk(columns)
+                    columns = self.empty_columns()
+            if len(columns["ru"]) > 0:
+                self.add_chunk(columns)
+        self.finish()
+
+    def empty_columns(self) -> dict:
+        return {"event_id": list(), "operation": list(), "ru": list(), "doc_size": list()}
+
+    def add_chunk(self, columns: dict) -> None:
+        """Aggregate a chunk of columns; lists of event_id, operation, ru, and doc_size."""
+        self.rows = self.rows + len(columns["ru"])
+        self.chunks = self.chunks + 1
+        if self.use_numpy:
+            self.add_chunk_numpy(columns)
+        else:
+            self.add_chunk_python(columns)
+        while len(self.open_events) > self.max_open_events:
+            self.close_event(self.open_events.popitem(last=False)[1])
+
+    def add_chunk_numpy(self, columns: dict) -> None:
+        names, name_idx = np.unique(np.array(columns["operation"]), return_inverse=True)
+        name_codes = np.array([self.operation_code(name) for name in names.tolist()])
+        codes = name_codes[name_idx]
+        k = len(self.operation_names)
+        x = np.asarray(columns["doc_size"], dtype=np.float64)
+        y = np.asarray(columns["ru"], dtype=np.float64)
+        chunk_sums = [
+            np.bincount(codes, minlength=k),
+            np.bincount(codes, weights=x, minlength=k),
+            np.bincount(codes, weights=y, minlength=k),
+            np.bincount(codes, weights=x * x, minlength=k),
+            np.bincount(codes, weights=x * y, minlength=k),
+            np.bincount(codes, weights=y * y, minlength=k),
+        ]
+        for code in np.nonzero(chunk_sums[0])[0].tolist():
+            sums = self.sums[code]
+            for i in range(len(sums)):
+                sums[i] = sums[i] + float(chunk_sums[i][code])
+
+        # the per-event sums, in the order of each event's first operation
+        event_ids, first_idx, event_idx = np.unique(
+            np.array(columns["event_id"]), return_index=True, return_inverse=True)
+        event_ru = np.bincount(event_idx, weights=y)
+        event_ops = np.bincount(event_idx)
+        changed = np.array(self.changed_codes)[codes]
+        event_changed = np.bincount(event_idx, weights=changed)
+        event_ids = event_ids.tolist()
+        for i in np.argsort(first_idx, kind="stable").tolist():
+            self.merge_event(
+                event_ids[i], float(event_ru[i]), int(event_ops[i]), event_changed[i] > 0)
+
+    def add_chunk_python(self, columns: dict) -> None:
+        operation_code = self.operation_code
+        for event_id, name, ru, size in zip(
+            columns["event_id"], columns["operation"], columns["ru"], columns["doc_size"]
+        ):
+            code = operation_code(name)
+            sums = self.sums[code]
+            sums[0] = sums[0] + 1
+            sums[1] = sums[1] + size
+            sums[2] = sums[2] + ru
+            sums[3] = sums[3] + (size * size)
+            sums[4] = sums[4] + (size * ru)
+            sums[5] = sums[5] + (ru * ru)
+            self.merge_event(event_id, ru, 1, self.changed_codes[code] == 1)
+
+    def merge_event(self, event_id: str, ru: float, op_count: int, changed: bool) -> None:
+        event = self.open_events.get(event_id, None)
+        if event is None:
+            self.open_events[event_id] = [ru, op_count, changed]
+        else:
+            event[0] = event[0] + ru
+            event[1] = event[1] + op_count
+            event[2] = event[2] or changed
+
+    def close_event(self, event: list) -> None:
+        self.event_histograms["all"].record(event[0])
+        if event[2]:
+            self.event_histograms["changed"].record(event[0])
+        else:
+            self.event_histograms["unchanged"].record(event[0])
+
+    def finish(self) -> None:
+        """Close the open events; call this after the last chunk."""
+        while len(self.open_events) > 0:
+            self.close_event(self.open_events.popitem(last=False)[1])
+
+    def fit(self, code: int) -> dict:
+        """Return the least squares fit of RU = intercept + slope * doc_size for an operation."""
+        n, sx, sy, sxx, sxy, syy = self.sums[code]
+        fit = dict()
+        fit["count"] = int(n)
+        fit["mean_ru"] = sy / n
+        fit["mean_doc_size"] = sx / n
+        var_x = sxx - ((sx * sx) / n)
+        var_y = syy - ((sy * sy) / n)
+        cov = sxy - ((sx * sy) / n)
+        slope = cov / var_x if var_x > 1e-9 * max(1.0, sxx) else 0.0
+        fit["intercept_ru"] = (sy - (slope * sx)) / n
+        fit["ru_per_kb"] = slope * 1024.0
+        if var_y <= 1e-9 * max(1.0, syy):
+            fit["r2"] = 1.0  # a constant RU is fit exactly
+        elif slope == 0.0:
+            fit["r2"] = 0.0
+        else:
+            fit["r2"] = min(1.0, (cov * cov) / (var_x * var_y))
+        return fit
+
+    def fits(self) -> dict:
+        data = dict()
+        for name in sorted(self.operation_names):
+            data[name] = self.fit(self.operation_codes[name])
+        return data
+
+    def capacity_report(
+        self,
+        events_per_second: float,
+        change_rate: float = None,
+        headroom: float = 1.2,
+        readme_ru_estimates: dict = None,
+    ) -> dict:
+        """
+        Project the RU/s required for the given events per second and change
+        rate (the fraction of 'changed' events; default the observed rate),
+        from the mean RU of the changed and unchanged events.  The headroom
+        multiplies the projection for the recommended provisioned throughput.
+        """
+        histograms = self.event_histograms
+        event_count = histograms["all"].count
+        observed_change_rate = 0.0
+        if event_count > 0:
+            observed_change_rate = histograms["changed"].count / event_count
+        if change_rate is None:
+            change_rate = observed_change_rate
+        mean_changed = histograms["changed"].mean()
+        mean_unchanged = histograms["unchanged"].mean()
+        if histograms["changed"].count == 0:
+            mean_changed = histograms["all"].mean()
+        if histograms["unchanged"].count == 0:
+            mean_unchanged = histograms["all"].mean()
+        mean_event_ru = ((1.0 - change_rate) * mean_unchanged) + (change_rate * mean_changed)
+        projected = events_per_second * mean_event_ru
+
+        report = dict()
+        report["rows"] = self.rows
+        report["chunks"] = self.chunks
+        report["events"] = event_count
+        report["observed_change_rate"] = observed_change_rate
+        report["events_per_second"] = events_per_second
+        report["change_rate"] = change_rate
+        report["headroom"] = headroom
+        report["mean_event_ru"] = mean_event_ru
+        report["projected_ru_per_second"] = projected
+        report["recommended_manual_ru_per_second"] = max(
+            400, int(math.ceil((projected * headroom) / 100.0)) * 100)
+        report["recommended_autoscale_max_ru_per_second"] = max(
+            1000, int(math.ceil((projected * headroom) / 1000.0)) * 1000)
+        if readme_ru_estimates is not None:
+            readme_mean = ((1.0 - change_rate) * readme_ru_estimates["minimum"]) + (
+                change_rate * readme_ru_estimates["with_updates"])
+            report["readme_mean_event_ru"] = readme_mean
+            report["readme_ru_per_second"] = events_per_second * readme_mean
+        report["event_ru"] = dict()
+        for name in ["all", "changed", "unchanged"]:
+            report["event_ru"][name] = histograms[name].summary()
+
+        # the projected RU/s per operation type, at the observed operation mix
+        operations = dict()
+        fits = self.fits()
+        for name, fit in fits.items():
+            entry = dict(fit)
+            entry["per_event"] = 0.0 if event_count == 0 else fit["count"] / event_count
+            entry["ru_per_second"] = events_per_second * entry["per_event"] * fit["mean_ru"]
+            operations[name] = entry
+        report["operations"] = operations
+        return report
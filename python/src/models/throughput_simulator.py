@@ -0,0 +1,294 @@
+import heapq
+import math
+import random
+import zlib
+
+from src.models.partition_key_strategy import PartitionKeyStrategy
+from src.util.histogram import Histogram
+from src.util.operations_log import OperationsLog
+
+# Instances of this class are discrete-event simulations of a container's
+# provisioned throughput, to predict the throttling and the latency of a
+# workload before changing the RU/s or the partitioning of a container.
+#
+# The provisioned RU/s are split evenly over the physical partitions, each
+# a token bucket that refills at its share of the RU/s, up to burst_seconds
+# of it.  As in Cosmos DB, a request is admitted while its partition's
+# budget isn't exhausted, and may overdraw it; otherwise it gets a 429
+# response and is retried after the time until the budget is positive
+# again.  The logical partition keys are hashed to the physical partitions,
+# so a few hot keys, or a partition key with few values, concentrate the
+# RU on a few partitions.
+#
+# The requests are (arrival seconds, did, ru) tuples, from a recorded
+# operations log (see method log_requests) or a DeviceEventGenerator
+# (see method synthetic_requests).
+
+
+class ThroughputSimulator:
+
+    # the RU/s limit of a physical partition
+    max_partition_ru = 10_000
+
+    # partition scheme name -> function of a did, arrival seconds, and request
+    # sequence number that returns the partition key; PartitionKeyStrategy
+    # specs, such as 'did_hash:8', are also schemes
+    partition_schemes = {
+        "did": lambda did, t, seq: did,
+        "first_letter": lambda did, t, seq: did[0:1],
+    }
+
+    def __init__(
+        self,
+        provisioned_ru: float,
+        physical_partitions: int = None,
+        scheme: str = "did",
+        burst_seconds: float = 1.0,
+        max_retries: int = 9,
+        latency_ms: float = 5.0,
+        interval_seconds: float = 1.0,
+    ):
+        """
+        The physical_partitions default is the number required for the
+        provisioned_ru, at max_partition_ru each.  A request that is still
+        throttled after max_retries retries fails, as it does in the SDK.
+        The curves are reported per interval_seconds.
+        """
+        if provisioned_ru <= 0:
+            raise ValueError("provisioned_ru must be positive")
+        if physical_partitions is None:
+            physical_partitions = int(math.ceil(provisioned_ru / ThroughputSimulator.max_partition_ru))
+        self.provisioned_ru = provisioned_ru
+        self.physical_partitions = max(1, physical_partitions)
+        self.scheme = scheme
+        if scheme in ThroughputSimulator.partition_schemes:
+            self.partition_key = ThroughputSimulator.partition_schemes[scheme]
+        else:
+            self.partition_key = PartitionKeyStrategy.parse(scheme).key_for
+        self.partition_rate = provisioned_ru / self.physical_partitions
+        self.burst_ru = self.partition_rate * burst_seconds
+        self.max_retries = max_retries
+        self.latency_ms = latency_ms
+        self.interval_seconds = interval_seconds
+        self.partition_indexes = dict()  # partition key -> physical partition index
+        self.reset()
+
+    def reset(self) -> None:
+        n = self.physical_partitions
+        self.tokens = [self.burst_ru] * n
+        self.refill_times = [0.0] * n
+        self.partition_demand = [0.0] * n  # the RU of the requests, throttled or not
+        self.partition_ru = [0.0] * n
+        self.partition_requests = [0] * n
+        self.partition_throttled = [0] * n
+        self.partition_keys = [set() for i in range(n)]
+        self.key_ru = dict()  # partition key -> RU
+        self.retries = list()  # heap of (time, seq, attempt, arrival, partition, ru)
+        self.intervals = list()
+        self.latency_histogram = Histogram()
+        self.requests = 0
+        self.attempts = 0
+        self.throttled = 0
+        self.failed = 0
+        self.total_ru = 0.0
+        self.last_time = 0.0
+        self.seq = 0
+
+    def physical_partition(self, key: str) -> int:
+        """
+        Return the physical partition index of the given partition key; its
+        hash range, as the partitions split the hash space evenly.
+        """
+        idx = self.partition_indexes.get(key, None)
+        if idx is None:
+            idx = (zlib.crc32(key.encode("utf-8")) * self.physical_partitions) >> 32
+            self.partition_indexes[key] = idx
+        return idx
+
+    def interval(self, t: float) -> dict:
+        idx = int(t / self.interval_seconds)
+        while len(self.intervals) <= idx:
+            entry = dict()
+            entry["start_seconds"] = len(self.intervals) * self.interval_seconds
+            entry["arrivals"] = 0
+            entry["attempts"] = 0
+            entry["throttled"] = 0
+            entry["completed"] = 0
+            entry["failed"] = 0
+            entry["ru"] = 0.0
+            entry["backlog"] = 0
+            entry["latency"] = Histogram()
+            self.intervals.append(entry)
+        return self.intervals[idx]
+
+    def run(self, requests) -> dict:
+        """Simulate the given iterable of (arrival seconds, did, ru) requests, and return get_stats."""
+        self.reset()
+        retries = self.retries
+        for arrival, did, ru in requests:
+            while len(retries) > 0 and retries[0][0] <= arrival:
+                t, seq, attempt, first_arrival, partition, retry_ru = heapq.heappop(retries)
+                self.attempt(t, attempt, first_arrival, partition, retry_ru)
+            key = self.partition_key(did, arrival, self.requests)
+            partition = self.physical_partition(key)
+            self.requests = self.requests + 1
+            self.key_ru[key] = self.key_ru.get(key, 0.0) + ru
+            self.partition_demand[partition] += ru
+            self.partition_keys[partition].add(key)
+            self.interval(arrival)["arrivals"] += 1
+            self.attempt(arrival, 0, arrival, partition, ru)
+        while len(retries) > 0:
+            t, seq, attempt, first_arrival, partition, retry_ru = heapq.heappop(retries)
+            self.attempt(t, attempt, first_arrival, partition, retry_ru)
+        return self.get_stats()
+
+    def attempt(self, t: float, attempt: int, arrival: float, partition: int, ru: float) -> None:
+        self.attempts = self.attempts + 1
+        self.last_time = max(self.last_time, t)
+        interval = self.interval(t)
+        interval["attempts"] += 1
+        interval["backlog"] = max(interval["backlog"], len(self.retries))
+        self.partition_requests[partition] += 1
+        rate = self.partition_rate
+        tokens = min(self.burst_ru, self.tokens[partition] + ((t - self.refill_times[partition]) * rate))
+        self.refill_times[partition] = t
+        if tokens > 0:
+            self.tokens[partition] = tokens - ru
+            self.partition_ru[partition] += ru
+            self.total_ru = self.total_ru + ru
+            interval["ru"] += ru
+            interval["completed"] += 1
+            self.record_latency(interval, t, arrival)
+            return
+        self.tokens[partition] = tokens
+        self.throttled = self.throttled + 1
+        self.partition_throttled[partition] += 1
+        interval["throttled"] += 1
+        if attempt >= self.max_retries:
+            self.failed = self.failed + 1
+            interval["failed"] += 1
+            self.record_latency(interval, t, arrival)
+            return
+        # the retry-after time, until the budget is positive again
+        retry_after = (-tokens / rate) + 0.001
+        self.seq = self.seq + 1
+        heapq.heappush(self.retries, (t + retry_after, self.seq, attempt + 1, arrival, partition, ru))
+
+    def record_latency(self, interval: dict, t: float, arrival: float) -> None:
+        ms = ((t - arrival) * 1000.0) + self.latency_ms
+        self.latency_histogram.record(ms)
+        interval["latency"].record(ms)
+
+    def get_stats(self) -> dict:
+        stats = dict()
+        stats["scheme"] = self.scheme
+        stats["provisioned_ru"] = self.provisioned_ru
+        stats["physical_partitions"] = self.physical_partitions
+        stats["partition_ru_per_second"] = self.partition_rate
+        stats["requests"] = self.requests
+        stats["attempts"] = self.attempts
+        stats["throttled"] = self.throttled
+        stats["failed"] = self.failed
+        stats["throttled_pct"] = 0.0 if self.attempts == 0 else 100.0 * self.throttled / self.attempts
+        stats["failed_pct"] = 0.0 if self.requests == 0 else 100.0 * self.failed / self.requests
+        stats["simulated_seconds"] = self.last_time
+        stats["ru_per_second"] = 0.0 if self.last_time <= 0 else self.total_ru / self.last_time
+        stats["latency_ms"] = self.latency_histogram.summary()
+
+        # the concentration of the requested RU on the physical and logical partitions
+        demand = sum(self.partition_demand)
+        stats["partition_keys"] = len(self.key_ru)
+        stats["hot_partition_ratio"] = 0.0
+        stats["hottest_key_ru_share"] = 0.0
+        if demand > 0:
+            stats["hot_partition_ratio"] = max(self.partition_demand) * self.physical_partitions / demand
+            stats["hottest_key_ru_share"] = max(self.key_ru.values()) / demand
+        partitions = list()
+        for idx in range(self.physical_partitions):
+            entry = dict()
+            entry["partition"] = idx
+            entry["partition_keys"] = len(self.partition_keys[idx])
+            entry["demand_ru"] = self.partition_demand[idx]
+            entry["ru"] = self.partition_ru[idx]
+            entry["utilization"] = 0.0
+            if self.last_time > 0:
+                entry["utilization"] = self.partition_demand[idx] / (self.partition_rate * self.last_time)
+            entry["attempts"] = self.partition_requests[idx]
+            entry["throttled"] = self.partition_throttled[idx]
+            partitions.append(entry)
+        stats["partitions"] = partitions
+
+        curves = list()
+        for interval in self.intervals:
+            entry = dict(interval)
+            entry["throttled_pct"] = 0.0
+            if interval["attempts"] > 0:
+                entry["throttled_pct"] = 100.0 * interval["throttled"] / interval["attempts"]
+            entry["ru_per_second"] = interval["ru"] / self.interval_seconds
+            entry["p50_ms"] = interval["latency"].percentile(50)
+            entry["p99_ms"] = interval["latency"].percentile(99)
+            del entry["latency"]
+            curves.append(entry)
+        stats["curves"] = curves
+        return stats
+
+    @classmethod
+    def compare_schemes(cls, requests_function, schemes: list, provisioned_ru: float, **kwargs) -> dict:
+        """
+        Simulate the requests returned by the given function, called once per
+        scheme, with each of the given partition schemes; return scheme -> stats.
+        """
+        results = dict()
+        for scheme in schemes:
+            simulator = ThroughputSimulator(provisioned_ru, scheme=scheme, **kwargs)
+            results[scheme] = simulator.run(requests_function())
+        return results
+
+    @classmethod
+    def arrival_times(cls, events_per_second: float, arrivals: str = "constant", seed: int = 42):
+        """Yield the arrival seconds of events at the given rate; evenly spaced or Poisson."""
+        if arrivals not in ["poisson", "constant"]:
+            raise ValueError("unknown arrivals: {}".format(arrivals))
+        rng = random.Random(seed)
+        t = 0.0
+        while True:
+            yield t
+            if arrivals == "poisson":
+                t = t + rng.expovariate(events_per_second)
+            else:
+                t = t + (1.0 / events_per_second)
+
+    @classmethod
+    def log_requests(cls, paths: list, events_per_second: float, arrivals: str = "constant", seed: int = 42):
+        """
+        Yield the requests of the given operations log files, replayed at the
+        given events per second; the operations of an event arrive together.
+        """
+        times = cls.arrival_times(events_per_second, arrivals, seed)
+        event_id, t = None, 0.0
+        for path in paths:
+            for entry in OperationsLog.read(path):
+                if entry["event_id"] != event_id:
+                    event_id = entry["event_id"]
+                    t = next(times)
+                yield t, entry["did"], entry["ru"]
+
+    @classmethod
+    def synthetic_requests(
+        cls,
+        generator,
+        event_count: int,
+        events_per_second: float,
+        unchanged_ru: float,
+        changed_ru: float,
+        arrivals: str = "constant",
+    ):
+        """
+        Yield a request per event of the given DeviceEventGenerator, with the
+        given RU for the events without and with a changed attribute.
+        """
+        times = cls.arrival_times(events_per_second, arrivals, generator.seed)
+        dids = generator.pool_list("deviceIDs")
+        for batch in generator.batches(event_count):
+            for device, changes in zip(batch.column("device"), batch.column("changes")):
+                yield next(times), dids[device], changed_ru if changes != 0 else unchanged_ru
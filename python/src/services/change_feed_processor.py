@@ -0,0 +1,239 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import traceback
+import zlib
+
+from src.util.counter import Counter
+
+# Instances of these classes read the change feed of a container, such as
+# DeviceState, and pass each page of changed documents to an async batch
+# function; this is the logic that an Azure Function with a Cosmos DB
+# trigger would implement.
+#
+# The feed ranges are read in parallel, and the continuation token of each
+# range is checkpointed in a LeaseStore after its batch has been processed,
+# so processing resumes where it stopped (at-least-once).  A failed batch
+# is retried up to max_batch_attempts times, then dead-lettered and skipped,
+# so one poison batch can't stall its range forever.  The feed source
+# is either a CosmosNoSQLService, or a LocalChangeFeed for testing; both
+# implement methods read_feed_ranges and read_change_feed_page.
+
+
+class LeaseStore:
+    """
+    The checkpointed continuation token per feed range, optionally
+    persisted to the given JSON file.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.leases = dict()  # lease key -> dict with the continuation
+        if path is not None and os.path.isfile(path):
+            with open(path, "rt", encoding="utf-8") as f:
+                self.leases = json.loads(f.read())
+
+    @classmethod
+    def lease_key(cls, feed_range) -> str:
+        """The lease key of a feed range; feed ranges are dicts, or strings."""
+        if isinstance(feed_range, str):
+            return feed_range
+        return json.dumps(feed_range, sort_keys=True)
+
+    def get_continuation(self, key: str):
+        lease = self.leases.get(key, None)
+        if lease is None:
+            return None
+        return lease["continuation"]
+
+    def checkpoint(self, key: str, continuation) -> None:
+        lease = dict()
+        lease["continuation"] = continuation
+        lease["checkpoint_time"] = time.time()
+        self.leases[key] = lease
+        self.save()
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        # write-then-rename, so a crash can't leave a partial lease file
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "wt", encoding="utf-8") as f:
+            f.write(json.dumps(self.leases, sort_keys=True, indent=2))
+        os.replace(tmp_path, self.path)
+
+
+class LocalChangeFeed:
+    """
+    An in-memory stand-in for a container's change feed, for tests and
+    local simulations.  Documents are assigned to feed ranges by a hash of
+    their partition key, and each range returns its documents in order.
+    """
+
+    def __init__(self, range_count: int = 4):
+        self.ranges = list()
+        for i in range(range_count):
+            self.ranges.append(list())
+
+    def append(self, doc: dict, pk) -> None:
+        idx = zlib.crc32(str(pk).encode("utf-8")) % len(self.ranges)
+        self.ranges[idx].append(dict(doc))
+
+    async def read_feed_ranges(self) -> list:
+        return ["range-{}".format(i) for i in range(len(self.ranges))]
+
+    async def read_change_feed_page(
+        self, feed_range=None, continuation=None, max_item_count=100, start_time="Beginning"
+    ) -> dict:
+        docs = self.ranges[int(feed_range.split("-")[1])]
+        if continuation is not None:
+            start = int(continuation)
+        elif start_time == "Now":
+            start = len(docs)
+        else:
+            start = 0
+        items = docs[start : start + max_item_count]
+        result = dict()
+        result["items"] = items
+        result["item_count"] = len(items)
+        result["ru"] = 0.0
+        result["continuation"] = str(start + len(items))
+        return result
+
+
+class ChangeFeedProcessor:
+
+    def __init__(
+        self,
+        feed_source,
+        lease_store: LeaseStore,
+        process_batch,
+        max_item_count: int = 100,
+        poll_interval_seconds: float = 1.0,
+        start_time: str = "Beginning",
+        max_batch_attempts: int = 5,
+        retry_interval_seconds: float = 0.1,
+        dead_letter_path: str = None,
+    ):
+        """
+        The process_batch argument is an async function that is called with
+        the lease key of a feed range and a list of its changed documents.
+        The start_time ("Beginning" or "Now") applies to ranges without a lease.
+        A batch that fails max_batch_attempts times is logged, appended to
+        the optional dead_letter_path NDJSON file, and checkpointed past.
+        """
+        self.feed_source = feed_source
+        self.lease_store = lease_store
+        self.process_batch = process_batch
+        self.max_item_count = max_item_count
+        self.poll_interval_seconds = poll_interval_seconds
+        self.start_time = start_time
+        self.max_batch_attempts = max(1, max_batch_attempts)
+        self.retry_interval_seconds = retry_interval_seconds
+        self.dead_letter_path = dead_letter_path
+        self.failing = dict()  # lease key -> the failed attempts of its current batch
+        self.counter = Counter()
+        self.request_charge = 0.0
+
+    async def run_once(self) -> int:
+        """
+        Read and process one page of each feed range in parallel, and
+        return the number of changed documents processed.
+        """
+        feed_ranges = await self.feed_source.read_feed_ranges()
+        counts = await asyncio.gather(
+            *[self.process_range(feed_range) for feed_range in feed_ranges]
+        )
+        return sum(counts)
+
+    async def process_range(self, feed_range) -> int:
+        key = LeaseStore.lease_key(feed_range)
+        continuation = self.lease_store.get_continuation(key)
+        page = await self.feed_source.read_change_feed_page(
+            feed_range=feed_range,
+            continuation=continuation,
+            max_item_count=self.max_item_count,
+            start_time=self.start_time,
+        )
+        self.counter.increment("pages")
+        self.request_charge = self.request_charge + page["ru"]
+        docs = page["items"]
+        if len(docs) > 0:
+            try:
+                await self.process_batch(key, docs)
+                self.counter.increment_by("documents", len(docs))
+                self.counter.increment("batches")
+                self.failing.pop(key, None)
+            except Exception as e:
+                self.counter.increment("batch_failures")
+                logging.info(str(e))
+                logging.info(traceback.format_exc())
+                attempts = self.failing.get(key, 0) + 1
+                if attempts < self.max_batch_attempts:
+                    # don't checkpoint, so the batch is retried in the next run
+                    self.failing[key] = attempts
+                    return 0
+                self.dead_letter(key, continuation, docs, e)
+                self.failing.pop(key, None)
+                docs = list()
+        if page["continuation"] is not None and page["continuation"] != continuation:
+            self.lease_store.checkpoint(key, page["continuation"])
+        return len(docs)
+
+    def dead_letter(self, key: str, continuation, docs: list, exception: Exception) -> None:
+        """Record a batch that failed max_batch_attempts times; it's then skipped."""
+        self.counter.increment("dead_lettered_batches")
+        self.counter.increment_by("dead_lettered_documents", len(docs))
+        logging.info("ChangeFeedProcessor dead-lettered {} documents of lease {} at {}: {}".format(
+            len(docs), key, continuation, str(exception)))
+        if self.dead_letter_path is not None:
+            entry = dict()
+            entry["lease_key"] = key
+            entry["continuation"] = continuation
+            entry["error"] = str(exception)
+            entry["docs"] = docs
+            with open(self.dead_letter_path, "at", encoding="utf-8") as f:
+                f.write(json.dumps(entry))
+                f.write("\n")
+
+    async def run_until_idle(self) -> int:
+        """
+        Process pages until the change feed has no more changes and no range
+        has a failed batch pending retry; return the count processed.
+        """
+        total = 0
+        while True:
+            count = await self.run_once()
+            total = total + count
+            if count == 0:
+                if len(self.failing) == 0:
+                    return total
+                await asyncio.sleep(self.retry_interval_seconds)
+
+    async def run(self, stop_event: asyncio.Event) -> None:
+        """
+        Poll the change feed until the given event is set, then process
+        the remaining changes and return.
+        """
+        while not stop_event.is_set():
+            count = await self.run_once()
+            if count == 0:
+                try:
+                    await asyncio.wait_for(stop_event.wait(), self.poll_interval_seconds)
+                except asyncio.TimeoutError:
+                    pass
+        await self.run_until_idle()
+
+    def get_stats(self) -> dict:
+        stats = dict()
+        stats["pages"] = self.counter.get_value("pages")
+        stats["batches"] = self.counter.get_value("batches")
+        stats["documents"] = self.counter.get_value("documents")
+        stats["batch_failures"] = self.counter.get_value("batch_failures")
+        stats["failing_ranges"] = len(self.failing)
+        stats["dead_lettered_batches"] = self.counter.get_value("dead_lettered_batches")
+        stats["dead_lettered_documents"] = self.counter.get_value("dead_lettered_documents")
+        stats["request_charge"] = self.request_charge
+        return stats
@@ -92,6 +92,55 @@ class ConfigService:
                 return True
         return False
 
+    @classmethod
+    def arg_value(cls, flag: str, default: str = None) -> str:
+        """
+        Return the command-line value that follows the given flag,
+        such as 'abc' in '--token abc', or the given default value.
+        """
+        for idx, arg in enumerate(sys.argv):
+            if arg == flag:
+                if idx + 1 < len(sys.argv):
+                    return sys.argv[idx + 1]
+                return default
+        return default
+
+    @classmethod
+    def int_arg(cls, flag: str, default: int = -1) -> int:
+        """
+        Return the int value that follows the given flag in the command-line,
+        such as '--workers 4', or the given default value.
+        """
+        value = cls.arg_value(flag)
+        if value is not None:
+            try:
+                return int(value)
+            except Exception as e:
+                logging.error(
+                    "int_arg error for flag: {} -> {}; returning default.".format(
+                        flag, value
+                    )
+                )
+        return default
+
+    @classmethod
+    def float_arg(cls, flag: str, default: float = -1.0) -> float:
+        """
+        Return the float value that follows the given flag in the command-line,
+        such as '--latency-ms 2.5', or the given default value.
+        """
+        value = cls.arg_value(flag)
+        if value is not None:
+            try:
+                return float(value)
+            except Exception as e:
+                logging.error(
+                    "float_arg error for flag: {} -> {}; returning default.".format(
+                        flag, value
+                    )
+                )
+        return default
+
     @classmethod
     def defined_environment_variables(cls) -> dict:
         """
@@ -105,6 +154,10 @@ class ConfigService:
         d["COSMOSDB_NOSQL_KEY"] = "The key of your Cosmos DB NoSQL account"
         d["COSMOSDB_NOSQL_DB"] = "Your Cosmos DB NoSQL database name"
         d["COSMOSDB_NOSQL_CONTAINER"] = "Your Cosmos DB NoSQL container name"
+        d["DEVICE_DATA_SEED"] = "The random seed of the generated device data pools; default 42"
+        d["DEVICE_DATA_CACHE_DIR"] = (
+            "The directory of the cached device data pool files; default tmp/cache"
+        )
         d["LOG_LEVEL"] = (
             "a python logging standard-lib level name: notset, debug, info, warning, error, or critical"
         )
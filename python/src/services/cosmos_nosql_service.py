@@ -1,12 +1,26 @@
+import asyncio
+import copy
 import json
 import logging
+import time
 import traceback
 import uuid
 
+from azure.core import MatchConditions
 from azure.cosmos.aio import CosmosClient
+from azure.cosmos.exceptions import (
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
 from azure.identity import ClientSecretCredential, DefaultAzureCredential
 
 from src.services.config_service import ConfigService
+from src.util.counter import Counter
+from src.util.operation_metrics import (
+    OperationCapture,
+    OperationMetrics,
+    last_operation_capture,
+)
 
 # Chris Joakim, Microsoft
 
@@ -17,6 +31,9 @@ azure_logger.setLevel(logging.WARNING)
 
 LAST_REQUEST_CHARGE_HEADER = "x-ms-request-charge"
 
+# the Cosmos DB partial document update (patch) operation types
+PATCH_OPERATION_TYPES = ["add", "set", "replace", "remove", "incr"]
+
 
 class CosmosNoSQLService:
 
@@ -29,6 +46,17 @@ class CosmosNoSQLService:
         self._ctrproxy = None
         self._cname = None
         self._client = None
+        # per-operation telemetry; an OperationMetrics may be shared via opts
+        if "metrics" in opts.keys():
+            self.metrics = opts["metrics"]
+        else:
+            self.metrics = OperationMetrics()
+        # single-flight point-reads; concurrent reads of the same (id, pk)
+        # share one in-flight request, see method point_read
+        self._single_flight = opts.get("single_flight_reads", True)
+        self._inflight_reads = dict()  # (id, pk) -> [future, follower_count]
+        self.single_flight_counter = Counter()
+        self._container_services = dict()  # cname -> CosmosNoSQLService
         logging.info("CosmosNoSQLService - constructor")
 
     async def initialize(self):
@@ -62,8 +90,11 @@ class CosmosNoSQLService:
     async def list_databases(self):
         """Return the list of database names in the account."""
         dblist = list()
-        async for db in self._client.list_databases():
-            dblist.append(db["id"])
+        with self.metrics.capture("list_databases") as capture:
+            async for db in self._client.list_databases(
+                response_hook=capture.response_hook
+            ):
+                dblist.append(db["id"])
         return dblist
 
     def set_db(self, dbname):
@@ -79,30 +110,278 @@ class CosmosNoSQLService:
     def get_current_cname(self):
         return self._cname
 
+    def current_ctrproxy(self):
+        return self._ctrproxy
+
     def set_container(self, cname):
         """Set the current container in the current database to the given cname."""
         self._cname = cname
         self._ctrproxy = self._dbproxy.get_container_client(cname)
         return self._ctrproxy  # <class 'azure.cosmos.aio._container.ContainerProxy'>
 
+    def for_container(self, cname):
+        """
+        Return a CosmosNoSQLService for the given container in the current
+        database.  It shares this service's client and metrics, so several
+        containers can be used concurrently without calling set_container
+        back and forth.  Only the original service should be closed.
+        """
+        if cname not in self._container_services.keys():
+            svc = copy.copy(self)
+            svc._inflight_reads = dict()
+            svc._container_services = dict()
+            svc.set_container(cname)
+            self._container_services[cname] = svc
+        return self._container_services[cname]
+
     async def list_containers(self):
         """Return the list of container names in the current database."""
         container_list = list()
-        async for container in self._dbproxy.list_containers():
-            container_list.append(container["id"])
+        with self.metrics.capture("list_containers") as capture:
+            async for container in self._dbproxy.list_containers(
+                response_hook=capture.response_hook
+            ):
+                container_list.append(container["id"])
         return container_list
 
     async def point_read(self, id, pk):
-        return await self._ctrproxy.read_item(item=id, partition_key=pk)
+        """
+        Read the document with the given id and pk.  If a read of the same
+        (id, pk) is already in flight, this call waits for and shares its
+        result rather than issuing a duplicate request.  The coalesced callers
+        each get their own copy of the document, and no RU are charged to them.
+        The shared read runs in its own task, so a cancelled caller doesn't
+        cancel the read of the other callers.
+        """
+        if self._single_flight == False:
+            return await self._point_read(id, pk)
+        key = (id, pk)
+        if key in self._inflight_reads.keys():
+            inflight = self._inflight_reads[key]
+            inflight[1] = inflight[1] + 1
+            self.single_flight_counter.increment("coalesced")
+            try:
+                with self.metrics.capture("point_read_coalesced"):
+                    doc = await asyncio.shield(inflight[0])
+            finally:
+                inflight[1] = inflight[1] - 1
+            return copy.deepcopy(doc)
+
+        inflight = [None, 0, None]  # the read task, the waiting followers, and its capture
+        inflight[0] = asyncio.create_task(self._shared_point_read(id, pk, inflight))
+        self._inflight_reads[key] = inflight
+        inflight[0].add_done_callback(lambda task: self._end_inflight_read(key, inflight))
+        self.single_flight_counter.increment("requests")
+        try:
+            doc = await asyncio.shield(inflight[0])
+        except asyncio.CancelledError:
+            if inflight[1] == 0 and not inflight[0].done():
+                # no other caller is waiting for it; end it now, so that a
+                # later caller starts a new read rather than joining this one
+                self._end_inflight_read(key, inflight)
+                inflight[0].cancel()
+            raise
+        finally:
+            if inflight[2] is not None:
+                last_operation_capture.set(inflight[2])  # for last_request_charge in this task
+        if inflight[1] > 0:
+            return copy.deepcopy(doc)  # the followers copy the same doc
+        return doc
+
+    def _end_inflight_read(self, key: tuple, inflight: list) -> None:
+        """Stop coalescing point_read calls onto the given read, unless it was already replaced."""
+        if self._inflight_reads.get(key, None) is inflight:
+            self._inflight_reads.pop(key)
+
+    async def _shared_point_read(self, id, pk, inflight: list):
+        try:
+            return await self._point_read(id, pk)
+        finally:
+            inflight[2] = last_operation_capture.get()
+
+    async def _point_read(self, id, pk):
+        with self.metrics.capture("point_read") as capture:
+            return await self._ctrproxy.read_item(
+                item=id, partition_key=pk, response_hook=capture.response_hook
+            )
+
+    def single_flight_stats(self) -> dict:
+        """
+        Return the number of point-read requests issued, and the number of
+        point_read calls that were coalesced onto an in-flight request.
+        """
+        stats = dict()
+        stats["requests"] = self.single_flight_counter.get_value("requests")
+        stats["coalesced"] = self.single_flight_counter.get_value("coalesced")
+        return stats
+
+    async def read_many(self, items: list, max_concurrency=16, max_ids_per_query=100):
+        """
+        Read the given list of (id, pk) tuples in one call.  The items are
+        grouped by partition key; a partition with a single id is fetched with
+        a point-read, otherwise its ids are fetched with single-partition
+        queries of up to max_ids_per_query ids each.  At most max_concurrency
+        of these requests are in flight at once.
+        Return a dict with these keys:
+          docs - a dict of the found documents keyed by their (id, pk) tuple
+          missing - the list of (id, pk) tuples that weren't found
+          errors - a list of error messages for requests that failed
+          ru - the aggregate request charge of all requests
+          request_count - the number of requests (point-reads or query pages)
+          elapsed_time - the elapsed seconds of this call
+        Afterwards last_request_charge also returns the aggregate charge.
+        """
+        start_time = time.time()
+        ids_by_pk = dict()
+        for id, pk in items:
+            if pk not in ids_by_pk.keys():
+                ids_by_pk[pk] = dict()
+            ids_by_pk[pk][id] = 1  # a dict rather than a set to preserve order
+
+        result = dict()
+        result["docs"] = dict()
+        result["missing"] = list()
+        result["errors"] = list()
+        result["ru"] = 0.0
+        result["request_count"] = 0
+        semaphore = asyncio.Semaphore(max_concurrency)
+        tasks = list()
+        for pk in ids_by_pk.keys():
+            ids = list(ids_by_pk[pk].keys())
+            for idx in range(0, len(ids), max_ids_per_query):
+                chunk = ids[idx : idx + max_ids_per_query]
+                tasks.append(self._read_many_in_partition(chunk, pk, semaphore, result))
+        await asyncio.gather(*tasks)
+        total = OperationCapture("read_many")
+        total.request_charge = result["ru"]
+        last_operation_capture.set(total)  # not recorded; its requests were
+
+        for pk in ids_by_pk.keys():
+            for id in ids_by_pk[pk].keys():
+                if (id, pk) not in result["docs"]:
+                    result["missing"].append((id, pk))
+        result["elapsed_time"] = time.time() - start_time
+        return result
+
+    async def _read_many_in_partition(self, ids, pk, semaphore, result):
+        """Private method to fetch the given ids in one partition for read_many()."""
+        async with semaphore:
+            try:
+                if len(ids) == 1:
+                    try:
+                        doc = await self.point_read(ids[0], pk)
+                        result["docs"][(doc["id"], pk)] = doc
+                    except CosmosResourceNotFoundError as e:
+                        pass
+                    result["ru"] = result["ru"] + self.last_request_charge()
+                    result["request_count"] = result["request_count"] + 1
+                else:
+                    sql = "select * from c where array_contains(@ids, c.id)"
+                    parameters = [{"name": "@ids", "value": ids}]
+                    async for page in self.query_pages(
+                        sql, parameters, page_size=len(ids), pk=pk
+                    ):
+                        for doc in page["items"]:
+                            result["docs"][(doc["id"], pk)] = doc
+                        result["ru"] = result["ru"] + page["ru"]
+                        result["request_count"] = result["request_count"] + 1
+            except Exception as e:
+                logging.info(str(e))
+                result["errors"].append("pk: {}, ids: {} -> {}".format(pk, ids, str(e)))
 
     async def create_item(self, doc):
-        return await self._ctrproxy.create_item(body=doc)
+        with self.metrics.capture("create_item") as capture:
+            return await self._ctrproxy.create_item(
+                body=doc, response_hook=capture.response_hook
+            )
+
+    async def create_item_if_absent(self, doc):
+        """
+        Create the given document only if no document with its id exists in
+        its logical partition.  Return the created document, or None if it
+        already exists.
+        """
+        try:
+            return await self.create_item(doc)
+        except CosmosResourceExistsError:
+            return None
+
+    async def replace_item_if_match(self, doc, etag):
+        """
+        Replace the given document only if its current _etag in the container
+        is the given etag (If-Match), and return the replaced document with
+        its new _etag.  Otherwise a CosmosAccessConditionFailedError (412) is
+        raised, meaning the document was modified since it was last read.
+        """
+        with self.metrics.capture("replace_item") as capture:
+            return await self._ctrproxy.replace_item(
+                item=doc["id"],
+                body=doc,
+                etag=etag,
+                match_condition=MatchConditions.IfNotModified,
+                response_hook=capture.response_hook,
+            )
 
     async def upsert_item(self, doc):
-        return await self._ctrproxy.upsert_item(body=doc)
+        with self.metrics.capture("upsert_item") as capture:
+            return await self._ctrproxy.upsert_item(
+                body=doc, response_hook=capture.response_hook
+            )
+
+    async def patch_item(
+        self, id, pk, patch_operations: list, filter_predicate=None, etag=None
+    ):
+        """
+        Apply the given list of patch operations to the document with the
+        given id and pk, and return the patched document.  Each operation is
+        a dict like {"op": "set", "path": "/until", "value": 1739733895},
+        see method patch_op.  A patch only sends the changed attributes,
+        rather than the whole document as with an upsert.
+
+        The optional filter_predicate is a condition on the document, such
+        as "from c where c.until = -1", and the optional etag makes the patch
+        conditional on the document's _etag (If-Match).  If either condition
+        isn't met a CosmosHttpResponseError with status code 412 is raised.
+        """
+        kwargs = dict()
+        if filter_predicate is not None:
+            kwargs["filter_predicate"] = filter_predicate
+        if etag is not None:
+            kwargs["etag"] = etag
+            kwargs["match_condition"] = MatchConditions.IfNotModified
+        with self.metrics.capture("patch_item") as capture:
+            return await self._ctrproxy.patch_item(
+                item=id,
+                partition_key=pk,
+                patch_operations=patch_operations,
+                response_hook=capture.response_hook,
+                **kwargs
+            )
+
+    @classmethod
+    def patch_op(cls, op: str, path: str, value=None) -> dict:
+        """
+        Return a patch operation dict for method patch_item.  The op is one of
+        add, set, replace, remove, or incr (or increment); the path is a JSON
+        path like '/until'.  The value is ignored for remove operations.
+        """
+        op = op.lower()
+        if op == "increment":
+            op = "incr"
+        if op not in PATCH_OPERATION_TYPES:
+            raise ValueError("invalid patch operation type: {}".format(op))
+        if not path.startswith("/"):
+            raise ValueError("patch paths must start with '/': {}".format(path))
+        patch_operation = {"op": op, "path": path}
+        if op != "remove":
+            patch_operation["value"] = value
+        return patch_operation
 
     async def delete_item(self, id, pk):
-        return await self._ctrproxy.delete_item(item=id, partition_key=pk)
+        with self.metrics.capture("delete_item") as capture:
+            return await self._ctrproxy.delete_item(
+                item=id, partition_key=pk, response_hook=capture.response_hook
+            )
 
     # https://github.com/Azure/azure-sdk-for-python/blob/azure-cosmos_4.7.0/sdk/cosmos/azure-cosmos/samples/document_management_async.py
 
@@ -111,24 +390,22 @@ class CosmosNoSQLService:
         #   [("create", (get_sales_order("create_item"),)), next op, next op, ...]
         # each operation is a 2-tuple, with the operation name as tup[0]
         # tup[1] is a nested 2-tuple , with the document as tup[0]
-        return await self._ctrproxy.execute_item_batch(
-            batch_operations=item_operations, partition_key=pk
-        )
+        with self.metrics.capture("execute_item_batch") as capture:
+            return await self._ctrproxy.execute_item_batch(
+                batch_operations=item_operations,
+                partition_key=pk,
+                response_hook=capture.response_hook,
+            )
 
     async def query_items(self, sql, cross_partition=False, pk=None, max_items=100):
-        parameters_list, results_list = list(), list()
-        parameters_list.append(
-            {"name": "@enable_cross_partition_query", "value": cross_partition}
-        )
-        # parameters_list.append({"name": "@max_item_count", "value": max_items})
+        """
+        Execute the given query and return the list of up to max_items results.
+        If a pk value is given the query is routed to that single logical
+        partition, otherwise it's a cross-partition query.
+        """
         if pk is not None:
-            parameters_list.append({"name": "@partition_key", "value": pk})
-        query_results = self._ctrproxy.query_items(
-            query=sql, parameters=parameters_list
-        )
-        async for item in query_results:
-            results_list.append(item)
-        return results_list
+            return await self.query_partition(sql, pk, max_items=max_items)
+        return await self.query_list(sql, None, None, max_items)
 
     async def parameterized_query(
         self,
@@ -138,25 +415,202 @@ class CosmosNoSQLService:
         pk=None,
         max_items=100,
     ):
-        parameters_list, results_list = list(), list()
-        parameters_list.append(
-            {"name": "@enable_cross_partition_query", "value": cross_partition}
-        )
-        parameters_list.append({"name": "@max_item_count", "value": max_items})
+        """
+        Execute the given parameterized query and return the list of up to
+        max_items results.  The sql_parameters are a list of dicts with 'name'
+        and 'value' keys.  If a pk value is given the query is routed to that
+        single logical partition, otherwise it's a cross-partition query.
+        """
         if pk is not None:
-            parameters_list.append({"name": "@partition_key", "value": pk})
-        if sql_parameters is not None:
-            for sql_param in sql_parameters:
-                parameters_list.append(sql_param)
+            return await self.query_partition(
+                sql_template, pk, sql_parameters, max_items=max_items
+            )
+        return await self.query_list(sql_template, sql_parameters, None, max_items)
+
+    async def query_partition(self, sql, pk, parameters=None, max_items=100):
+        """
+        Execute the given query within the single logical partition with
+        the given partition key value, and return the list of up to max_items
+        results.  These single-partition queries are much cheaper in RU and
+        latency than cross-partition queries, which fan out to every partition.
+        """
+        self.validate_partition_key_value(pk)
+        return await self.query_list(sql, parameters, pk, max_items)
+
+    async def query_list(self, sql, parameters, pk, max_items) -> list:
+        """
+        Return up to max_items results of the given query, fetched in pages
+        of at most max_items.  Afterwards last_request_charge returns the
+        request charge of all of the pages, not only of the last one.
+        """
+        results_list = list()
+        total = OperationCapture("query")
+        pages = self.query_pages(sql, parameters, page_size=max_items, pk=pk)
+        try:
+            async for page in pages:
+                total.request_charge = total.request_charge + page["ru"]
+                results_list.extend(page["items"])
+                if len(results_list) >= max_items:
+                    break
+        finally:
+            await pages.aclose()
+        last_operation_capture.set(total)  # not recorded; its pages were
+        return results_list[0:max_items]
+
+    def validate_partition_key_value(self, pk):
+        """
+        Raise a ValueError if the given pk isn't a usable partition key value,
+        such as None, an empty string, or a partition key path like '/did'.
+        """
+        if pk is None:
+            raise ValueError("a partition key value is required")
+        if isinstance(pk, str):
+            if len(pk.strip()) == 0:
+                raise ValueError("the partition key value is an empty string")
+            if pk.startswith("/"):
+                raise ValueError(
+                    "'{}' is a partition key path, not a partition key value".format(pk)
+                )
+
+    async def query_iter(
+        self, sql, parameters=None, page_size=100, continuation_token=None, pk=None
+    ):
+        """
+        Execute the given query and return an async generator of the result
+        items, fetched one page of page_size items at a time.  Only one page
+        is held in memory, and the first item is available after the first page.
+        """
+        async for page in self.query_pages(
+            sql, parameters, page_size, continuation_token, pk
+        ):
+            for item in page["items"]:
+                yield item
+
+    async def query_pages(
+        self, sql, parameters=None, page_size=100, continuation_token=None, pk=None
+    ):
+        """
+        Execute the given query and return an async generator of result pages.
+        The query is routed to the single logical partition of the given pk
+        value, if any, otherwise it's a cross-partition query.
+        Each page is a dict with these keys:
+          items - the list of result documents in this page
+          item_count - the number of items in this page
+          ru - the request charge of fetching this page
+          page_number - 1 for the first page of this call
+          continuation_token - pass this to a later call to resume the
+            query after this page; None after the last page
+        Each page fetch is captured as a 'query_page' operation.
+        """
+        current_capture = [None]  # the capture of the page being fetched
+
+        def capture_page_response(headers, result):
+            if current_capture[0] is not None:
+                current_capture[0].response_hook(headers, result)
+
+        if pk is not None:
+            self.validate_partition_key_value(pk)
         query_results = self._ctrproxy.query_items(
-            query=sql_template, parameters=parameters_list
+            query=sql,
+            parameters=parameters,
+            partition_key=pk,
+            max_item_count=page_size,
+            response_hook=capture_page_response,
+        )
+        pager = query_results.by_page(continuation_token)
+        page_number = 0
+        while True:
+            with self.metrics.capture("query_page") as capture:
+                current_capture[0] = capture
+                try:
+                    page = await pager.__anext__()
+                except StopAsyncIteration:
+                    page = None
+                    if capture.headers is None:
+                        capture.discard()  # no request was made
+                if page is not None:
+                    items = list()
+                    async for item in page:
+                        items.append(item)
+            current_capture[0] = None
+            if page is None:
+                return
+            page_number = page_number + 1
+            result = dict()
+            result["items"] = items
+            result["item_count"] = len(items)
+            result["ru"] = capture.request_charge
+            result["page_number"] = page_number
+            result["continuation_token"] = pager.continuation_token
+            yield result
+
+    async def read_feed_ranges(self) -> list:
+        """
+        Return the list of feed ranges of the current container; each is a
+        dict, and they can be read in parallel with read_change_feed_page.
+        """
+        feed_ranges = list()
+        async for feed_range in self._ctrproxy.read_feed_ranges():
+            feed_ranges.append(feed_range)
+        return feed_ranges
+
+    async def read_change_feed_page(
+        self, feed_range=None, continuation=None, max_item_count=100, start_time="Beginning"
+    ) -> dict:
+        """
+        Read the next page of the change feed of the given feed range, from the
+        given continuation token or else from the given start_time ("Beginning"
+        or "Now").  Return a dict with the items, item_count, ru, and the
+        continuation to pass to the next call; the continuation token also
+        identifies the feed range.  Captured as a 'change_feed_page' operation.
+        """
+        current_capture = [None]  # the capture of the page being fetched
+
+        def capture_page_response(headers, result):
+            if current_capture[0] is not None:
+                current_capture[0].response_hook(headers, result)
+
+        kwargs = dict()
+        if continuation is not None:
+            kwargs["continuation"] = continuation
+        else:
+            kwargs["start_time"] = start_time
+            if feed_range is not None:
+                kwargs["feed_range"] = feed_range
+        change_feed = self._ctrproxy.query_items_change_feed(
+            max_item_count=max_item_count, response_hook=capture_page_response, **kwargs
         )
-        async for item in query_results:
-            results_list.append(item)
-        return results_list
+        pager = change_feed.by_page()
+        items = list()
+        with self.metrics.capture("change_feed_page") as capture:
+            current_capture[0] = capture
+            try:
+                page = await pager.__anext__()
+                async for item in page:
+                    items.append(item)
+            except StopAsyncIteration:
+                pass
+            current_capture[0] = None
+        result = dict()
+        result["items"] = items
+        result["item_count"] = len(items)
+        result["ru"] = capture.request_charge
+        result["continuation"] = pager.continuation_token or continuation
+        return result
+
+    def last_operation(self):
+        """
+        Return the OperationCapture of the most recent operation completed
+        in the current asyncio task, or None.  Unlike the client's shared
+        last_response_headers, this isn't affected by concurrent operations
+        in other tasks.  See class OperationCapture for its attributes.
+        """
+        return last_operation_capture.get()
 
     def last_response_headers(self):
         """
+        The response headers of the most recent operation in the current
+        asyncio task, see last_operation().
         The headers are an instance of class CIMultiDict.
         You can lookup the value of a header by name, like this:
             nosql_svc.last_response_headers()['x-ms-item-count']
@@ -164,12 +618,19 @@ class CosmosNoSQLService:
             for two_tup in nosql_svc.last_response_headers().items():
                 name, value = two_tup[0], two_tup[1]
         """
+        capture = self.last_operation()
+        if capture is not None and capture.headers is not None:
+            return capture.headers
         try:
             return self._ctrproxy.client_connection.last_response_headers
         except:
             return None
 
     def last_request_charge(self):
+        """Return the request charge of the most recent operation in the current task."""
+        capture = self.last_operation()
+        if capture is not None:
+            return capture.request_charge
         try:
             return float(
                 self._ctrproxy.client_connection.last_response_headers[
@@ -216,6 +677,6 @@ class CosmosNoSQLService:
         x-ms-xp-role -> 2
         """
         try:
-            return self._ctrproxy.client_connection.last_response_headers[header]
+            return self.last_response_headers()[header]
         except:
             return None
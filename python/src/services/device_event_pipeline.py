@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import time
+import traceback
+import zlib
+
+from src.services.cosmos_nosql_service import CosmosNoSQLService
+from src.services.write_batcher import WriteBatcher
+from src.models.device_state_change_operations import DeviceStateChangeOperations
+from src.models.partition_key_strategy import PartitionKeyStrategy
+from src.util.counter import Counter
+from src.util.histogram import Histogram
+
+# Instances of this class process a stream of DeviceState events with a
+# bounded asyncio pipeline.  Events are sharded by did into worker queues,
+# so the events of a device are processed in order while different devices
+# are processed concurrently; the bounded queues provide backpressure.
+
+
+class DeviceEventPipeline:
+
+    STAGES = ["queue_wait_ms", "insert_ms", "operations_ms", "total_ms"]
+
+    def __init__(
+        self,
+        nosql_svc: CosmosNoSQLService,
+        write_batcher: WriteBatcher = None,
+        workers: int = 8,
+        queue_depth: int = 100,
+        execute_operations: bool = True,
+        on_event_processed=None,
+        partition_strategy: PartitionKeyStrategy = None,
+    ):
+        """
+        If execute_operations is False the events are only inserted, and the
+        DeviceStateChangeOperations are left to a change feed processor; only
+        then is the optional write_batcher used, as each worker enqueues the
+        inserts of all of its queued events before awaiting them.  Otherwise
+        an event's operations must follow its insert, so it's written directly.
+        The optional on_event_processed function is called with each event,
+        its total milliseconds, and its exception or None.  The optional
+        partition_strategy sets the 'pk' of each event before it's inserted;
+        the events are still sharded to the workers by did.
+        """
+        if write_batcher is not None and execute_operations:
+            raise ValueError("a write_batcher requires execute_operations False")
+        self.nosql_svc = nosql_svc
+        self.execute_operations = execute_operations
+        self.write_batcher = write_batcher
+        self.on_event_processed = on_event_processed
+        self.partition_strategy = partition_strategy
+        self.workers = max(1, workers)
+        self.queue_depth = max(1, queue_depth)
+        self.queues = list()
+        self.worker_tasks = list()
+        self.histograms = dict()
+        for stage in DeviceEventPipeline.STAGES:
+            self.histograms[stage] = Histogram()
+        self.counter = Counter()
+        self.start_time = None
+        self.end_time = None
+
+    def start(self) -> None:
+        """Create the worker queues and tasks; call this within the event loop."""
+        for i in range(self.workers):
+            queue = asyncio.Queue(maxsize=self.queue_depth)
+            self.queues.append(queue)
+            self.worker_tasks.append(asyncio.create_task(self.work(queue)))
+
+    def worker_index(self, did: str) -> int:
+        """Return the worker for the given did; a stable hash, unlike hash()."""
+        return zlib.crc32(str(did).encode("utf-8")) % self.workers
+
+    async def submit(self, event: dict, arrival_time: float = None) -> None:
+        """
+        Queue the given event, waiting while its worker's queue is full.
+        The latencies are measured from the given perf_counter arrival_time,
+        such as an open-loop load driver's scheduled time, or else from now.
+        """
+        if arrival_time is None:
+            arrival_time = time.perf_counter()
+        if self.start_time is None:
+            self.start_time = arrival_time
+        queue = self.queues[self.worker_index(event["did"])]
+        await queue.put((event, arrival_time))
+        self.counter.increment("submitted")
+
+    async def drain(self) -> None:
+        """Wait until all of the submitted events have been processed."""
+        for queue in self.queues:
+            await queue.join()
+
+    async def close(self) -> None:
+        await self.drain()
+        for task in self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks = list()
+
+    async def work(self, queue: asyncio.Queue) -> None:
+        while True:
+            items = [await queue.get()]
+            if self.write_batcher is not None:
+                # take the events already queued, so that their inserts can share batches
+                while len(items) < self.write_batcher.max_batch_size and not queue.empty():
+                    items.append(queue.get_nowait())
+                errors = await self.insert_events(items)
+            else:
+                event, submit_time = items[0]
+                errors = [None]
+                try:
+                    await self.process_event(event, submit_time)
+                except Exception as e:
+                    errors[0] = e
+            self.end_time = time.perf_counter()
+            for (event, submit_time), error in zip(items, errors):
+                try:
+                    if error is not None:
+                        self.counter.increment("errors")
+                        logging.info(str(error))
+                        logging.info("".join(traceback.format_exception(error)))
+                    if self.on_event_processed is not None:
+                        total_ms = (self.end_time - submit_time) * 1000.0
+                        self.on_event_processed(event, total_ms, error)
+                except Exception as e:
+                    logging.info(str(e))
+                    logging.info(traceback.format_exc())
+                finally:
+                    queue.task_done()
+
+    def event_pk(self, event: dict):
+        if self.partition_strategy is not None:
+            return self.partition_strategy.assign(event)
+        return event["did"]
+
+    async def process_event(self, event: dict, submit_time: float) -> None:
+        """Insert the DeviceState event, then execute its DeviceStateChangeOperations."""
+        start_time = time.perf_counter()
+        self.histograms["queue_wait_ms"].record((start_time - submit_time) * 1000.0)
+        self.event_pk(event)
+        ds_doc = await self.nosql_svc.upsert_item(event)
+        insert_ru = self.nosql_svc.last_request_charge()
+        insert_time = time.perf_counter()
+        self.histograms["insert_ms"].record((insert_time - start_time) * 1000.0)
+        if self.execute_operations == False:
+            self.histograms["total_ms"].record((insert_time - submit_time) * 1000.0)
+            self.counter.increment("processed")
+            return
+
+        ops = DeviceStateChangeOperations(self.nosql_svc, ds_doc, insert_ru)
+        await ops.execute()
+        end_time = time.perf_counter()
+        self.histograms["operations_ms"].record((end_time - insert_time) * 1000.0)
+        self.histograms["total_ms"].record((end_time - submit_time) * 1000.0)
+        self.counter.increment("processed")
+
+    async def insert_events(self, items: list) -> list:
+        """
+        Insert the given (event, submit_time) items through the write_batcher;
+        all of the inserts are enqueued and their partitions flushed before
+        any is awaited.  Return the exception of each item, or None.
+        """
+        start_time = time.perf_counter()
+        futures, pks = list(), dict()
+        for event, submit_time in items:
+            self.histograms["queue_wait_ms"].record((start_time - submit_time) * 1000.0)
+            pk = self.event_pk(event)
+            pks[pk] = 1
+            futures.append(self.write_batcher.upsert(event, pk))
+        for pk in pks.keys():
+            self.write_batcher.flush_partition(pk)
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        insert_time = time.perf_counter()
+        errors = list()
+        for (event, submit_time), result in zip(items, results):
+            if isinstance(result, Exception):
+                errors.append(result)
+                continue
+            self.histograms["insert_ms"].record((insert_time - start_time) * 1000.0)
+            self.histograms["total_ms"].record((insert_time - submit_time) * 1000.0)
+            self.counter.increment("processed")
+            errors.append(None)
+        return errors
+
+    def get_stats(self) -> dict:
+        """Return the event counts, events per second, and the per-stage latencies."""
+        stats = dict()
+        processed = self.counter.get_value("processed")
+        elapsed = 0.0
+        if self.start_time is not None and self.end_time is not None:
+            elapsed = self.end_time - self.start_time
+        stats["workers"] = self.workers
+        stats["queue_depth"] = self.queue_depth
+        stats["submitted"] = self.counter.get_value("submitted")
+        stats["processed"] = processed
+        stats["errors"] = self.counter.get_value("errors")
+        stats["elapsed_seconds"] = elapsed
+        stats["events_per_second"] = 0.0 if elapsed <= 0 else processed / elapsed
+        for stage in DeviceEventPipeline.STAGES:
+            stats[stage] = self.histograms[stage].summary()
+        return stats
@@ -0,0 +1,295 @@
+import asyncio
+import copy
+import math
+import random
+import time
+import uuid
+
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosHttpResponseError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
+
+from src.services.change_feed_processor import LocalChangeFeed
+from src.util.counter import Counter
+from src.util.operation_metrics import (
+    OperationMetrics,
+    last_operation_capture,
+    REQUEST_CHARGE_HEADER,
+    THROTTLE_RETRY_COUNT_HEADER,
+)
+
+# Instances of this class are a local, in-memory stand-in for the
+# CosmosNoSQLService, for load tests and simulations without a Cosmos DB
+# account.  It implements the methods used by the devices simulation, with
+# _etag semantics, an approximate RU charge per operation, an injectable
+# latency, and injectable 429 throttling which is retried like the SDK does.
+# The operations are captured in the same OperationMetrics.
+#
+# Documents are partitioned by their 'pk' attribute, or else their 'did'.
+# Queries aren't parsed; query_partition returns the DeviceState documents
+# of the partition, most recent evt_time first (and of equal evt_times,
+# the first written last), which is the only query shape the devices
+# simulation uses.
+
+
+class InMemoryNoSQLService:
+
+    # approximate RU charges; per started KB of the document
+    read_ru_per_kb = 1.0
+    write_ru_per_kb = 5.0
+    query_ru = 2.8
+
+    def __init__(self, opts={}):
+        """
+        The opts may include latency_ms (the mean per request, default 0),
+        latency_distribution ('fixed' or 'exponential'), throttle_pct (the
+        percentage of requests that get a 429), max_throttle_retries
+        (default 9, as in the SDK), retry_after_ms (default 5), and seed.
+        """
+        self._opts = opts
+        self._cname = None
+        self.containers = dict()  # cname -> dict of (id, pk) -> doc
+        self.change_feeds = dict()  # cname -> LocalChangeFeed
+        self._container_services = dict()  # cname -> InMemoryNoSQLService
+        if "metrics" in opts.keys():
+            self.metrics = opts["metrics"]
+        else:
+            self.metrics = OperationMetrics()
+        self.latency_ms = float(opts.get("latency_ms", 0.0))
+        self.latency_distribution = opts.get("latency_distribution", "exponential")
+        self.throttle_pct = float(opts.get("throttle_pct", 0.0))
+        self.max_throttle_retries = int(opts.get("max_throttle_retries", 9))
+        self.retry_after_ms = float(opts.get("retry_after_ms", 5.0))
+        self.rng = random.Random(opts.get("seed", 42))
+        self.counter = Counter()
+
+    async def initialize(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def list_databases(self):
+        return ["in-memory"]
+
+    def set_db(self, dbname):
+        return dbname
+
+    def get_current_cname(self):
+        return self._cname
+
+    def set_container(self, cname):
+        self._cname = cname
+        if cname not in self.containers.keys():
+            self.containers[cname] = dict()
+            self.change_feeds[cname] = LocalChangeFeed()
+        return cname
+
+    def for_container(self, cname):
+        """Return a service for the given container, which shares these containers and metrics."""
+        if cname not in self._container_services.keys():
+            svc = copy.copy(self)
+            svc._container_services = dict()
+            svc.set_container(cname)
+            self._container_services[cname] = svc
+        return self._container_services[cname]
+
+    async def list_containers(self):
+        return sorted(self.containers.keys())
+
+    def docs(self) -> dict:
+        """Return the (id, pk) -> doc dict of the current container."""
+        return self.containers[self._cname]
+
+    def partition_key(self, doc: dict):
+        if "pk" in doc.keys():
+            return doc["pk"]
+        return doc["did"]
+
+    async def point_read(self, id, pk):
+        with self.metrics.capture("point_read") as capture:
+            await self.simulate_request(
+                capture, self.ru_for(self.read_ru_per_kb, self.docs().get((id, pk), None)))
+            doc = self.docs().get((id, pk), None)
+            if doc is None:
+                raise CosmosResourceNotFoundError(status_code=404, message="not found")
+            return copy.deepcopy(doc)
+
+    def single_flight_stats(self) -> dict:
+        return dict()
+
+    async def create_item(self, doc):
+        with self.metrics.capture("create_item") as capture:
+            await self.simulate_request(capture, self.ru_for(self.write_ru_per_kb, doc))
+            if (doc["id"], self.partition_key(doc)) in self.docs().keys():
+                raise CosmosResourceExistsError(status_code=409, message="conflict")
+            return self.store(doc)
+
+    async def create_item_if_absent(self, doc):
+        try:
+            return await self.create_item(doc)
+        except CosmosResourceExistsError:
+            return None
+
+    async def replace_item_if_match(self, doc, etag):
+        with self.metrics.capture("replace_item") as capture:
+            await self.simulate_request(capture, self.ru_for(self.write_ru_per_kb, doc))
+            current = self.docs().get((doc["id"], self.partition_key(doc)), None)
+            if current is None:
+                raise CosmosResourceNotFoundError(status_code=404, message="not found")
+            if current["_etag"] != etag:
+                raise CosmosAccessConditionFailedError(status_code=412, message="etag mismatch")
+            return self.store(doc)
+
+    async def upsert_item(self, doc):
+        with self.metrics.capture("upsert_item") as capture:
+            await self.simulate_request(capture, self.ru_for(self.write_ru_per_kb, doc))
+            return self.store(doc)
+
+    async def patch_item(
+        self, id, pk, patch_operations: list, filter_predicate=None, etag=None
+    ):
+        """Apply the patch operations; a filter_predicate isn't evaluated."""
+        with self.metrics.capture("patch_item") as capture:
+            await self.simulate_request(
+                capture, self.ru_for(self.write_ru_per_kb, self.docs().get((id, pk), None)))
+            current = self.docs().get((id, pk), None)
+            if current is None:
+                raise CosmosResourceNotFoundError(status_code=404, message="not found")
+            if etag is not None and current["_etag"] != etag:
+                raise CosmosAccessConditionFailedError(status_code=412, message="etag mismatch")
+            return self.store(self.apply_patch(current, patch_operations))
+
+    def apply_patch(self, doc: dict, patch_operations: list) -> dict:
+        doc = copy.deepcopy(doc)
+        for operation in patch_operations:
+            op, name = operation["op"], operation["path"][1:]
+            if op == "remove":
+                doc.pop(name, None)
+            elif op == "incr":
+                doc[name] = doc.get(name, 0) + operation["value"]
+            else:
+                doc[name] = operation["value"]
+        return doc
+
+    async def delete_item(self, id, pk):
+        with self.metrics.capture("delete_item") as capture:
+            doc = self.docs().pop((id, pk), None)
+            await self.simulate_request(capture, self.ru_for(self.write_ru_per_kb, doc))
+            if doc is None:
+                raise CosmosResourceNotFoundError(status_code=404, message="not found")
+
+    async def execute_item_batch(self, item_operations: list, pk: str):
+        """Execute the upsert, create, and patch operations of a transactional batch."""
+        with self.metrics.capture("execute_item_batch") as capture:
+            ru = 0.0
+            for name, args in [(op[0], op[1]) for op in item_operations]:
+                doc = args[0] if name != "patch" else self.docs().get((args[0], pk), None)
+                ru = ru + self.ru_for(self.write_ru_per_kb, doc)
+            await self.simulate_request(capture, ru)
+            results = list()
+            for name, args in [(op[0], op[1]) for op in item_operations]:
+                if name in ["upsert", "create"]:
+                    doc = self.store(args[0])
+                elif name == "patch":
+                    doc = self.store(self.apply_patch(self.docs()[(args[0], pk)], args[1]))
+                else:
+                    raise ValueError("unsupported batch operation: {}".format(name))
+                results.append({"statusCode": 200, "resourceBody": doc})
+            return results
+
+    async def query_items(self, sql, cross_partition=False, pk=None, max_items=100):
+        """Return up to max_items documents, ordered by did descending; the sql isn't parsed."""
+        with self.metrics.capture("query_items") as capture:
+            docs = [doc for (id, doc_pk), doc in self.docs().items() if pk is None or doc_pk == pk]
+            docs = sorted(docs, key=lambda doc: str(doc.get("did", "")), reverse=True)[0:max_items]
+            await self.simulate_request(capture, self.query_ru + (0.1 * len(docs)))
+            return copy.deepcopy(docs)
+
+    async def query_partition(self, sql, pk, parameters=None, max_items=100):
+        """Return the DeviceStates of the partition, most recent first; the sql isn't parsed."""
+        with self.metrics.capture("query_page") as capture:
+            docs = [doc for (id, doc_pk), doc in self.docs().items()
+                    if doc_pk == pk and doc.get("dt", "ds") == "ds"]
+            docs.reverse()  # the sort is stable, so equal evt_times are newest first
+            docs = sorted(docs, key=lambda doc: doc.get("evt_time", 0), reverse=True)[0:max_items]
+            await self.simulate_request(capture, self.query_ru + (0.1 * len(docs)))
+            return copy.deepcopy(docs)
+
+    async def read_feed_ranges(self) -> list:
+        return await self.change_feeds[self._cname].read_feed_ranges()
+
+    async def read_change_feed_page(
+        self, feed_range=None, continuation=None, max_item_count=100, start_time="Beginning"
+    ) -> dict:
+        with self.metrics.capture("change_feed_page") as capture:
+            page = await self.change_feeds[self._cname].read_change_feed_page(
+                feed_range, continuation, max_item_count, start_time)
+            page["ru"] = self.query_ru + (0.1 * page["item_count"])
+            await self.simulate_request(capture, page["ru"])
+            return page
+
+    def last_operation(self):
+        return last_operation_capture.get()
+
+    def last_request_charge(self):
+        capture = self.last_operation()
+        if capture is not None:
+            return capture.request_charge
+        return -1.0
+
+    def store(self, doc: dict) -> dict:
+        """Store a copy of the given document with a new _etag and _ts, and return a copy."""
+        doc = copy.deepcopy(doc)
+        doc["_etag"] = str(uuid.uuid4())
+        doc["_ts"] = int(time.time())
+        pk = self.partition_key(doc)
+        self.docs()[(doc["id"], pk)] = doc
+        self.change_feeds[self._cname].append(doc, pk)
+        return copy.deepcopy(doc)
+
+    def ru_for(self, ru_per_kb: float, doc: dict) -> float:
+        """Return the approximate RU charge of reading or writing the given document."""
+        size = 0 if doc is None else len(str(doc))
+        return ru_per_kb * max(1, math.ceil(size / 1024.0))
+
+    async def simulate_request(self, capture, ru: float) -> None:
+        """
+        Wait for the simulated latency, retrying the throttled attempts after
+        retry_after_ms.  A 429 is raised if the retries are exhausted.
+        """
+        retries = 0
+        while True:
+            self.counter.increment("requests")
+            await asyncio.sleep(self.simulated_latency_ms() / 1000.0)
+            if self.throttle_pct <= 0 or self.rng.random() * 100.0 >= self.throttle_pct:
+                break
+            self.counter.increment("throttled")
+            if retries >= self.max_throttle_retries:
+                capture.response_hook({THROTTLE_RETRY_COUNT_HEADER: str(retries)}, None)
+                raise CosmosHttpResponseError(status_code=429, message="request rate is large")
+            retries = retries + 1
+            await asyncio.sleep(self.retry_after_ms / 1000.0)
+        headers = dict()
+        headers[REQUEST_CHARGE_HEADER] = str(ru)
+        headers[THROTTLE_RETRY_COUNT_HEADER] = str(retries)
+        capture.response_hook(headers, None)
+
+    def simulated_latency_ms(self) -> float:
+        if self.latency_ms <= 0:
+            return 0.0
+        if self.latency_distribution == "fixed":
+            return self.latency_ms
+        return self.rng.expovariate(1.0 / self.latency_ms)
+
+    def get_stats(self) -> dict:
+        stats = dict()
+        requests = self.counter.get_value("requests")
+        throttled = self.counter.get_value("throttled")
+        stats["requests"] = requests
+        stats["throttled"] = throttled
+        stats["throttle_rate"] = 0.0 if requests == 0 else throttled / requests
+        return stats
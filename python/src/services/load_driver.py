@@ -0,0 +1,211 @@
+import asyncio
+import math
+import random
+import time
+
+from src.services.device_event_pipeline import DeviceEventPipeline
+from src.util.counter import Counter
+from src.util.histogram import Histogram
+from src.util.operation_metrics import OperationMetrics
+
+# Instances of this class drive a DeviceEventPipeline with an open-loop
+# workload; events are submitted at their scheduled arrival times whether or
+# not the earlier events have completed, so the measured latencies include
+# the queueing delay at the target rate.  The latencies are measured from
+# the scheduled arrival times, so a pipeline that falls behind isn't hidden
+# by a slower submission rate (coordinated omission).
+#
+# The workload is a list of stages, each with a start and end rate in
+# events per second and a duration; a stage with different rates is a
+# linear ramp.  Arrivals are either Poisson or evenly spaced (constant).
+
+
+class LoadDriver:
+
+    def __init__(
+        self,
+        pipeline: DeviceEventPipeline,
+        next_event,
+        stages: list,
+        arrivals: str = "poisson",
+        seed: int = 42,
+    ):
+        """
+        The next_event argument is a function that returns the next event
+        dict; the stages are dicts, see method parse_stages.
+        """
+        if arrivals not in ["poisson", "constant"]:
+            raise ValueError("unknown arrivals: {}".format(arrivals))
+        self.pipeline = pipeline
+        self.next_event = next_event
+        self.stages = stages
+        self.arrivals = arrivals
+        self.rng = random.Random(seed)
+        self.counter = Counter()
+        self.schedule_lag_histogram = Histogram()
+        self.stage_histograms = [Histogram() for stage in stages]
+        self.stage_counters = [Counter() for stage in stages]
+        self.event_stages = dict()  # event id -> stage index, while in flight
+        self.start_time = None
+        self.end_time = None
+        pipeline.on_event_processed = self.event_processed
+
+    @classmethod
+    def parse_stages(cls, spec: str) -> list:
+        """
+        Parse a stages spec of comma-separated 'rate:seconds' or
+        'start_rate-end_rate:seconds' values, such as '100:30,100-1000:60,1000:120'.
+        """
+        stages = list()
+        for part in spec.split(","):
+            rates, seconds = part.strip().split(":")
+            if "-" in rates:
+                start_rate, end_rate = rates.split("-")
+            else:
+                start_rate, end_rate = rates, rates
+            stage = dict()
+            stage["start_rate"] = float(start_rate)
+            stage["end_rate"] = float(end_rate)
+            stage["duration_seconds"] = float(seconds)
+            if stage["start_rate"] < 0 or stage["end_rate"] < 0 or stage["duration_seconds"] <= 0:
+                raise ValueError("invalid stage: {}".format(part))
+            stages.append(stage)
+        return stages
+
+    @classmethod
+    def device_evt_time(cls, last_evt_times: dict, did: str, now: float = None) -> float:
+        """
+        Return the evt_time, in seconds with millisecond precision, of a new
+        event of the given device at time now (default the current time).
+        It's after the device's previous evt_time in the given dict, so the
+        events of a hot device never tie on evt_time, which orders its states.
+        """
+        now = time.time() if now is None else now
+        evt_time = round(now, 3)
+        if did in last_evt_times.keys():
+            evt_time = max(evt_time, round(last_evt_times[did] + 0.001, 3))
+        last_evt_times[did] = evt_time
+        return evt_time
+
+    def stage_time_at(self, stage: dict, events: float) -> float:
+        """
+        Return the time in the given stage at which its cumulative target
+        event count reaches the given events, or None if it doesn't.  The
+        count is the integral of the linear rate; a*t*t + b*t = events.
+        """
+        a = (stage["end_rate"] - stage["start_rate"]) / (2.0 * stage["duration_seconds"])
+        b = stage["start_rate"]
+        discriminant = (b * b) + (4.0 * a * events)
+        if discriminant < 0:
+            return None
+        denominator = b + math.sqrt(discriminant)
+        if denominator <= 0:
+            return None
+        return (2.0 * events) / denominator  # the stable form of the quadratic root
+
+    def arrival_schedule(self):
+        """
+        Yield (stage index, arrival offset seconds) tuples for all of the
+        stages.  The arrivals are where the cumulative target event count
+        reaches the next integer (constant), or the sum of exponentially
+        distributed increments (Poisson), which follows a ramp's rate exactly.
+        """
+        stage_start = 0.0
+        for idx, stage in enumerate(self.stages):
+            events = 0.0
+            while True:
+                if self.arrivals == "poisson":
+                    events = events + self.rng.expovariate(1.0)
+                else:
+                    events = events + 1.0
+                t = self.stage_time_at(stage, events)
+                if t is None or t >= stage["duration_seconds"]:
+                    break
+                yield idx, stage_start + t
+            stage_start = stage_start + stage["duration_seconds"]
+
+    async def run(self) -> None:
+        """Submit the events on schedule, and wait for them to complete; see get_stats."""
+        self.start_time = time.perf_counter()
+        for idx, offset in self.arrival_schedule():
+            arrival_time = self.start_time + offset
+            delay = arrival_time - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                # the driver, or the pipeline's backpressure, is behind schedule
+                self.counter.increment("late_submits")
+            self.schedule_lag_histogram.record(max(0.0, -delay) * 1000.0)
+            event = self.next_event()
+            self.event_stages[event["id"]] = idx
+            self.stage_counters[idx].increment("submitted")
+            self.counter.increment("submitted")
+            await self.pipeline.submit(event, arrival_time=arrival_time)
+        await self.pipeline.drain()
+        self.end_time = time.perf_counter()
+
+    def event_processed(self, event: dict, total_ms: float, error) -> None:
+        idx = self.event_stages.pop(event["id"], None)
+        if idx is None:
+            return
+        self.stage_histograms[idx].record(total_ms)
+        if error is None:
+            self.stage_counters[idx].increment("processed")
+        else:
+            self.stage_counters[idx].increment("errors")
+            if getattr(error, "status_code", None) == 429:
+                self.stage_counters[idx].increment("throttled")
+
+    def get_stats(self, metrics: OperationMetrics = None) -> dict:
+        """
+        Return the driver, per-stage, and pipeline stats; and with the given
+        OperationMetrics the per-operation stats, RU per event, and the
+        throttle rate (the 429 responses and retries per request).
+        """
+        stats = dict()
+        submitted = self.counter.get_value("submitted")
+        elapsed = 0.0
+        if self.start_time is not None and self.end_time is not None:
+            elapsed = self.end_time - self.start_time
+        pipeline_stats = self.pipeline.get_stats()
+        stats["arrivals"] = self.arrivals
+        stats["elapsed_seconds"] = elapsed
+        stats["submitted"] = submitted
+        stats["processed"] = pipeline_stats["processed"]
+        stats["errors"] = pipeline_stats["errors"]
+        stats["error_rate"] = 0.0 if submitted == 0 else pipeline_stats["errors"] / submitted
+        stats["late_submits"] = self.counter.get_value("late_submits")
+        stats["schedule_lag_ms"] = self.schedule_lag_histogram.summary()
+        stats["end_to_end_ms"] = pipeline_stats["total_ms"]
+        stats["queue_wait_ms"] = pipeline_stats["queue_wait_ms"]
+        stats["stages"] = list()
+        for idx, stage in enumerate(self.stages):
+            counter = self.stage_counters[idx]
+            stage_stats = dict(stage)
+            stage_stats["target_events"] = (
+                (stage["start_rate"] + stage["end_rate"]) / 2.0) * stage["duration_seconds"]
+            stage_stats["submitted"] = counter.get_value("submitted")
+            stage_stats["processed"] = counter.get_value("processed")
+            stage_stats["errors"] = counter.get_value("errors")
+            stage_stats["throttled"] = counter.get_value("throttled")
+            stage_stats["achieved_rate"] = counter.get_value("submitted") / stage["duration_seconds"]
+            stage_stats["end_to_end_ms"] = self.stage_histograms[idx].summary()
+            stats["stages"].append(stage_stats)
+        stats["pipeline"] = pipeline_stats
+        if metrics is not None:
+            requests, throttled, retries = 0, 0, 0
+            for name in metrics.operation_names():
+                statuses = metrics.status_counts[name]
+                requests = requests + sum(statuses.values())
+                throttled = throttled + statuses.get("429", 0)
+                retries = retries + metrics.retry_counts[name]
+            total_ru = metrics.total_request_charge()
+            processed = pipeline_stats["processed"]
+            stats["requests"] = requests
+            stats["request_units"] = total_ru
+            stats["ru_per_event"] = 0.0 if processed == 0 else total_ru / processed
+            stats["throttled_requests"] = throttled
+            stats["throttle_retries"] = retries
+            stats["throttle_rate"] = 0.0 if requests == 0 else (throttled + retries) / (requests + retries)
+            stats["operations"] = metrics.to_dict()
+        return stats
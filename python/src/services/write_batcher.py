@@ -0,0 +1,185 @@
+import asyncio
+import json
+import logging
+
+from azure.cosmos.exceptions import CosmosBatchOperationError
+
+from src.services.cosmos_nosql_service import CosmosNoSQLService
+from src.util.counter import Counter
+
+# Instances of this class are an async write buffer in front of a
+# CosmosNoSQLService.  Individual upserts are grouped by partition key and
+# flushed together as one transactional batch through execute_item_batch,
+# rather than as one round-trip per document.
+#
+# Writes only coalesce if several writes of a partition key are pending at
+# once, so callers should enqueue their writes before awaiting them, and
+# may call flush_partition rather than wait for the linger time.  The
+# flushes of a partition key are executed one at a time, in order.
+
+
+class WriteBatcher:
+
+    # Cosmos DB transactional batch limits
+    MAX_BATCH_OPERATIONS = 100
+    MAX_BATCH_BYTES = 2_000_000
+
+    def __init__(
+        self,
+        nosql_svc: CosmosNoSQLService,
+        max_batch_size: int = MAX_BATCH_OPERATIONS,
+        max_batch_bytes: int = MAX_BATCH_BYTES,
+        linger_ms: float = 10.0,
+    ):
+        """
+        Pending writes for a partition key are flushed when max_batch_size
+        operations or max_batch_bytes are pending, or linger_ms after the
+        first write was buffered, whichever comes first.
+        """
+        self.nosql_svc = nosql_svc
+        self.max_batch_size = min(max_batch_size, WriteBatcher.MAX_BATCH_OPERATIONS)
+        self.max_batch_bytes = min(max_batch_bytes, WriteBatcher.MAX_BATCH_BYTES)
+        self.linger_ms = linger_ms
+        self.pending = dict()  # pk -> list of pending entry dicts
+        self.pending_bytes = dict()  # pk -> int
+        self.linger_tasks = dict()  # pk -> asyncio.Task
+        self.flush_tasks = set()
+        self.flushing = dict()  # pk -> the latest flush task of the pk
+        self.counter = Counter()
+
+    def upsert(self, doc: dict, pk) -> asyncio.Future:
+        """
+        Buffer an upsert of the given document, and return a future for its
+        result dict, see method write_result.  Callers can await the future.
+        """
+        return self.enqueue(("upsert", (doc,)), pk, doc)
+
+    def enqueue(self, operation: tuple, pk, payload) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        entry = dict()
+        entry["operation"] = operation
+        entry["future"] = future
+        entry["size"] = len(json.dumps(payload))
+        if pk not in self.pending.keys():
+            self.pending[pk] = list()
+            self.pending_bytes[pk] = 0
+        # flush first if this write would exceed the batch byte limit
+        if self.pending_bytes[pk] + entry["size"] > self.max_batch_bytes:
+            self.flush_partition(pk)
+            self.pending[pk] = list()
+            self.pending_bytes[pk] = 0
+        self.pending[pk].append(entry)
+        self.pending_bytes[pk] = self.pending_bytes[pk] + entry["size"]
+        self.counter.increment("items")
+
+        if len(self.pending[pk]) >= self.max_batch_size:
+            self.flush_partition(pk)
+        elif pk not in self.linger_tasks.keys():
+            self.linger_tasks[pk] = asyncio.create_task(self.linger_then_flush(pk))
+        return future
+
+    async def linger_then_flush(self, pk) -> None:
+        await asyncio.sleep(self.linger_ms / 1000.0)
+        self.linger_tasks.pop(pk, None)
+        self.flush_partition(pk)
+
+    def flush_partition(self, pk) -> None:
+        """Start flushing the pending writes of the given partition key, if any."""
+        linger_task = self.linger_tasks.pop(pk, None)
+        if linger_task is not None and linger_task is not asyncio.current_task():
+            linger_task.cancel()
+        entries = self.pending.pop(pk, list())
+        self.pending_bytes.pop(pk, None)
+        if len(entries) > 0:
+            task = asyncio.create_task(self.execute_in_order(pk, entries, self.flushing.get(pk, None)))
+            self.flushing[pk] = task
+            self.flush_tasks.add(task)
+            task.add_done_callback(self.flush_tasks.discard)
+            task.add_done_callback(lambda t: self.flush_done(pk, t))
+
+    def flush_done(self, pk, task) -> None:
+        if self.flushing.get(pk, None) is task:
+            self.flushing.pop(pk)
+
+    async def execute_in_order(self, pk, entries: list, previous: asyncio.Task) -> None:
+        """Execute the batch after the previous flush of its partition key, so its writes can't reorder."""
+        if previous is not None:
+            await asyncio.wait([previous])
+        await self.execute_batch(pk, entries)
+
+    async def flush(self) -> None:
+        """Flush all pending writes and wait for them to complete."""
+        for pk in list(self.pending.keys()):
+            self.flush_partition(pk)
+        while len(self.flush_tasks) > 0:
+            await asyncio.gather(*list(self.flush_tasks), return_exceptions=True)
+
+    async def close(self) -> None:
+        await self.flush()
+
+    async def execute_batch(self, pk, entries: list) -> None:
+        """
+        Execute the given entries as one transactional batch.  A transactional
+        batch is all-or-nothing, so if it fails each of its entries is
+        retried as an individual write and gets its own result or exception.
+        """
+        if len(entries) == 1:
+            await self.execute_individually(pk, entries)
+            return
+        operations = [entry["operation"] for entry in entries]
+        try:
+            results = await self.nosql_svc.execute_item_batch(operations, pk)
+            ru = self.nosql_svc.last_request_charge()
+            self.counter.increment("batches")
+            self.counter.increment("requests")
+            for entry, result in zip(entries, results):
+                status_code = result.get("statusCode", 200)
+                doc = result.get("resourceBody", None)
+                write_result = self.write_result(doc, status_code, ru / len(entries), len(entries))
+                if not entry["future"].done():
+                    entry["future"].set_result(write_result)
+        except CosmosBatchOperationError as e:
+            logging.info(
+                "WriteBatcher batch failed in pk {} at operation index {}; falling back to individual writes".format(
+                    pk, e.error_index
+                )
+            )
+            self.counter.increment("batch_failures")
+            self.counter.increment("requests")
+            await self.execute_individually(pk, entries)
+        except Exception as e:
+            logging.info("WriteBatcher batch error in pk {}: {}".format(pk, str(e)))
+            self.counter.increment("batch_failures")
+            self.counter.increment("requests")
+            await self.execute_individually(pk, entries)
+
+    async def execute_individually(self, pk, entries: list) -> None:
+        for entry in entries:
+            try:
+                doc = await self.nosql_svc.upsert_item(entry["operation"][1][0])
+                ru = self.nosql_svc.last_request_charge()
+                self.counter.increment("individual_writes")
+                self.counter.increment("requests")
+                if not entry["future"].done():
+                    entry["future"].set_result(self.write_result(doc, 200, ru, 1))
+            except Exception as e:
+                self.counter.increment("individual_failures")
+                self.counter.increment("requests")
+                if not entry["future"].done():
+                    entry["future"].set_exception(e)
+
+    def write_result(self, doc, status_code, ru, batch_size) -> dict:
+        """
+        The result of each buffered write is a dict with the written doc, its
+        status_code, its share of the request charge, and the batch_size.
+        """
+        result = dict()
+        result["doc"] = doc
+        result["status_code"] = status_code
+        result["ru"] = ru
+        result["batch_size"] = batch_size
+        return result
+
+    def get_stats(self) -> dict:
+        """Return the item, batch, and request counts; items/requests shows the coalescing."""
+        return self.counter.get_data()
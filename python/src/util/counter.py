@@ -19,6 +19,10 @@ class Counter:
         else:
             self.data[key] = 1
 
+    def increment_by(self, key: str, value: int) -> None:
+        """Increment the given key by the given value."""
+        self.data[key] = self.get_value(key) + value
+
     def decrement(self, key: str) -> None:
         """Decrement the given key by 1."""
         keys = self.data.keys()
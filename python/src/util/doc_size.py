@@ -0,0 +1,38 @@
+# This class estimates the serialized JSON size of documents without
+# serializing them, which is much cheaper than len(json.dumps(doc)) when
+# the size of every document written is recorded.
+
+
+class DocSize:
+
+    @classmethod
+    def estimate(cls, obj) -> int:
+        """
+        Return the length of json.dumps(obj) with its default separators.
+        The result is exact for ASCII strings without characters that need
+        escaping, and otherwise an underestimate; it's intended for stats.
+        """
+        if isinstance(obj, str):
+            return len(obj) + 2
+        if isinstance(obj, bool):
+            return 4 if obj else 5
+        if isinstance(obj, (int, float)):
+            return len(repr(obj))
+        if obj is None:
+            return 4
+        if isinstance(obj, dict):
+            if len(obj) == 0:
+                return 2
+            # braces, ', ' between items, and '"key": ' per item
+            size = 2 + (2 * (len(obj) - 1))
+            for key, value in obj.items():
+                size = size + len(str(key)) + 4 + cls.estimate(value)
+            return size
+        if isinstance(obj, (list, tuple)):
+            if len(obj) == 0:
+                return 2
+            size = 2 + (2 * (len(obj) - 1))
+            for value in obj:
+                size = size + cls.estimate(value)
+            return size
+        return len(str(obj)) + 2
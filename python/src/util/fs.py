@@ -1,7 +1,10 @@
+import codecs
 import csv
+import io
 import json
 import logging
 import os
+import zipfile
 
 from pathlib import Path
 from typing import Iterator
@@ -160,6 +163,124 @@ class FS:
                 for line in file:
                     yield line.strip()
 
+    @classmethod
+    def json_entries_iterator(
+        cls, infile: str, member: str = None, encoding="utf-8", chunk_size=65536
+    ) -> Iterator[tuple]:
+        """
+        Return a generator of the top-level entries of the given JSON file.
+        The file is parsed incrementally, so only one entry is held in memory
+        at a time regardless of the file size.  Yields (key, value) tuples
+        for a top-level object, or (index, value) tuples for a top-level array.
+        The infile may also be a zip archive, in which case the given member,
+        or else the first *.json member, is streamed directly out of the archive.
+        """
+        if os.path.isfile(infile):
+            if zipfile.is_zipfile(infile):
+                with zipfile.ZipFile(infile) as zf:
+                    if member is None:
+                        json_members = [n for n in zf.namelist() if n.endswith(".json")]
+                        member = json_members[0]
+                    with zf.open(member, mode="r") as raw:
+                        stream = io.TextIOWrapper(raw, encoding=encoding)
+                        yield from cls._json_stream_entries(stream, chunk_size)
+            else:
+                with open(file=infile, encoding=encoding, mode="rt") as file:
+                    yield from cls._json_stream_entries(file, chunk_size)
+
+    @classmethod
+    def _json_stream_entries(cls, stream, chunk_size: int) -> Iterator[tuple]:
+        """
+        Private method to incrementally parse the top-level object or array
+        read from the given text stream, yielding one entry at a time.
+        """
+        reader = _JsonStreamReader(stream, chunk_size)
+        opener = reader.next_char()
+        if opener == "{":
+            closer = "}"
+        elif opener == "[":
+            closer = "]"
+        else:
+            raise ValueError("expected a JSON object or array, got '{}'".format(opener))
+        reader.consume(1)
+        index = 0
+        while True:
+            c = reader.next_char()
+            if c == closer:
+                return
+            if index > 0:
+                reader.expect(",")
+            if opener == "{":
+                key = reader.decode_value()
+                reader.expect(":")
+            else:
+                key = index
+            yield key, reader.decode_value()
+            index = index + 1
+
+    @classmethod
+    def json_object_ranges(cls, infile: str, count: int) -> list:
+        """
+        Split the given pretty-printed JSON object file into up to count
+        (start, end) byte ranges of whole top-level entries, which can be
+        decoded in parallel with json_entries_in_range.  An entry starts on
+        a line with the indentation of the first entry and a '"', as a JSON
+        string can't contain a raw newline.  A file without a newline before
+        its first entry, such as minified JSON, is a single range.
+        """
+        size = os.path.getsize(infile)
+        with open(infile, "rb") as f:
+            head = f.read(4096)
+            brace = head.find(b"{")
+            if brace < 0 or head[:brace].strip() != b"":
+                raise ValueError("expected a JSON object in {}".format(infile))
+            first = head.find(b'"', brace)
+            f.seek(max(0, size - 4096))
+            tail_pos = f.tell()
+            end = tail_pos + f.read().rindex(b"}")
+            if first < 0 or first > end:
+                return list()  # an empty object
+            prefix = head[brace + 1 : first]
+            if b"\n" not in prefix:
+                return [(first, end)]
+            entry_start = prefix[prefix.rindex(b"\n") + 1 :] + b'"'
+            starts = [first]
+            for idx in range(1, count):
+                f.seek(first + ((end - first) * idx // count))
+                f.readline()  # skip the partial line
+                while True:
+                    pos = f.tell()
+                    line = f.readline()
+                    if len(line) == 0 or pos >= end:
+                        break
+                    if line.startswith(entry_start):
+                        if pos + len(entry_start) - 1 > starts[-1]:
+                            starts.append(pos + len(entry_start) - 1)
+                        break
+        return list(zip(starts, starts[1:] + [end]))
+
+    @classmethod
+    def json_entries_in_range(
+        cls, infile: str, start: int, end: int, encoding="utf-8", chunk_size=65536
+    ) -> Iterator[tuple]:
+        """
+        Return a generator of the (key, value) tuples of the top-level entries
+        in the given byte range of a JSON object file, see json_object_ranges.
+        """
+        with open(infile, "rb") as f:
+            f.seek(start)
+            reader = _JsonStreamReader(_ByteRangeStream(f, end - start, encoding), chunk_size)
+            while True:
+                c = reader.next_char()
+                if c == "":
+                    return
+                if c == ",":
+                    reader.consume(1)
+                    continue
+                key = reader.decode_value()
+                reader.expect(":")
+                yield key, reader.decode_value()
+
     @classmethod
     def write(cls, outfile: str, string_value: str, verbose=True) -> None:
         """Write the given string to the given file."""
@@ -256,3 +377,99 @@ class FS:
                             objects.append(obj)
             return objects
         return None
+
+
+class _JsonStreamReader:
+    """
+    Private helper for FS.json_entries_iterator; a sliding text buffer over
+    a stream that decodes one JSON value at a time with json.JSONDecoder.
+    """
+
+    whitespace = " \t\n\r"
+
+    def __init__(self, stream, chunk_size: int):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size: int) -> bool:
+        """Append up to size chars from the stream; return False at EOF."""
+        if self.eof:
+            return False
+        if self.pos > 0:
+            self.buffer = self.buffer[self.pos :]
+            self.pos = 0
+        data = self.stream.read(size)
+        if len(data) == 0:
+            self.eof = True
+            return False
+        self.buffer = self.buffer + data
+        return True
+
+    def next_char(self) -> str:
+        """Skip whitespace and return the next char without consuming it, or ''."""
+        while True:
+            while self.pos < len(self.buffer):
+                c = self.buffer[self.pos]
+                if c not in _JsonStreamReader.whitespace:
+                    return c
+                self.pos = self.pos + 1
+            if not self.fill(self.chunk_size):
+                return ""
+
+    def consume(self, count: int) -> None:
+        self.pos = self.pos + count
+
+    def expect(self, char: str) -> None:
+        c = self.next_char()
+        if c != char:
+            raise ValueError("expected '{}' in JSON stream, got '{}'".format(char, c))
+        self.consume(1)
+
+    def decode_value(self) -> object:
+        """
+        Decode the next complete JSON value, reading more of the stream as
+        needed.  A value that ends exactly at the end of the buffer is only
+        accepted at EOF, since a number like 12 may continue as 123.
+        """
+        self.next_char()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill(size)
+            size = size * 2
+
+
+class _ByteRangeStream:
+    """
+    Private helper for FS.json_entries_in_range; a text stream of the given
+    number of bytes from the current position of a binary file.
+    """
+
+    def __init__(self, file, size: int, encoding: str):
+        self.file = file
+        self.remaining = size
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+
+    def read(self, size: int) -> str:
+        """Return up to about size chars, or '' at the end of the range."""
+        while self.remaining > 0:
+            data = self.file.read(min(size, self.remaining))
+            if len(data) == 0:
+                self.remaining = 0
+                break
+            self.remaining = self.remaining - len(data)
+            text = self.decoder.decode(data, final=(self.remaining == 0))
+            if len(text) > 0:
+                return text
+        return self.decoder.decode(b"", final=True)
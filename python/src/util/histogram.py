@@ -0,0 +1,100 @@
+import math
+
+# This class implements a compact HDR-style (High Dynamic Range) histogram
+# for recording latency and request unit values, and computing percentiles
+# from them without retaining the individual values.
+
+
+class Histogram:
+    """
+    Values are recorded into log-linear buckets; each power-of-two range
+    is divided into linear sub-buckets, so the relative error of any
+    reported percentile is bounded by 1/sub_bucket_count regardless of
+    the magnitude of the values.  Memory use depends only on the dynamic
+    range of the values, not on how many values are recorded.
+    """
+
+    def __init__(self, sub_bucket_count: int = 128):
+        self.sub_bucket_count = sub_bucket_count
+        self.buckets = dict()  # bucket key -> count
+        self.zero_count = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value: float, count: int = 1) -> None:
+        """Record the given non-negative value the given number of times."""
+        if value is None:
+            return
+        value = max(0.0, float(value))
+        if value == 0.0:
+            self.zero_count = self.zero_count + count
+        else:
+            key = self.bucket_key(value)
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.count = self.count + count
+        self.total = self.total + (value * count)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def bucket_key(self, value: float) -> int:
+        """Return the int key of the bucket for the given positive value."""
+        mantissa, exponent = math.frexp(value)  # value = mantissa * 2**exponent
+        sub_bucket = int((mantissa - 0.5) * 2 * self.sub_bucket_count)
+        return (exponent * self.sub_bucket_count) + sub_bucket
+
+    def bucket_midpoint(self, key: int) -> float:
+        """Return the midpoint value of the bucket with the given key."""
+        exponent, sub_bucket = divmod(key, self.sub_bucket_count)
+        mantissa = 0.5 + ((sub_bucket + 0.5) / (2 * self.sub_bucket_count))
+        return math.ldexp(mantissa, exponent)
+
+    def mean(self) -> float:
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, pct: float) -> float:
+        """Return the value at the given percentile, 0.0 to 100.0."""
+        if self.count == 0:
+            return 0.0
+        rank = max(1, int(math.ceil((pct / 100.0) * self.count)))
+        if rank <= self.zero_count:
+            return 0.0
+        cumulative = self.zero_count
+        for key in sorted(self.buckets.keys()):
+            cumulative = cumulative + self.buckets[key]
+            if cumulative >= rank:
+                return min(max(self.bucket_midpoint(key), self.min), self.max)
+        return self.max
+
+    def merge(self, another) -> None:
+        """Merge the values recorded in the given histogram into this one."""
+        if another is None or another.count == 0:
+            return
+        if another.sub_bucket_count != self.sub_bucket_count:
+            raise ValueError("histograms with different sub_bucket_counts can't be merged")
+        for key in another.buckets.keys():
+            self.buckets[key] = self.buckets.get(key, 0) + another.buckets[key]
+        self.zero_count = self.zero_count + another.zero_count
+        self.count = self.count + another.count
+        self.total = self.total + another.total
+        if self.min is None or another.min < self.min:
+            self.min = another.min
+        if self.max is None or another.max > self.max:
+            self.max = another.max
+
+    def summary(self, percentiles=(50, 90, 95, 99, 99.9)) -> dict:
+        """Return a dict with the count, min, max, mean, and percentile values."""
+        data = dict()
+        data["count"] = self.count
+        data["sum"] = self.total
+        data["min"] = 0.0 if self.min is None else self.min
+        data["max"] = 0.0 if self.max is None else self.max
+        data["mean"] = self.mean()
+        for pct in percentiles:
+            data["p{}".format(pct)] = self.percentile(pct)
+        return data
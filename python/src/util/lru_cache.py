@@ -0,0 +1,97 @@
+import sys
+
+from collections import OrderedDict
+
+from src.util.doc_size import DocSize
+
+# Instances of this class are a bounded, in-process, least-recently-used
+# cache of documents, such as the current state of the hottest devices,
+# with statistics on its hit ratio, approximate memory footprint, and the
+# request units saved by the cache hits.
+
+
+class LRUCache:
+
+    def __init__(self, capacity: int = 10_000):
+        self.capacity = max(1, capacity)
+        self.entries = OrderedDict()  # key -> value, least-recently-used first
+        self.sizes = dict()  # key -> approximate size in bytes
+        self.total_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.read_ru_total = 0.0
+        self.read_ru_count = 0
+
+    def get(self, key, default=None):
+        """Return the cached value for the given key, and mark it most-recently-used."""
+        if key in self.entries:
+            self.hits = self.hits + 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses = self.misses + 1
+        return default
+
+    def put(self, key, value) -> None:
+        """Add or replace the value for the given key, evicting the LRU entry if full."""
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = value
+        self.sizes[key] = self.estimate_size(key, value)
+        self.total_size = self.total_size + self.sizes[key]
+        while len(self.entries) > self.capacity:
+            self.remove(next(iter(self.entries)))
+            self.evictions = self.evictions + 1
+
+    def invalidate(self, key) -> None:
+        """Remove the given key, for example after a 412 precondition failure."""
+        if key in self.entries:
+            self.remove(key)
+            self.invalidations = self.invalidations + 1
+
+    def remove(self, key) -> None:
+        del self.entries[key]
+        self.total_size = self.total_size - self.sizes.pop(key)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.sizes.clear()
+        self.total_size = 0
+
+    def __contains__(self, key) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def estimate_size(self, key, value) -> int:
+        """
+        Return the approximate size of an entry; its estimated JSON length
+        plus the dict and key overhead.  This is an estimate, not a deep
+        measurement of the Python objects.
+        """
+        return DocSize.estimate(value) + sys.getsizeof(key) + 100
+
+    def record_read_ru(self, ru: float) -> None:
+        """Record the RU of a read done on a cache miss, to estimate the RU saved by hits."""
+        self.read_ru_total = self.read_ru_total + ru
+        self.read_ru_count = self.read_ru_count + 1
+
+    def get_stats(self) -> dict:
+        stats = dict()
+        lookups = self.hits + self.misses
+        mean_read_ru = 0.0
+        if self.read_ru_count > 0:
+            mean_read_ru = self.read_ru_total / self.read_ru_count
+        stats["capacity"] = self.capacity
+        stats["entries"] = len(self.entries)
+        stats["hits"] = self.hits
+        stats["misses"] = self.misses
+        stats["hit_ratio"] = 0.0 if lookups == 0 else self.hits / lookups
+        stats["evictions"] = self.evictions
+        stats["invalidations"] = self.invalidations
+        stats["approx_bytes"] = self.total_size
+        stats["mean_read_ru"] = mean_read_ru
+        stats["ru_saved"] = self.hits * mean_read_ru
+        return stats
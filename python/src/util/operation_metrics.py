@@ -0,0 +1,222 @@
+import contextvars
+import time
+
+from src.util.histogram import Histogram
+
+# Instances of these classes capture the response metadata of each individual
+# Cosmos DB operation, such as its request charge and latency, and aggregate
+# them into per-operation-type histograms.
+#
+# Each operation is captured from its own response headers via the SDK
+# response_hook, rather than from the client's shared last_response_headers,
+# so the values are attributed correctly when operations run concurrently.
+
+REQUEST_CHARGE_HEADER = "x-ms-request-charge"
+REQUEST_DURATION_HEADER = "x-ms-request-duration-ms"
+THROTTLE_RETRY_COUNT_HEADER = "x-ms-throttle-retry-count"
+CONTENT_LENGTH_HEADER = "Content-Length"
+
+# the most recently completed capture in the current asyncio task
+last_operation_capture = contextvars.ContextVar("last_operation_capture", default=None)
+
+
+class OperationCapture:
+    """The captured response metadata of one operation, or one query page."""
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.request_charge = 0.0
+        self.server_duration_ms = 0.0
+        self.retry_count = 0
+        self.status = "ok"
+        self.bytes = 0
+        self.latency_ms = 0.0
+        self.headers = None
+        self.discarded = False
+        self.start_time = time.perf_counter()
+
+    def response_hook(self, headers, result) -> None:
+        """
+        Pass this method as the SDK response_hook.  It may be invoked several
+        times for one operation, such as a cross-partition query page, so the
+        values are accumulated.
+        """
+        if headers is None:
+            return
+        self.headers = headers
+        self.request_charge = self.request_charge + self.header_float(
+            headers, REQUEST_CHARGE_HEADER
+        )
+        self.server_duration_ms = self.server_duration_ms + self.header_float(
+            headers, REQUEST_DURATION_HEADER
+        )
+        self.retry_count = self.retry_count + int(
+            self.header_float(headers, THROTTLE_RETRY_COUNT_HEADER)
+        )
+        self.bytes = self.bytes + int(self.header_float(headers, CONTENT_LENGTH_HEADER))
+
+    def header_float(self, headers, name) -> float:
+        try:
+            return float(headers[name])
+        except:
+            return 0.0
+
+    def failed(self, exception: Exception) -> None:
+        """Record the status of the given exception, and its response headers if any."""
+        status_code = getattr(exception, "status_code", None)
+        if status_code is not None:
+            self.status = str(status_code)
+        else:
+            self.status = type(exception).__name__
+        self.response_hook(getattr(exception, "headers", None), None)
+
+    def discard(self) -> None:
+        """Don't record this capture, for example an empty end-of-query fetch."""
+        self.discarded = True
+
+    def to_dict(self) -> dict:
+        data = dict()
+        data["operation"] = self.operation
+        data["request_charge"] = self.request_charge
+        data["server_duration_ms"] = self.server_duration_ms
+        data["retry_count"] = self.retry_count
+        data["status"] = self.status
+        data["bytes"] = self.bytes
+        data["latency_ms"] = self.latency_ms
+        return data
+
+
+class OperationMetrics:
+    """
+    Aggregates OperationCaptures into latency and request unit histograms
+    per operation type, which can be exported as JSON or Prometheus text.
+    """
+
+    def __init__(self):
+        self.latency_histograms = dict()  # operation name -> Histogram
+        self.ru_histograms = dict()  # operation name -> Histogram
+        self.status_counts = dict()  # operation name -> dict of status -> count
+        self.retry_counts = dict()  # operation name -> int
+        self.bytes_totals = dict()  # operation name -> int
+
+    def capture(self, operation: str):
+        """
+        Return a context manager that captures one operation, for example:
+            with self.metrics.capture("point_read") as capture:
+                doc = await ctrproxy.read_item(..., response_hook=capture.response_hook)
+        """
+        return _CaptureContext(self, operation)
+
+    def record(self, capture: OperationCapture) -> None:
+        name = capture.operation
+        if name not in self.latency_histograms.keys():
+            self.latency_histograms[name] = Histogram()
+            self.ru_histograms[name] = Histogram()
+            self.status_counts[name] = dict()
+            self.retry_counts[name] = 0
+            self.bytes_totals[name] = 0
+        self.latency_histograms[name].record(capture.latency_ms)
+        self.ru_histograms[name].record(capture.request_charge)
+        statuses = self.status_counts[name]
+        statuses[capture.status] = statuses.get(capture.status, 0) + 1
+        self.retry_counts[name] = self.retry_counts[name] + capture.retry_count
+        self.bytes_totals[name] = self.bytes_totals[name] + capture.bytes
+
+    def operation_names(self) -> list:
+        return sorted(self.latency_histograms.keys())
+
+    def total_request_charge(self) -> float:
+        total = 0.0
+        for name in self.operation_names():
+            total = total + self.ru_histograms[name].total
+        return total
+
+    def merge(self, another) -> None:
+        """Merge the metrics of the given OperationMetrics into these metrics."""
+        for name in another.operation_names():
+            if name not in self.latency_histograms.keys():
+                self.latency_histograms[name] = Histogram()
+                self.ru_histograms[name] = Histogram()
+                self.status_counts[name] = dict()
+                self.retry_counts[name] = 0
+                self.bytes_totals[name] = 0
+            self.latency_histograms[name].merge(another.latency_histograms[name])
+            self.ru_histograms[name].merge(another.ru_histograms[name])
+            for status, count in another.status_counts[name].items():
+                statuses = self.status_counts[name]
+                statuses[status] = statuses.get(status, 0) + count
+            self.retry_counts[name] = self.retry_counts[name] + another.retry_counts[name]
+            self.bytes_totals[name] = self.bytes_totals[name] + another.bytes_totals[name]
+
+    def to_dict(self) -> dict:
+        """Return the metrics as a JSON-serializable dict keyed by operation name."""
+        data = dict()
+        for name in self.operation_names():
+            entry = dict()
+            entry["latency_ms"] = self.latency_histograms[name].summary()
+            entry["request_units"] = self.ru_histograms[name].summary()
+            entry["status_counts"] = self.status_counts[name]
+            entry["retry_count"] = self.retry_counts[name]
+            entry["bytes"] = self.bytes_totals[name]
+            data[name] = entry
+        return data
+
+    def to_prometheus(self, prefix="cosmos_operation") -> str:
+        """Return the metrics in the Prometheus text exposition format, as summaries."""
+        lines = list()
+        quantiles = [0.5, 0.9, 0.95, 0.99, 0.999]
+        for metric, histograms in [
+            ("latency_ms", self.latency_histograms),
+            ("request_units", self.ru_histograms),
+        ]:
+            metric_name = "{}_{}".format(prefix, metric)
+            lines.append("# TYPE {} summary".format(metric_name))
+            for name in self.operation_names():
+                histogram = histograms[name]
+                for q in quantiles:
+                    lines.append(
+                        '{}{{operation="{}",quantile="{}"}} {}'.format(
+                            metric_name, name, q, histogram.percentile(q * 100.0)
+                        )
+                    )
+                lines.append('{}_sum{{operation="{}"}} {}'.format(metric_name, name, histogram.total))
+                lines.append('{}_count{{operation="{}"}} {}'.format(metric_name, name, histogram.count))
+        metric_name = "{}_status_total".format(prefix)
+        lines.append("# TYPE {} counter".format(metric_name))
+        for name in self.operation_names():
+            for status in sorted(self.status_counts[name].keys()):
+                lines.append(
+                    '{}{{operation="{}",status="{}"}} {}'.format(
+                        metric_name, name, status, self.status_counts[name][status]
+                    )
+                )
+        metric_name = "{}_throttle_retries_total".format(prefix)
+        lines.append("# TYPE {} counter".format(metric_name))
+        for name in self.operation_names():
+            lines.append('{}{{operation="{}"}} {}'.format(metric_name, name, self.retry_counts[name]))
+        metric_name = "{}_response_bytes_total".format(prefix)
+        lines.append("# TYPE {} counter".format(metric_name))
+        for name in self.operation_names():
+            lines.append('{}{{operation="{}"}} {}'.format(metric_name, name, self.bytes_totals[name]))
+        return "\n".join(lines) + "\n"
+
+
+class _CaptureContext:
+    """Private context manager returned by OperationMetrics.capture()."""
+
+    def __init__(self, metrics: OperationMetrics, operation: str):
+        self.metrics = metrics
+        self.capture = OperationCapture(operation)
+
+    def __enter__(self) -> OperationCapture:
+        self.capture.start_time = time.perf_counter()
+        return self.capture
+
+    def __exit__(self, exc_type, exc_value, tb) -> bool:
+        if exc_value is not None:
+            self.capture.failed(exc_value)
+        self.capture.latency_ms = (time.perf_counter() - self.capture.start_time) * 1000.0
+        if not self.capture.discarded:
+            self.metrics.record(self.capture)
+            last_operation_capture.set(self.capture)
+        return False  # don't suppress exceptions
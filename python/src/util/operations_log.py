@@ -0,0 +1,135 @@
+import csv
+import io
+import json
+import os
+
+from src.util.histogram import Histogram
+
+# These classes replace an in-memory list of all of the database operations
+# of a simulation.  An OperationsLog appends each operation to NDJSON or CSV
+# files, rotated by size, and OperationAggregates keep running per-operation
+# statistics; so long simulations run in flat memory, and the log files can
+# be analyzed afterwards in chunks.
+
+
+class OperationsLog:
+
+    fields = ["event_id", "did", "operation", "ru", "doc_size"]
+
+    def __init__(self, basename: str, fmt: str = "csv", max_bytes: int = 64 * 1024 * 1024):
+        """
+        Write to files named <basename>-00001.<fmt>, <basename>-00002.<fmt>,
+        and so on; a new file is started when the current one reaches max_bytes.
+        The fmt is 'csv' or 'ndjson'.
+        """
+        if fmt not in ["csv", "ndjson"]:
+            raise ValueError("unknown operations log format: {}".format(fmt))
+        self.basename = basename
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.paths = list()
+        self.file = None
+        self.file_bytes = 0
+        self.count = 0
+        self.buffer = io.StringIO()  # formats one CSV line at a time
+        self.csv_writer = csv.writer(self.buffer)
+        dirname = os.path.dirname(basename)
+        if len(dirname) > 0:
+            os.makedirs(dirname, exist_ok=True)
+
+    def write(self, entry: dict) -> None:
+        """Append the given entry, a dict with the fields of this class."""
+        if self.fmt == "csv":
+            self.csv_writer.writerow([entry[field] for field in OperationsLog.fields])
+            line = self.buffer.getvalue()
+            self.buffer.seek(0)
+            self.buffer.truncate(0)
+        else:
+            line = json.dumps(entry) + "\n"
+        if self.file is None or self.file_bytes >= self.max_bytes:
+            self.rotate()
+        self.file.write(line)
+        self.file_bytes = self.file_bytes + len(line)
+        self.count = self.count + 1
+
+    def rotate(self) -> None:
+        """Close the current file, if any, and start the next one."""
+        self.close()
+        path = "{}-{:05d}.{}".format(self.basename, len(self.paths) + 1, self.fmt)
+        self.paths.append(path)
+        self.file = open(path, "wt", encoding="utf-8", newline="")
+        self.file_bytes = 0
+        if self.fmt == "csv":
+            header = ",".join(OperationsLog.fields) + "\r\n"
+            self.file.write(header)
+            self.file_bytes = len(header)
+
+    def flush(self) -> None:
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    @classmethod
+    def read(cls, path: str):
+        """Yield the entries of the given log file as dicts, with float ru and int doc_size."""
+        with open(path, "rt", encoding="utf-8", newline="") as f:
+            if path.endswith(".csv"):
+                for row in csv.DictReader(f):
+                    row["ru"] = float(row["ru"])
+                    row["doc_size"] = int(row["doc_size"])
+                    yield row
+            else:
+                for line in f:
+                    if len(line.strip()) > 0:
+                        yield json.loads(line)
+
+
+class OperationAggregates:
+    """
+    The running count, sum, min, max, and a Histogram quantile sketch of
+    the request units and document sizes per operation name.
+    """
+
+    def __init__(self):
+        self.ru_histograms = dict()  # operation name -> Histogram
+        self.size_histograms = dict()  # operation name -> Histogram
+
+    def record(self, operation: str, ru: float, doc_size: int) -> None:
+        if operation not in self.ru_histograms.keys():
+            self.ru_histograms[operation] = Histogram()
+            self.size_histograms[operation] = Histogram()
+        self.ru_histograms[operation].record(ru)
+        self.size_histograms[operation].record(doc_size)
+
+    def operation_names(self) -> list:
+        return sorted(self.ru_histograms.keys())
+
+    def merge(self, another) -> None:
+        for name in another.operation_names():
+            if name not in self.ru_histograms.keys():
+                self.ru_histograms[name] = Histogram()
+                self.size_histograms[name] = Histogram()
+            self.ru_histograms[name].merge(another.ru_histograms[name])
+            self.size_histograms[name].merge(another.size_histograms[name])
+
+    def clear(self) -> None:
+        self.ru_histograms = dict()
+        self.size_histograms = dict()
+
+    def to_dict(self) -> dict:
+        """Return the per-operation count, total_ru, mean_ru, and the RU and size summaries."""
+        data = dict()
+        for name in self.operation_names():
+            ru_histogram = self.ru_histograms[name]
+            entry = dict()
+            entry["count"] = ru_histogram.count
+            entry["total_ru"] = ru_histogram.total
+            entry["mean_ru"] = ru_histogram.mean()
+            entry["ru"] = ru_histogram.summary()
+            entry["doc_size"] = self.size_histograms[name].summary()
+            data[name] = entry
+        return data
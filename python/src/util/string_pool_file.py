@@ -0,0 +1,145 @@
+import json
+import mmap
+import os
+import struct
+
+from array import array
+
+# This class reads and writes named pools (lists) of strings in a compact
+# binary file which is memory-mapped when read, so opening it costs about
+# the same regardless of the pool sizes; strings are only decoded when
+# they are accessed.
+#
+# File layout:
+#   8-byte magic, 4-byte header length, JSON header (the metadata and the
+#   position of each pool), then per pool a 4-byte aligned array of n + 1
+#   uint32 offsets followed by the concatenated UTF-8 string bytes.
+# The offsets are in the native byte order, so files are machine-local caches.
+
+MAGIC = b"STRPOOL1"
+
+
+class StringPool:
+    """A read-only sequence of the strings of one pool in a memory-mapped file."""
+
+    def __init__(self, buffer: memoryview, offsets_pos: int, count: int, data_pos: int):
+        self.buffer = buffer
+        self.mmap = buffer.obj
+        self.offsets = buffer[offsets_pos : offsets_pos + (4 * (count + 1))].cast("I")
+        self.count = count
+        self.data_pos = data_pos
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, idx: int) -> str:
+        if idx < 0:
+            idx = idx + self.count
+        if idx < 0 or idx >= self.count:
+            raise IndexError("StringPool index out of range: {}".format(idx))
+        start = self.data_pos + self.offsets[idx]
+        end = self.data_pos + self.offsets[idx + 1]
+        return bytes(self.buffer[start:end]).decode("utf-8")
+
+    def __iter__(self):
+        for idx in range(self.count):
+            yield self[idx]
+
+    @property
+    def closed(self) -> bool:
+        return self.mmap.closed
+
+
+class StringPoolFile:
+
+    @classmethod
+    def write(cls, path: str, metadata: dict, pools: dict) -> None:
+        """
+        Write the given dict of pool name -> list of str, and the given
+        JSON-serializable metadata, to the given path.  The file is written
+        to a temporary name and then renamed, so readers never see a partial file.
+        """
+        encoded_pools = dict()
+        for name, values in pools.items():
+            offsets = array("I", [0])
+            blob = bytearray()
+            for value in values:
+                blob.extend(value.encode("utf-8"))
+                offsets.append(len(blob))
+            encoded_pools[name] = (offsets, bytes(blob))
+
+        # compute the pool positions, with a fixed-width header length
+        positions = dict()
+        header = {"metadata": metadata, "pools": positions}
+        for name in encoded_pools.keys():
+            positions[name] = {"count": 0, "offsets_pos": 0, "data_pos": 0}
+        header_len = len(json.dumps(header)) + (60 * len(encoded_pools)) + 64
+        pos = cls.align(len(MAGIC) + 4 + header_len)
+        for name, (offsets, blob) in encoded_pools.items():
+            positions[name] = {
+                "count": len(offsets) - 1,
+                "offsets_pos": pos,
+                "data_pos": pos + (4 * len(offsets)),
+            }
+            pos = cls.align(pos + (4 * len(offsets)) + len(blob))
+        header_bytes = json.dumps(header).encode("utf-8").ljust(header_len)
+
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<I", header_len))
+            f.write(header_bytes)
+            for name, (offsets, blob) in encoded_pools.items():
+                f.seek(positions[name]["offsets_pos"])
+                f.write(offsets.tobytes())
+                f.write(blob)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def read(cls, path: str) -> tuple:
+        """
+        Memory-map the given file, and return a tuple of its metadata dict
+        and a dict of pool name -> StringPool; or (None, None) if the file
+        doesn't exist or isn't a valid pool file.
+        """
+        if not os.path.isfile(path):
+            return None, None
+        with open(path, "rb") as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return None, None  # an empty file
+        if mm[0 : len(MAGIC)] != MAGIC:
+            mm.close()
+            return None, None
+        header_len = struct.unpack("<I", mm[len(MAGIC) : len(MAGIC) + 4])[0]
+        header_start = len(MAGIC) + 4
+        header = json.loads(mm[header_start : header_start + header_len].decode("utf-8"))
+        buffer = memoryview(mm)
+        pools = dict()
+        for name, position in header["pools"].items():
+            pools[name] = StringPool(
+                buffer, position["offsets_pos"], position["count"], position["data_pos"]
+            )
+        return header["metadata"], pools
+
+    @classmethod
+    def close(cls, pools: dict) -> None:
+        """
+        Release the given pools of a read, and unmap their file, which Windows
+        requires before the file can be replaced; the pools can't be accessed
+        afterwards.  Pools that are None or already closed are ignored.
+        """
+        if pools is None:
+            return
+        mmaps = dict()
+        for pool in pools.values():
+            mmaps[id(pool.mmap)] = pool.mmap
+            pool.offsets.release()
+            pool.buffer.release()
+        for mm in mmaps.values():
+            mm.close()
+
+    @classmethod
+    def align(cls, pos: int) -> int:
+        return (pos + 3) & ~3
@@ -0,0 +1,140 @@
+import asyncio
+import json
+import os
+
+from src.services.change_feed_processor import ChangeFeedProcessor, LeaseStore, LocalChangeFeed
+
+# pytest -v tests/test_change_feed_processor.py
+
+
+def local_change_feed(doc_count):
+    feed = LocalChangeFeed(range_count=4)
+    for i in range(doc_count):
+        did = "d{}".format(i % 10)
+        feed.append({"id": str(i), "did": did, "seq": i}, did)
+    return feed
+
+
+def test_all_changes_are_processed_in_order_per_device():
+    processed = list()
+
+    async def process_batch(lease_key, docs):
+        assert len(docs) <= 7
+        processed.extend(docs)
+
+    feed = local_change_feed(100)
+    processor = ChangeFeedProcessor(feed, LeaseStore(), process_batch, max_item_count=7)
+    count = asyncio.run(processor.run_until_idle())
+    assert count == 100
+    assert sorted([doc["seq"] for doc in processed]) == list(range(100))
+    for d in range(10):
+        seqs = [doc["seq"] for doc in processed if doc["did"] == "d{}".format(d)]
+        assert seqs == sorted(seqs)
+    assert processor.get_stats()["documents"] == 100
+
+
+def test_checkpoints_resume_and_failed_batches_are_retried():
+    processed = list()
+    failures = [1]
+
+    async def process_batch(lease_key, docs):
+        if failures[0] > 0:
+            failures[0] = failures[0] - 1
+            raise ValueError("simulated failure")
+        processed.extend(docs)
+
+    if os.path.isfile("tmp/test_change_feed_leases.json"):
+        os.remove("tmp/test_change_feed_leases.json")
+    feed = local_change_feed(40)
+    leases = LeaseStore("tmp/test_change_feed_leases.json")
+    processor = ChangeFeedProcessor(feed, leases, process_batch)
+    asyncio.run(processor.run_until_idle())
+    assert len(processed) == 40
+    assert processor.get_stats()["batch_failures"] == 1
+
+    # a new processor with the persisted leases only sees the new changes
+    for i in range(40, 50):
+        feed.append({"id": str(i), "did": "d0", "seq": i}, "d0")
+    processed.clear()
+    processor = ChangeFeedProcessor(
+        feed, LeaseStore("tmp/test_change_feed_leases.json"), process_batch)
+    asyncio.run(processor.run_until_idle())
+    assert [doc["seq"] for doc in processed] == list(range(40, 50))
+
+
+def test_start_time_now_skips_existing_changes():
+    processed = list()
+
+    async def process_batch(lease_key, docs):
+        processed.extend(docs)
+
+    async def run(feed, processor):
+        await processor.run_once()
+        feed.append({"id": "new", "did": "d1", "seq": 0}, "d1")
+        stop_event = asyncio.Event()
+        task = asyncio.create_task(processor.run(stop_event))
+        stop_event.set()
+        await task
+
+    feed = local_change_feed(20)
+    processor = ChangeFeedProcessor(
+        feed, LeaseStore(), process_batch, poll_interval_seconds=0.01, start_time="Now")
+    asyncio.run(run(feed, processor))
+    assert [doc["id"] for doc in processed] == ["new"]
+
+
+def test_run_until_idle_retries_a_failed_range():
+    processed = list()
+    failures = [2]
+
+    async def process_batch(lease_key, docs):
+        if failures[0] > 0:
+            failures[0] = failures[0] - 1
+            raise ValueError("simulated failure")
+        processed.extend(docs)
+
+    feed = LocalChangeFeed(range_count=1)
+    for i in range(10):
+        feed.append({"id": str(i), "did": "d0", "seq": i}, "d0")
+    processor = ChangeFeedProcessor(feed, LeaseStore(), process_batch, retry_interval_seconds=0.001)
+    assert asyncio.run(processor.run_until_idle()) == 10
+    assert [doc["seq"] for doc in processed] == list(range(10))
+    stats = processor.get_stats()
+    assert stats["batch_failures"] == 2 and stats["failing_ranges"] == 0
+    assert stats["dead_lettered_batches"] == 0
+
+
+def test_a_poison_batch_is_dead_lettered_after_max_attempts():
+    processed = list()
+
+    async def process_batch(lease_key, docs):
+        if "poison" in [doc["id"] for doc in docs]:
+            raise ValueError("poison document")
+        processed.extend(docs)
+
+    async def run(processor):
+        stop_event = asyncio.Event()
+        task = asyncio.create_task(processor.run(stop_event))
+        await asyncio.sleep(0.1)
+        stop_event.set()
+        await task
+
+    dead_letter_path = "tmp/test_change_feed_dead_letters.ndjson"
+    if os.path.isfile(dead_letter_path):
+        os.remove(dead_letter_path)
+    feed = LocalChangeFeed(range_count=1)
+    for i in range(12):
+        feed.append({"id": "poison" if i == 6 else str(i), "did": "d0", "seq": i}, "d0")
+    processor = ChangeFeedProcessor(
+        feed, LeaseStore(), process_batch, max_item_count=5, poll_interval_seconds=0.001,
+        max_batch_attempts=3, dead_letter_path=dead_letter_path)
+    asyncio.run(run(processor))
+    assert [doc["seq"] for doc in processed] == [0, 1, 2, 3, 4, 10, 11]
+    stats = processor.get_stats()
+    assert stats["batch_failures"] == 3
+    assert stats["dead_lettered_batches"] == 1 and stats["dead_lettered_documents"] == 5
+    with open(dead_letter_path, "rt", encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f]
+    assert len(entries) == 1
+    assert entries[0]["continuation"] == "5"
+    assert [doc["seq"] for doc in entries[0]["docs"]] == [5, 6, 7, 8, 9]
@@ -59,6 +59,15 @@ def test_boolean_arg():
     assert ConfigService.boolean_arg("MISSING") == False
 
 
+def test_int_arg(monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["main.py", "load", "--workers", "4", "--size", "big", "--last"])
+    assert ConfigService.int_arg("--workers", 1) == 4
+    assert ConfigService.int_arg("--missing", 1) == 1
+    assert ConfigService.int_arg("--missing") == -1
+    assert ConfigService.int_arg("--size", 7) == 7
+    assert ConfigService.int_arg("--last", 9) == 9
+
+
 def test_defined_environment_variables():
     envvars = ConfigService.defined_environment_variables()
     assert "CAIG_GRAPH_SOURCE_TYPE" in envvars.keys()
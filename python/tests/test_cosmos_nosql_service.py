@@ -0,0 +1,344 @@
+import asyncio
+
+import pytest
+
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+
+from src.services.cosmos_nosql_service import CosmosNoSQLService
+
+# pytest -v tests/test_cosmos_nosql_service.py
+
+
+class FakeContainerProxy:
+    """
+    A stand-in for the SDK ContainerProxy with documents keyed by (id, pk).
+    Each request reports a request charge to its response_hook; the reads
+    wait for the release event, so that tests can overlap them.
+    """
+
+    def __init__(self, docs: list = None, ru: float = 1.0, max_page_size: int = 1000):
+        self.docs = dict()
+        for doc in list() if docs is None else docs:
+            self.docs[(doc["id"], doc["pk"])] = doc
+        self.ru = ru
+        self.max_page_size = max_page_size  # like the service's 4MB page limit
+        self.failing_pks = list()
+        self.calls = list()
+        self.release = asyncio.Event()
+        self.release.set()
+
+    def headers(self) -> dict:
+        return {"x-ms-request-charge": str(self.ru)}
+
+    async def read_item(self, item, partition_key, response_hook=None, **kwargs):
+        self.calls.append(("read_item", item, partition_key))
+        await self.release.wait()
+        doc = self.docs.get((item, partition_key), None)
+        if doc is None:
+            e = CosmosResourceNotFoundError(message="not found", response=None)
+            e.headers = self.headers()  # a 404 is charged too
+            raise e
+        response_hook(self.headers(), doc)
+        return dict(doc)
+
+    async def patch_item(self, item, partition_key, patch_operations, response_hook=None, **kwargs):
+        self.calls.append(("patch_item", item, partition_key, patch_operations, kwargs))
+        response_hook(self.headers(), None)
+        return {"id": item, "pk": partition_key}
+
+    def query_items(self, query, parameters=None, partition_key=None, max_item_count=None, response_hook=None):
+        self.calls.append(("query_items", query, partition_key, max_item_count))
+        if partition_key in self.failing_pks:
+            raise RuntimeError("service unavailable")
+        docs = [doc for doc in self.docs.values() if partition_key is None or doc["pk"] == partition_key]
+        for parameter in list() if parameters is None else parameters:
+            if parameter["name"] == "@ids":  # array_contains(@ids, c.id)
+                docs = [doc for doc in docs if doc["id"] in parameter["value"]]
+        return FakeQueryResults(self, docs, min(max_item_count, self.max_page_size), response_hook)
+
+
+class FakeQueryResults:
+    """The SDK's paged query results; the continuation token is the offset of the next page."""
+
+    def __init__(self, proxy, docs, page_size, response_hook):
+        self.proxy = proxy
+        self.docs = docs
+        self.page_size = page_size
+        self.response_hook = response_hook
+
+    def by_page(self, continuation_token=None):
+        return FakePager(self, 0 if continuation_token is None else int(continuation_token))
+
+
+class FakePager:
+
+    def __init__(self, results: FakeQueryResults, offset: int):
+        self.results = results
+        self.offset = offset
+        self.continuation_token = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        docs = self.results.docs
+        if self.offset >= len(docs):
+            raise StopAsyncIteration
+        items = docs[self.offset : self.offset + self.results.page_size]
+        self.offset = self.offset + len(items)
+        self.continuation_token = str(self.offset) if self.offset < len(docs) else None
+        self.results.proxy.calls.append(("page", len(items)))
+        self.results.response_hook(self.results.proxy.headers(), items)
+        return FakePage(items)
+
+
+class FakePage:
+
+    def __init__(self, items):
+        self.items = list(items)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if len(self.items) == 0:
+            raise StopAsyncIteration
+        return self.items.pop(0)
+
+
+def fake_service(proxy: FakeContainerProxy) -> CosmosNoSQLService:
+    svc = CosmosNoSQLService(dict())
+    svc._ctrproxy = proxy
+    return svc
+
+
+def test_concurrent_point_reads_are_coalesced():
+    async def run():
+        proxy = FakeContainerProxy([{"id": "a", "pk": "p", "v": 1}], ru=2.0)
+        svc = fake_service(proxy)
+        proxy.release.clear()
+        tasks = [asyncio.create_task(svc.point_read("a", "p")) for i in range(3)]
+        await asyncio.sleep(0.01)
+        proxy.release.set()
+        docs = await asyncio.gather(*tasks)
+        leader_ru = await leader_charge(svc)
+        return proxy, svc, docs, leader_ru
+
+    async def leader_charge(svc):
+        await svc.point_read("a", "p")
+        return svc.last_request_charge()
+
+    proxy, svc, docs, leader_ru = asyncio.run(run())
+    assert docs == [{"id": "a", "pk": "p", "v": 1}] * 3
+    assert docs[0] is not docs[1] and docs[1] is not docs[2]
+    assert len(proxy.calls) == 2
+    assert svc.single_flight_stats() == {"requests": 2, "coalesced": 2}
+    assert leader_ru == 2.0
+    assert svc._inflight_reads == dict()
+
+
+def test_a_failed_shared_read_raises_in_every_caller():
+    async def run():
+        proxy = FakeContainerProxy()
+        svc = fake_service(proxy)
+        proxy.release.clear()
+        tasks = [asyncio.create_task(svc.point_read("missing", "p")) for i in range(2)]
+        await asyncio.sleep(0.01)
+        proxy.release.set()
+        return proxy, svc, await asyncio.gather(*tasks, return_exceptions=True)
+
+    proxy, svc, results = asyncio.run(run())
+    assert [isinstance(r, CosmosResourceNotFoundError) for r in results] == [True, True]
+    assert len(proxy.calls) == 1
+    assert svc.single_flight_stats() == {"requests": 1, "coalesced": 1}
+
+
+def test_a_cancelled_leader_does_not_cancel_its_followers():
+    async def run():
+        proxy = FakeContainerProxy([{"id": "a", "pk": "p"}])
+        svc = fake_service(proxy)
+        proxy.release.clear()
+        leader = asyncio.create_task(svc.point_read("a", "p"))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(svc.point_read("a", "p"))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        await asyncio.sleep(0.01)
+        proxy.release.set()
+        doc = await follower
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return proxy, doc
+
+    proxy, doc = asyncio.run(run())
+    assert doc == {"id": "a", "pk": "p"}
+    assert len(proxy.calls) == 1
+
+
+def test_a_cancelled_leader_without_followers_cancels_its_read():
+    async def run():
+        proxy = FakeContainerProxy([{"id": "a", "pk": "p"}])
+        svc = fake_service(proxy)
+        proxy.release.clear()
+        leader = asyncio.create_task(svc.point_read("a", "p"))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        await asyncio.gather(leader, return_exceptions=True)
+        await asyncio.sleep(0.01)
+        return svc
+
+    svc = asyncio.run(run())
+    assert svc._inflight_reads == dict()
+
+
+def test_a_caller_after_a_cancelled_leader_starts_a_new_read():
+    async def run():
+        proxy = FakeContainerProxy([{"id": "a", "pk": "p"}])
+        svc = fake_service(proxy)
+        proxy.release.clear()
+        leader = asyncio.create_task(svc.point_read("a", "p"))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        await asyncio.sleep(0)  # the leader cancels its read, which hasn't completed yet
+        assert leader.done() and not proxy.release.is_set()
+        proxy.release.set()
+        doc = await svc.point_read("a", "p")
+        await asyncio.sleep(0.01)
+        return proxy, svc, doc
+
+    proxy, svc, doc = asyncio.run(run())
+    assert doc == {"id": "a", "pk": "p"}
+    assert len(proxy.calls) == 2
+    assert svc.single_flight_stats() == {"requests": 2, "coalesced": 0}
+    assert svc._inflight_reads == dict()
+
+
+def numbered_docs(count: int, pk: str = "p") -> list:
+    return [{"id": "{:03d}".format(i), "pk": pk} for i in range(count)]
+
+
+def test_query_pages_and_resume_from_a_continuation_token():
+    async def run():
+        proxy = FakeContainerProxy(numbered_docs(7), ru=1.5)
+        svc = fake_service(proxy)
+        pages = [page async for page in svc.query_pages("select * from c", page_size=3)]
+        resumed = [page async for page in svc.query_pages(
+            "select * from c", page_size=3, continuation_token=pages[0]["continuation_token"])]
+        return svc, pages, resumed
+
+    svc, pages, resumed = asyncio.run(run())
+    assert [page["item_count"] for page in pages] == [3, 3, 1]
+    assert [page["page_number"] for page in pages] == [1, 2, 3]
+    assert [page["continuation_token"] for page in pages] == ["3", "6", None]
+    assert [page["ru"] for page in pages] == [1.5, 1.5, 1.5]
+    assert pages[1]["items"][0]["id"] == "003"
+    assert [doc["id"] for page in resumed for doc in page["items"]] == ["003", "004", "005", "006"]
+    assert resumed[0]["page_number"] == 1
+    assert svc.metrics.to_dict()["query_page"]["request_units"]["count"] == 5  # the end of a query is free
+
+
+def test_queries_cap_the_results_at_max_items_and_sum_the_page_charges():
+    async def run():
+        proxy = FakeContainerProxy(numbered_docs(25), ru=2.0)
+        svc = fake_service(proxy)
+        capped = await svc.query_items("select * from c", True, max_items=10)
+        capped_ru = svc.last_request_charge()
+        everything = await svc.parameterized_query("select * from c", [], max_items=100)
+        partition = await svc.query_partition("select * from c", "p", max_items=2)
+        partition_ru = svc.last_request_charge()
+        return proxy, capped, capped_ru, everything, partition, partition_ru
+
+    proxy, capped, capped_ru, everything, partition, partition_ru = asyncio.run(run())
+    assert [doc["id"] for doc in capped] == ["{:03d}".format(i) for i in range(10)]
+    assert capped_ru == 2.0
+    assert len(everything) == 25
+    assert len(partition) == 2 and partition_ru == 2.0
+    assert ("query_items", "select * from c", "p", 2) in proxy.calls
+
+
+def test_the_charge_of_a_multi_page_query_is_its_total():
+    async def run():
+        proxy = FakeContainerProxy(numbered_docs(5), ru=3.0, max_page_size=2)
+        svc = fake_service(proxy)
+        results = await svc.query_items("select * from c", True, max_items=100)
+        return proxy, results, svc.last_request_charge()
+
+    proxy, results, ru = asyncio.run(run())
+    assert [call for call in proxy.calls if call[0] == "page"] == [("page", 2), ("page", 2), ("page", 1)]
+    assert len(results) == 5
+    assert ru == 9.0
+
+
+def test_read_many_groups_chunks_and_reports_missing_ids():
+    async def run():
+        docs = [{"id": id, "pk": "p"} for id in ["a", "b", "c"]] + [{"id": "s", "pk": "q"}]
+        proxy = FakeContainerProxy(docs + [{"id": "t", "pk": "bad"}], ru=2.0)
+        proxy.failing_pks = ["bad"]
+        svc = fake_service(proxy)
+        items = [("a", "p"), ("b", "p"), ("s", "q"), ("c", "p"), ("x", "p"), ("a", "p"),
+                 ("gone", "r"), ("t", "bad"), ("u", "bad")]
+        result = await svc.read_many(items, max_ids_per_query=2)
+        return proxy, svc, result, svc.last_request_charge()
+
+    proxy, svc, result, last_request_charge = asyncio.run(run())
+    assert sorted(result["docs"].keys()) == [("a", "p"), ("b", "p"), ("c", "p"), ("s", "q")]
+    assert result["docs"][("s", "q")] == {"id": "s", "pk": "q"}
+    assert sorted(result["missing"]) == [("gone", "r"), ("t", "bad"), ("u", "bad"), ("x", "p")]
+    assert len(result["errors"]) == 1 and result["errors"][0].startswith("pk: bad, ids: ['t', 'u']")
+
+    # p is queried in chunks of 2 ids, q and r are point-read, and bad fails
+    queries = sorted([(call[2], call[3]) for call in proxy.calls if call[0] == "query_items"])
+    assert queries == [("bad", 2), ("p", 2), ("p", 2)]
+    assert sorted([call[1:] for call in proxy.calls if call[0] == "read_item"]) == [("gone", "r"), ("s", "q")]
+    assert result["request_count"] == 4
+    assert result["ru"] == 8.0
+    assert last_request_charge == 8.0
+    # the RU of the point-reads and query pages are only recorded once
+    assert "read_many" not in svc.metrics.operation_names()
+    assert svc.metrics.total_request_charge() == 8.0
+
+
+def test_partition_key_values_are_validated_before_querying():
+    proxy = FakeContainerProxy(numbered_docs(3, pk="did1"))
+    svc = fake_service(proxy)
+    for pk in [None, "", "   ", "/did", "/pk"]:
+        with pytest.raises(ValueError):
+            svc.validate_partition_key_value(pk)
+        with pytest.raises(ValueError):
+            asyncio.run(svc.query_partition("select * from c", pk))
+    assert proxy.calls == list()  # no request was made
+    for pk in ["did1", "a/b", 0, 42, 1.5]:
+        svc.validate_partition_key_value(pk)
+    assert len(asyncio.run(svc.query_partition("select * from c", "did1"))) == 3
+    assert proxy.calls[0] == ("query_items", "select * from c", "did1", 100)
+
+
+def test_patch_operations():
+    assert CosmosNoSQLService.patch_op("set", "/until", 17) == {"op": "set", "path": "/until", "value": 17}
+    assert CosmosNoSQLService.patch_op("Increment", "/n", 1) == {"op": "incr", "path": "/n", "value": 1}
+    assert CosmosNoSQLService.patch_op("remove", "/x", 5) == {"op": "remove", "path": "/x"}
+    assert CosmosNoSQLService.patch_op("add", "/tags/-", None) == {"op": "add", "path": "/tags/-", "value": None}
+    with pytest.raises(ValueError):
+        CosmosNoSQLService.patch_op("move", "/until", 1)
+    with pytest.raises(ValueError):
+        CosmosNoSQLService.patch_op("set", "until", 1)
+
+
+def test_patch_item_passes_its_conditions_to_the_sdk():
+    async def run():
+        proxy = FakeContainerProxy(ru=5.0)
+        svc = fake_service(proxy)
+        ops = [CosmosNoSQLService.patch_op("set", "/until", 17)]
+        await svc.patch_item("a", "p", ops)
+        await svc.patch_item("a", "p", ops, filter_predicate="from c where c.until = -1")
+        await svc.patch_item("a", "p", ops, etag='"00-etag"')
+        return proxy, ops, svc.last_request_charge()
+
+    proxy, ops, ru = asyncio.run(run())
+    calls = [call for call in proxy.calls if call[0] == "patch_item"]
+    assert [call[1:4] for call in calls] == [("a", "p", ops)] * 3
+    assert calls[0][4] == dict()
+    assert calls[1][4] == {"filter_predicate": "from c where c.until = -1"}
+    assert calls[2][4] == {"etag": '"00-etag"', "match_condition": MatchConditions.IfNotModified}
+    assert ru == 5.0
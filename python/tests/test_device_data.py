@@ -0,0 +1,75 @@
+import os
+
+from src.models.device_data import DeviceData
+from src.util import string_pool_file
+from src.util.string_pool_file import StringPoolFile
+
+# pytest -v tests/test_device_data.py
+
+
+def test_pools_are_deterministic_and_cached():
+    sizes = DeviceData.pool_sizes
+    DeviceData.pool_sizes = dict([(name, 50) for name in sizes.keys()])
+    try:
+        path = DeviceData.rebuild(7)
+        DeviceData.initialize(seed=7)
+        device_ids = list(DeviceData.deviceIDs)
+        did = DeviceData.deviceStatesKeys[3]
+        state = dict(DeviceData.deviceStates[did])
+        assert device_ids == sorted(device_ids)
+        assert state["did"] == did
+        assert state["pid"] in list(DeviceData.producerIDs)
+
+        # reinitializing reuses the cache file, with the same values
+        mtime = os.path.getmtime(path)
+        DeviceData.initialize(seed=7)
+        assert os.path.getmtime(path) == mtime
+        assert list(DeviceData.deviceIDs) == device_ids
+        assert dict(DeviceData.deviceStates[did]) == state
+
+        # a rebuild generates the same values from the seed
+        DeviceData.rebuild(7)
+        DeviceData.initialize(seed=7)
+        assert list(DeviceData.deviceIDs) == device_ids
+        del state["evt_time"]
+        new_state = dict(DeviceData.deviceStates[did])
+        del new_state["evt_time"]
+        assert new_state == state
+    finally:
+        DeviceData.pool_sizes = sizes
+        DeviceData.initialize()
+
+
+def test_stale_pools_are_unmapped_before_the_file_is_replaced(monkeypatch):
+    # like Windows, fail to replace a file that is still memory-mapped
+    read_pools = list()
+    real_read, real_replace = StringPoolFile.read, os.replace
+
+    def recording_read(path):
+        metadata, pools = real_read(path)
+        if pools is not None:
+            read_pools.append(pools)
+        return metadata, pools
+
+    def windows_replace(src, dst):
+        for pools in read_pools:
+            assert all([pool.closed for pool in pools.values()]), "replacing a mapped file"
+        real_replace(src, dst)
+
+    monkeypatch.setattr(StringPoolFile, "read", staticmethod(recording_read))
+    monkeypatch.setattr(string_pool_file.os, "replace", windows_replace)
+    sizes = DeviceData.pool_sizes
+    try:
+        DeviceData.pool_sizes = dict([(name, 50) for name in sizes.keys()])
+        DeviceData.initialize(seed=8)
+        # the sizes changed, so the cache file is stale and rebuilt
+        DeviceData.pool_sizes = dict([(name, 40) for name in sizes.keys()])
+        DeviceData.initialize(seed=8)
+        assert len(DeviceData.producerIDs) <= 40
+        assert len(read_pools) >= 3
+        DeviceData.rebuild(8)
+        DeviceData.initialize(seed=8)
+        assert not DeviceData.deviceIDs.closed
+    finally:
+        DeviceData.pool_sizes = sizes
+        DeviceData.initialize()
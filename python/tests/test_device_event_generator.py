@@ -0,0 +1,62 @@
+from src.models.device_data import DeviceData
+from src.models.device_event_generator import DeviceEventGenerator
+
+# pytest -v tests/test_device_event_generator.py
+
+DeviceData.initialize()
+
+
+def generators(**kwargs) -> list:
+    """Return generators with each available implementation."""
+    gens = [DeviceEventGenerator(use_numpy=False, **kwargs)]
+    if DeviceEventGenerator(device_count=1).use_numpy:
+        gens.append(DeviceEventGenerator(use_numpy=True, **kwargs))
+    return gens
+
+
+def test_events_are_reproducible():
+    for use_numpy in [g.use_numpy for g in generators()]:
+        g1 = DeviceEventGenerator(seed=42, start_time=1000, use_numpy=use_numpy)
+        g2 = DeviceEventGenerator(seed=42, start_time=1000, use_numpy=use_numpy)
+        events1 = list(g1.events(2000, batch_size=500))
+        events2 = list(g2.events(2000, batch_size=500))
+        assert events1 == events2
+        assert len(set([e["id"] for e in events1])) == 2000
+        assert events1[0]["evt_time"] == 1000
+        assert events1[-1]["evt_time"] == 1001
+        assert sorted(events1[0].keys()) == sorted(
+            "id,did,pid,extId,ser,cid,host,ip,mac,build,evt_time,until,dt".split(","))
+
+
+def test_hotset_skew():
+    for g in generators(skew="hotset", hot_fraction=0.01, hot_weight=0.9):
+        devices = g.next_batch(20_000).column("device")
+        hot_count = max(1, int(g.device_count * 0.01))
+        counts = dict()
+        for d in devices:
+            counts[d] = counts.get(d, 0) + 1
+        top = sorted(counts.values(), reverse=True)[:hot_count]
+        assert 0.85 < sum(top) / len(devices) < 0.95
+
+
+def test_changes_follow_the_change_probabilities():
+    probs = {"ser": 0.0, "cid": 0.0, "host": 0.0, "ip": 0.0, "mac": 0.0, "build": 0.2}
+    for g in generators(device_count=50, change_probs=probs):
+        last_values = dict()
+        change_total = 0
+        for batch in g.batches(5000, batch_size=1000):
+            devices, changes = batch.column("device"), batch.column("changes")
+            columns = dict([(attr, batch.column(attr)) for attr in DeviceEventGenerator.attrs])
+            for i, d in enumerate(devices):
+                build_bit = 1 << DeviceEventGenerator.attrs.index("build")
+                assert changes[i] & ~build_bit == 0
+                if changes[i]:
+                    change_total = change_total + 1
+                values = dict([(attr, columns[attr][i]) for attr in columns.keys()])
+                if d in last_values:
+                    # the values only change with the change mask
+                    for attr in DeviceEventGenerator.attrs:
+                        if attr != "build" or changes[i] == 0:
+                            assert values[attr] == last_values[d][attr]
+                last_values[d] = values
+        assert 800 < change_total < 1200
@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+from src.services.device_event_pipeline import DeviceEventPipeline
+from src.services.write_batcher import WriteBatcher
+
+# pytest -v tests/test_device_event_pipeline.py
+
+
+class SlowNoSQLService:
+    """A stand-in for CosmosNoSQLService with a fixed latency per request."""
+
+    def __init__(self, latency_seconds):
+        self.latency_seconds = latency_seconds
+        self.inserted = list()
+
+    async def upsert_item(self, doc):
+        await asyncio.sleep(self.latency_seconds)
+        self.inserted.append((doc["did"], doc["seq"]))
+        return doc
+
+    async def query_partition(self, sql, pk, parameters=None, max_items=100):
+        await asyncio.sleep(self.latency_seconds)
+        return list()
+
+    def last_request_charge(self):
+        return 1.0
+
+
+class BatchingNoSQLService(SlowNoSQLService):
+    """Also executes transactional batches, with the same latency."""
+
+    def __init__(self):
+        super().__init__(0.005)
+
+    async def execute_item_batch(self, operations, pk):
+        await asyncio.sleep(self.latency_seconds)
+        for op in operations:
+            self.inserted.append((op[1][0]["did"], op[1][0]["seq"]))
+        return [{"statusCode": 200, "resourceBody": op[1][0]} for op in operations]
+
+
+def test_events_are_ordered_per_device_and_processed_concurrently():
+    async def run(svc):
+        pipeline = DeviceEventPipeline(svc, workers=8, queue_depth=2)
+        pipeline.start()
+        for seq in range(10):
+            for d in range(8):
+                await pipeline.submit({"id": "{}-{}".format(d, seq), "did": "d{}".format(d), "seq": seq})
+        await pipeline.close()
+        return pipeline.get_stats()
+
+    svc = SlowNoSQLService(0.01)
+    start_time = time.perf_counter()
+    stats = asyncio.run(run(svc))
+    elapsed = time.perf_counter() - start_time
+    # 80 events at 2 requests of 10ms each would take at least 1.6s sequentially
+    assert elapsed < 0.8
+    assert stats["processed"] == 80
+    assert stats["errors"] == 0
+    assert stats["events_per_second"] > 100
+    assert stats["total_ms"]["count"] == 80
+    for d in range(8):
+        seqs = [seq for did, seq in svc.inserted if did == "d{}".format(d)]
+        assert seqs == list(range(10))
+
+
+def test_insert_only_pipeline_coalesces_the_queued_inserts_of_a_device():
+    async def run(svc, batcher):
+        pipeline = DeviceEventPipeline(svc, batcher, workers=2, queue_depth=50, execute_operations=False)
+        pipeline.start()
+        for seq in range(40):
+            await pipeline.submit({"id": "hot-{}".format(seq), "did": "hot", "seq": seq})
+        await pipeline.close()
+        return pipeline.get_stats()
+
+    svc = BatchingNoSQLService()
+    batcher = WriteBatcher(svc, linger_ms=1000)
+    start_time = time.perf_counter()
+    stats = asyncio.run(run(svc, batcher))
+    assert time.perf_counter() - start_time < 0.5  # the partitions are flushed without lingering
+    assert stats["processed"] == 40
+    assert stats["errors"] == 0
+    assert [seq for did, seq in svc.inserted] == list(range(40))
+    assert batcher.get_stats()["batches"] >= 1
+    assert batcher.get_stats()["requests"] < 40
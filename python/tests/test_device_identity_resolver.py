@@ -0,0 +1,100 @@
+import random
+
+import pytest
+
+from src.models.device_identity_resolver import DeviceIdentityResolver
+
+# pytest -v tests/test_device_identity_resolver.py
+
+
+def resolvers() -> list:
+    result = [DeviceIdentityResolver(use_numpy=False)]
+    if DeviceIdentityResolver().use_numpy:
+        result.append(DeviceIdentityResolver(use_numpy=True))
+    return result
+
+
+def random_columns(rows: int, seed: int = 7) -> dict:
+    """Rows of 500 devices with mostly stable values, some of them shared."""
+    rng = random.Random(seed)
+    states = dict()
+    columns = {"did": list(), "ser": list(), "cid": list(), "host": list(), "ip": list()}
+    for i in range(rows):
+        did = "d{}".format(rng.randrange(500))
+        if did not in states or rng.random() < 0.05:
+            states[did] = {
+                "ser": str(rng.randrange(2000)),
+                "cid": str(rng.randrange(5000)) if rng.random() < 0.5 else None,
+                "host": "h{}".format(rng.randrange(3000)),
+                "ip": "10.0.0.{}".format(rng.randrange(5)),
+            }
+        columns["did"].append(did)
+        for name in ["ser", "cid", "host", "ip"]:
+            columns[name].append(states[did][name])
+    return columns
+
+
+def test_incremental_clusters():
+    resolver = DeviceIdentityResolver(use_numpy=False)
+    assert resolver.observe({"did": "a", "ser": "1", "host": "h1", "ip": "10.0.0.1"}) == 0
+    assert resolver.observe({"did": "b", "ser": "2", "host": "h2", "ip": "10.0.0.1"}) == 0
+    assert resolver.cluster("a") == ["a"]  # a weak value doesn't merge
+    assert resolver.shared_attributes("a") == {"b": ["ip"]}
+    assert resolver.observe({"did": "c", "ser": "2", "host": "h1"}) == 2
+    assert resolver.cluster("b") == ["a", "b", "c"]
+    assert resolver.same_device("a", "b")
+    assert resolver.observe({"did": "c", "ser": "2", "host": "h1"}) == 0  # unchanged values
+
+    # the value history of a device is kept in the inverted index
+    resolver.observe({"did": "a", "ser": "1", "host": "h3", "ip": "10.0.0.1"})
+    assert resolver.devices_with("host", "h1") == ["a", "c"]
+    assert resolver.devices_with("host", "h3") == ["a"]
+    assert resolver.devices_with("host", "zzz") == list()
+    stats = resolver.get_stats()
+    assert stats["devices"] == 3 and stats["clusters"] == 1 and stats["largest_cluster"] == 3
+    assert stats["merges"] == 2 and stats["events"] == 5
+    assert stats["values"]["host"] == 3
+
+
+def test_bulk_resolve_matches_incremental():
+    columns = random_columns(3000)
+    incremental = DeviceIdentityResolver(use_numpy=False)
+    for i in range(3000):
+        incremental.observe(dict([(name, columns[name][i]) for name in columns.keys()]))
+    expected = incremental.get_stats()
+    assert 1 < expected["clusters"] < 500
+    for resolver in resolvers():
+        resolver.bulk_resolve(columns)
+        stats = resolver.get_stats()
+        for name in ["devices", "events", "clusters", "largest_cluster", "cluster_sizes", "merges", "values"]:
+            assert stats[name] == expected[name]
+        for did in ["d1", "d2", "d3"]:
+            assert resolver.cluster(did) == incremental.cluster(did)
+            assert resolver.shared_attributes(did) == incremental.shared_attributes(did)
+        assert resolver.devices_with("ip", "10.0.0.1") == incremental.devices_with("ip", "10.0.0.1")
+
+        # incremental observation continues after a bulk resolution
+        resolver.observe({"did": "new", "ser": columns["ser"][0]})
+        assert resolver.same_device("new", columns["did"][0])
+
+
+def test_bulk_resolve_numpy_parity_with_missing_columns():
+    pytest.importorskip("numpy")
+    columns = random_columns(2000, seed=11)
+    columns["mac"] = [None] * 2000  # present, but all missing
+    columns["build"] = [""] * 2000
+    expected = DeviceIdentityResolver(use_numpy=False)
+    expected.bulk_resolve(columns)
+    resolver = DeviceIdentityResolver(use_numpy=True)
+    resolver.bulk_resolve(columns)
+    stats, expected_stats = resolver.get_stats(), expected.get_stats()
+    # a value that a device returns to is posted again incrementally, but once in bulk
+    assert stats.pop("postings") <= expected_stats.pop("postings")
+    assert stats == expected_stats
+    assert stats["values"]["mac"] == 0
+    for did in ["d1", "d2", "d3", "d4"]:
+        assert resolver.cluster(did) == expected.cluster(did)
+        assert resolver.shared_attributes(did) == expected.shared_attributes(did)
+    assert resolver.devices_with("mac", "x") == list()
+    resolver.observe({"did": "d1", "mac": "m1"})
+    assert resolver.devices_with("mac", "m1") == ["d1"]
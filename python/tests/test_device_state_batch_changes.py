@@ -0,0 +1,60 @@
+import random
+
+from src.models.device_data import DeviceData
+from src.models.device_state_batch_changes import DeviceStateBatchChanges
+from src.models.device_state_changes import DeviceStateChanges
+
+# pytest -v tests/test_device_state_batch_changes.py
+
+DeviceData.initialize()
+
+
+def random_pairs(count):
+    random.seed(42)
+    curr_docs, ds_docs = list(), list()
+    for i in range(count):
+        curr_doc = dict(DeviceData.random_device_state())
+        curr_doc["_etag"] = DeviceData.simulated_etag()
+        ds_doc = dict(curr_doc)
+        del ds_doc["_etag"]
+        if i % 3 == 0:
+            ds_doc["host"] = DeviceData.random_hostname()
+        if i % 5 == 0:
+            ds_doc["build"] = ds_doc["build"] + 1
+        if i % 7 == 0:
+            del ds_doc["mac"]
+        if i % 11 == 0:
+            ds_doc["os"] = "linux"
+        curr_docs.append(None if i % 13 == 0 else curr_doc)
+        ds_docs.append(ds_doc)
+    return curr_docs, ds_docs
+
+
+def test_batch_changes_match_the_per_object_changes():
+    curr_docs, ds_docs = random_pairs(200)
+    batch = DeviceStateBatchChanges(curr_docs, ds_docs)
+    for i in range(200):
+        dsc = DeviceStateChanges(curr_docs[i], ds_docs[i])
+        assert batch.has_changes(i) == dsc.has_changes()
+        assert batch.is_new(i) == dsc.is_new()
+        if not dsc.is_new():
+            expected = dsc.attrs_added + dsc.attrs_removed + dsc.attrs_changed
+            assert sorted(batch.changed_attrs(i)) == sorted(expected)
+
+
+def test_patch_operations_transform_the_current_doc():
+    curr_docs, ds_docs = random_pairs(100)
+    batch = DeviceStateBatchChanges(curr_docs, ds_docs)
+    for i in range(100):
+        if batch.is_new(i):
+            continue
+        patched = dict(curr_docs[i])
+        for op in batch.patch_operations(i):
+            if op["op"] == "remove":
+                del patched[op["path"][1:]]
+            else:
+                patched[op["path"][1:]] = op["value"]
+        del patched["_etag"]
+        assert patched == ds_docs[i]
+    assert batch.patch_operations(1) == list()
+    assert batch.mask_attrs(batch.masks[5]) == ["build"]
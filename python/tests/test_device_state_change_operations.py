@@ -0,0 +1,244 @@
+import asyncio
+import uuid
+
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosResourceNotFoundError,
+)
+
+from src.models.device_data import DeviceData
+from src.models.device_state_change_operations import DeviceStateChangeOperations
+from src.services.in_memory_nosql_service import InMemoryNoSQLService
+from src.util.lru_cache import LRUCache
+
+# pytest -v tests/test_device_state_change_operations.py
+
+DeviceData.initialize()
+
+
+class FakeNoSQLService:
+    """An in-memory stand-in for CosmosNoSQLService, with _etag semantics."""
+
+    def __init__(self, containers=None, requests=None):
+        self.containers = dict() if containers is None else containers
+        self.docs = dict()  # (id, pk) -> doc
+        self.requests = list() if requests is None else requests
+
+    def for_container(self, cname):
+        if cname not in self.containers.keys():
+            self.containers[cname] = FakeNoSQLService(self.containers, self.requests)
+        return self.containers[cname]
+
+    def store(self, doc, pk):
+        doc = dict(doc)
+        doc["_etag"] = str(uuid.uuid4())
+        self.docs[(doc["id"], pk)] = doc
+        return dict(doc)
+
+    async def upsert_item(self, doc):
+        self.requests.append("upsert")
+        return self.store(doc, doc["did"])
+
+    async def patch_item(self, id, pk, patch_operations, filter_predicate=None, etag=None):
+        self.requests.append("patch")
+        doc = self.docs.get((id, pk))
+        if doc is None:
+            raise CosmosResourceNotFoundError(status_code=404, message="not found")
+        if etag is not None and doc["_etag"] != etag:
+            raise CosmosAccessConditionFailedError(status_code=412, message="etag mismatch")
+        for op in patch_operations:
+            doc[op["path"][1:]] = op["value"]
+        return self.store(doc, pk)
+
+    async def point_read(self, id, pk):
+        self.requests.append("read")
+        if (id, pk) not in self.docs.keys():
+            raise CosmosResourceNotFoundError(status_code=404, message="not found")
+        return dict(self.docs[(id, pk)])
+
+    async def create_item_if_absent(self, doc):
+        self.requests.append("create")
+        if (doc["id"], doc["pk"]) in self.docs.keys():
+            return None
+        return self.store(doc, doc["pk"])
+
+    async def replace_item_if_match(self, doc, etag):
+        self.requests.append("replace")
+        if self.docs[(doc["id"], doc["pk"])]["_etag"] != etag:
+            raise CosmosAccessConditionFailedError(status_code=412, message="etag mismatch")
+        return self.store(doc, doc["pk"])
+
+    async def query_partition(self, sql, pk, parameters=None, max_items=100):
+        self.requests.append("query")
+        docs = [dict(doc) for (id, doc_pk), doc in self.docs.items() if doc_pk == pk]
+        return sorted(docs, key=lambda doc: doc["evt_time"], reverse=True)[0:2]
+
+    def last_request_charge(self):
+        return 1.0
+
+
+def stream_events(svc, events):
+    async def run():
+        for event in events:
+            ds_doc = await svc.upsert_item(event)
+            ops = DeviceStateChangeOperations(svc, ds_doc, 5.0)
+            await ops.execute()
+    asyncio.run(run())
+
+
+def device_state_events(did, count):
+    events = list()
+    for i in range(count):
+        event = dict(DeviceData.random_device_state())
+        event["id"] = str(uuid.uuid4())
+        event["did"] = did
+        event["pid"] = "p1"
+        event["evt_time"] = 1000 + i
+        event["until"] = -1
+        events.append(event)
+    return events
+
+
+def test_etag_pipeline_skips_the_recent_events_query():
+    DeviceStateChangeOperations.use_etag_pipeline = True
+    DeviceStateChangeOperations.last_known_states.clear()
+    try:
+        svc = FakeNoSQLService()
+        events = device_state_events("d1", 4)
+        stream_events(svc, events)
+        # only the first event of the device queries for the previous state
+        assert svc.requests == ["upsert", "query", "upsert", "patch", "upsert", "patch", "upsert", "patch"]
+        untils = [svc.docs[(e["id"], "d1")]["until"] for e in events]
+        assert untils == [1001, 1002, 1003, -1]
+    finally:
+        DeviceStateChangeOperations.use_etag_pipeline = False
+
+
+def test_etag_pipeline_rereads_on_precondition_failure():
+    DeviceStateChangeOperations.use_etag_pipeline = True
+    DeviceStateChangeOperations.last_known_states.clear()
+    try:
+        svc = FakeNoSQLService()
+        events = device_state_events("d2", 2)
+        stream_events(svc, events[0:1])
+        # another writer modifies the latest DeviceState, changing its _etag
+        svc.store(svc.docs[(events[0]["id"], "d2")], "d2")
+        svc.requests = list()
+        stream_events(svc, events[1:2])
+        assert svc.requests == ["upsert", "patch", "query", "patch"]
+        assert svc.docs[(events[0]["id"], "d2")]["until"] == 1001
+    finally:
+        DeviceStateChangeOperations.use_etag_pipeline = False
+
+
+def test_current_state_docs_replace_the_recent_events_query():
+    DeviceStateChangeOperations.use_current_state_docs = True
+    try:
+        svc = FakeNoSQLService()
+        events = device_state_events("d3", 3)
+        stream_events(svc, events)
+        assert "query" not in svc.requests
+        dc_id = "p1-d3"
+        dc_doc = svc.for_container("DeviceStateCurrent").docs[(dc_id, dc_id)]
+        assert dc_doc["dsid"] == events[2]["id"]
+        assert dc_doc["dt"] == "dc"
+        assert dc_doc["evt_time"] == 1002
+        untils = [svc.docs[(e["id"], "d3")]["until"] for e in events]
+        assert untils == [1001, 1002, -1]
+    finally:
+        DeviceStateChangeOperations.use_current_state_docs = False
+
+
+def test_full_flow_skips_unchanged_writes():
+    DeviceStateChangeOperations.use_full_flow = True
+    try:
+        svc = FakeNoSQLService()
+        base = device_state_events("d4", 1)[0]
+        events = list()
+        for i in range(2):
+            event = dict(base)
+            event["id"] = str(uuid.uuid4())
+            event["evt_time"] = 1000 + i
+            events.append(event)
+        stream_events(svc, events[0:1])
+        assert sorted(svc.requests) == sorted(["upsert"] + ["read", "create"] * 6)
+        svc.requests.clear()
+        stream_events(svc, events[1:2])
+        # only the DC document changes, and the previous DeviceState is patched
+        assert sorted(svc.requests) == sorted(["upsert", "replace", "patch"] + ["read"] * 6)
+        da_id = "ser-{}".format(base["ser"])
+        assert svc.for_container("DeviceAttributes").docs[(da_id, da_id)]["dids"] == ["d4"]
+        d1_doc = svc.for_container("DeviceSingletons").docs[("d4", "d4")]
+        assert d1_doc["firstEventEpoch"] == 1000
+        summary = DeviceStateChangeOperations.ru_summary()
+        assert summary["operations"]["read device singleton"]["mean_ru"] == 1.0
+    finally:
+        DeviceStateChangeOperations.use_full_flow = False
+
+
+def test_state_cache_skips_reads_for_hot_devices():
+    DeviceStateChangeOperations.use_full_flow = True
+    DeviceStateChangeOperations.state_cache = LRUCache(100)
+    try:
+        svc = FakeNoSQLService()
+        base = device_state_events("d5", 1)[0]
+        events = list()
+        for i in range(3):
+            event = dict(base)
+            event["id"] = str(uuid.uuid4())
+            event["evt_time"] = 1000 + i
+            events.append(event)
+        stream_events(svc, events[0:2])
+        # another writer modifies the DC document, so the cached _etag is stale
+        dc_svc = svc.for_container("DeviceStateCurrent")
+        dc_svc.store(dc_svc.docs[("p1-d5", "p1-d5")], "p1-d5")
+        svc.requests.clear()
+        stream_events(svc, events[2:3])
+        assert sorted(svc.requests) == sorted(["upsert", "replace", "read", "replace", "patch"])
+        stats = DeviceStateChangeOperations.state_cache.get_stats()
+        assert stats["invalidations"] == 1
+        assert stats["hits"] == 12
+        assert stats["ru_saved"] == 12.0
+    finally:
+        DeviceStateChangeOperations.use_full_flow = False
+        DeviceStateChangeOperations.state_cache = None
+
+
+def test_change_feed_batch_skips_superseded_device_states():
+    svc = FakeNoSQLService()
+    events = device_state_events("d6", 3)
+    docs = list()
+    for event in events:
+        docs.append(svc.store(event, "d6"))
+    docs[0]["until"] = 1001  # re-emitted by the change feed after its until was patched
+    count = asyncio.run(DeviceStateChangeOperations.execute_change_feed_batch(svc, docs))
+    assert count == 2
+    assert svc.requests == ["query", "patch", "query", "patch"]
+
+
+def test_events_with_the_same_evt_time_close_their_previous_states():
+    svc = InMemoryNoSQLService()
+    svc.set_container("DeviceState")
+    events = device_state_events("d7", 4)
+    for event in events:
+        event["evt_time"] = 1000
+    stream_events(svc, events)
+    untils = [svc.containers["DeviceState"][(e["id"], "d7")]["until"] for e in events]
+    assert untils == [1000, 1000, 1000, -1]
+    patches = svc.metrics.to_dict()["patch_item"]["latency_ms"]["count"]
+    assert patches == 3
+
+
+def test_previous_device_state_excludes_the_event_and_closed_states():
+    event = {"id": "e3", "did": "d8", "evt_time": 1000, "until": -1}
+    ops = DeviceStateChangeOperations(FakeNoSQLService(), event, 5.0)
+    closed = {"id": "e1", "did": "d8", "evt_time": 1000, "until": 1000, "_ts": 9}
+    older = {"id": "e0", "did": "d8", "evt_time": 999, "until": -1, "_ts": 9}
+    tied = [{"id": "e2b", "did": "d8", "evt_time": 1000, "until": -1, "_ts": 7},
+            {"id": "e2a", "did": "d8", "evt_time": 1000, "until": -1, "_ts": 8}]
+    assert ops.previous_device_state([event]) is None
+    assert ops.previous_device_state([event, closed]) is None
+    assert ops.previous_device_state([event, older])["id"] == "e0"
+    assert ops.previous_device_state([event, closed, older])["id"] == "e0"
+    assert ops.previous_device_state(tied + [event])["id"] == "e2a"
+    assert ops.previous_device_state(list(reversed(tied)))["id"] == "e2a"
@@ -0,0 +1,39 @@
+import asyncio
+
+from src.dao.device_state_history import DeviceStateHistory
+
+# pytest -v tests/test_device_state_history.py
+
+
+class RecordingNoSQLService:
+    """Records the single-partition queries, and returns the DeviceStates of the did."""
+
+    def __init__(self, docs: list):
+        self.docs = docs
+        self.queries = list()
+
+    async def query_partition(self, sql, pk, parameters=None, max_items=100):
+        self.queries.append((sql, pk, parameters, max_items))
+        return [doc for doc in self.docs if doc["did"] == pk][0:max_items]
+
+    def last_request_charge(self):
+        return 2.5
+
+
+def test_states_as_of_single_partition_queries():
+    nosql_svc = RecordingNoSQLService([{"id": "a1", "did": "a", "evt_time": 100, "until": -1}])
+    history = DeviceStateHistory(nosql_svc)
+    states = asyncio.run(history.states_as_of(["a", "b"], 150))
+    assert states == {"a": nosql_svc.docs[0], "b": None}
+    assert history.query_count == 2
+    assert history.request_units == 5.0
+    for sql, pk, parameters, max_items in nosql_svc.queries:
+        assert "c.evt_time <= @t" in sql and "c.until > @t" in sql
+        assert parameters == [{"name": "@did", "value": pk}, {"name": "@t", "value": 150}]
+        assert max_items == 1
+
+    asyncio.run(history.history("a", 100, 200))
+    sql, pk, parameters, max_items = nosql_svc.queries[-1]
+    assert pk == "a"
+    assert "c.evt_time < @end" in sql and "c.until > @start" in sql
+    assert history.export_sql(["ser"]) == "select c.id, c.did, c.evt_time, c.until, c.ser from c where c.dt = 'ds'"
@@ -0,0 +1,54 @@
+import json
+
+from src.models.device_state_interval_index import DeviceStateIntervalIndex
+
+# pytest -v tests/test_device_state_interval_index.py
+
+
+def ds(id, did, evt_time, until=-1, ser="1"):
+    return {"id": id, "did": did, "evt_time": evt_time, "until": until, "ser": ser, "dt": "ds"}
+
+
+def test_as_of_intervals():
+    index = DeviceStateIntervalIndex(["ser"])
+    index.add_all([
+        ds("a1", "a", 100, 200, ser="s1"),
+        ds("a2", "a", 200, -1, ser="s2"),
+        ds("b1", "b", 150, -1),
+        {"id": "x", "did": "a", "evt_time": 0, "dt": "d1"},  # not a DeviceState
+    ])
+    assert index.as_of("a", 99) is None
+    assert index.as_of("a", 100)["id"] == "a1"
+    assert index.as_of("a", 199.9) == {"id": "a1", "did": "a", "evt_time": 100, "until": 200, "ser": "s1"}
+    assert index.as_of("a", 200)["id"] == "a2"
+    assert index.as_of("a", 10_000)["ser"] == "s2"
+    assert index.as_of("c", 150) is None
+
+    states = index.bulk_as_of(["a", "b", "c"], 175)
+    assert states["a"]["id"] == "a1" and states["b"]["id"] == "b1" and states["c"] is None
+    assert [s["id"] for s in index.snapshot(160)] == ["a1", "b1"]
+    assert list(index.changed_between(160, 250)) == ["a"]
+
+    # a superseded state whose 'until' patch hasn't been seen ends at the next state
+    index.add(ds("b2", "b", 300))
+    assert index.as_of("b", 299)["until"] == 300
+    assert index.as_of("b", 300)["id"] == "b2"
+
+    # a later version of a document, from the change feed, replaces the earlier one
+    index.add(ds("b1", "b", 150, 300))
+    stats = index.get_stats()
+    assert stats["added"] == 5 and stats["intervals"] == 4
+    assert stats["devices"] == 2 and stats["open_intervals"] == 2
+
+
+def test_add_file(tmpdir):
+    path = str(tmpdir.join("export.ndjson"))
+    with open(path, "wt") as f:
+        for i in range(100):
+            f.write(json.dumps(ds("d{}-{}".format(i % 10, i), "d{}".format(i % 10), i)) + "\n")
+    index = DeviceStateIntervalIndex()
+    assert index.add_file(path) == 100
+    assert index.get_stats()["devices"] == 10
+    state = index.as_of("d3", 55)
+    assert state == {"id": "d3-53", "did": "d3", "evt_time": 53, "until": 63}
+    assert len(list(index.snapshot(9))) == 10
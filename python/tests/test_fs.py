@@ -0,0 +1,67 @@
+import json
+import zipfile
+
+from src.util.fs import FS
+
+# pytest -v tests/test_fs.py
+
+
+def test_json_entries_iterator_object():
+    obj = {"a": 1, "b": {"c": 12345}, "d": [1, 2, 3], "e": None, "f": "x,y}"}
+    FS.write_json(obj, "tmp/test_object.json", verbose=False)
+    for chunk_size in [1, 2, 7, 65536]:
+        entries = list(FS.json_entries_iterator("tmp/test_object.json", chunk_size=chunk_size))
+        assert entries == list(obj.items())
+
+
+def test_json_entries_iterator_array():
+    arr = [1, 22, 333, {"a": [1, 2]}, "x", True]
+    FS.write_json(arr, "tmp/test_array.json", pretty=False, verbose=False)
+    for chunk_size in [1, 3, 65536]:
+        entries = list(FS.json_entries_iterator("tmp/test_array.json", chunk_size=chunk_size))
+        assert entries == list(enumerate(arr))
+
+
+def test_json_entries_iterator_empty_and_missing():
+    FS.write("tmp/test_empty.json", " { } ", verbose=False)
+    assert list(FS.json_entries_iterator("tmp/test_empty.json")) == list()
+    assert list(FS.json_entries_iterator("tmp/missing.json")) == list()
+
+
+def test_json_entries_iterator_zip():
+    obj = {"flask": {"id": "flask", "pk": "f"}, "pydantic": {"id": "pydantic", "pk": "p"}}
+    with zipfile.ZipFile("tmp/test_libs.zip", mode="w") as zf:
+        zf.writestr("libs.json", json.dumps(obj, indent=2))
+    entries = list(FS.json_entries_iterator("tmp/test_libs.zip", chunk_size=16))
+    assert entries == list(obj.items())
+
+
+def test_json_entries_iterator_python_libs_zip():
+    count, pks = 0, dict()
+    for libname, doc in FS.json_entries_iterator("../data/python_libs/python_libs.zip"):
+        assert libname == doc["id"]
+        pks[doc["pk"]] = 1
+        count = count + 1
+    assert count > 10000
+    assert "f" in pks.keys()
+
+
+def test_json_object_ranges():
+    obj = dict([("k{}".format(i), {"n": i, "s": "ü\n}, \"k\": {"}) for i in range(50)])
+    FS.write_json(obj, "tmp/test_ranges.json", verbose=False)
+    for count in [1, 2, 3, 7, 50, 100]:
+        ranges = FS.json_object_ranges("tmp/test_ranges.json", count)
+        assert 1 <= len(ranges) <= count
+        entries = list()
+        for start, end in ranges:
+            entries.extend(FS.json_entries_in_range("tmp/test_ranges.json", start, end, chunk_size=7))
+        assert entries == list(obj.items())
+    assert len(FS.json_object_ranges("tmp/test_ranges.json", 7)) == 7
+
+    # minified JSON can't be split, and an empty object has no ranges
+    FS.write_json(obj, "tmp/test_ranges_minified.json", pretty=False, verbose=False)
+    ranges = FS.json_object_ranges("tmp/test_ranges_minified.json", 4)
+    assert len(ranges) == 1
+    assert list(FS.json_entries_in_range("tmp/test_ranges_minified.json", *ranges[0])) == list(obj.items())
+    FS.write("tmp/test_empty.json", " { } ", verbose=False)
+    assert FS.json_object_ranges("tmp/test_empty.json", 4) == list()
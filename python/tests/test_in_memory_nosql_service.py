@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosHttpResponseError,
+    CosmosResourceNotFoundError,
+)
+
+from src.services.in_memory_nosql_service import InMemoryNoSQLService
+
+# pytest -v tests/test_in_memory_nosql_service.py
+
+
+def test_etag_semantics_and_request_charges():
+    async def run():
+        svc = InMemoryNoSQLService()
+        da = svc.for_container("DeviceAttributes")
+        doc = await da.create_item_if_absent({"id": "ser-1", "pk": "ser-1", "dids": ["d1"]})
+        assert da.last_request_charge() == 5.0
+        assert await da.create_item_if_absent({"id": "ser-1", "pk": "ser-1"}) is None
+        read = await da.point_read("ser-1", "ser-1")
+        assert da.last_request_charge() == 1.0
+        read["dids"].append("d2")
+        replaced = await da.replace_item_if_match(read, doc["_etag"])
+        assert replaced["dids"] == ["d1", "d2"]
+        with pytest.raises(CosmosAccessConditionFailedError):
+            await da.replace_item_if_match(read, doc["_etag"])
+        patched = await da.patch_item(
+            "ser-1", "ser-1", [{"op": "incr", "path": "/n", "value": 2}], etag=replaced["_etag"])
+        assert patched["n"] == 2
+        with pytest.raises(CosmosResourceNotFoundError):
+            await da.point_read("ser-2", "ser-2")
+        # the containers and metrics are shared with the other container services
+        assert "ser-1" in [id for (id, pk) in svc.containers["DeviceAttributes"].keys()]
+        assert svc.metrics.status_counts["point_read"] == {"ok": 1, "404": 1}
+        assert svc.metrics.status_counts["replace_item"] == {"ok": 1, "412": 1}
+
+    asyncio.run(run())
+
+
+def test_throttled_requests_are_retried_then_fail_with_429():
+    async def run():
+        svc = InMemoryNoSQLService(
+            {"throttle_pct": 100.0, "max_throttle_retries": 2, "retry_after_ms": 0.0})
+        svc.set_container("DeviceState")
+        with pytest.raises(CosmosHttpResponseError) as excinfo:
+            await svc.upsert_item({"id": "1", "did": "d1"})
+        assert excinfo.value.status_code == 429
+        assert svc.get_stats()["requests"] == 3
+        assert svc.metrics.retry_counts["upsert_item"] == 2
+        assert svc.metrics.status_counts["upsert_item"] == {"429": 1}
+
+    asyncio.run(run())
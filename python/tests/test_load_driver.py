@@ -0,0 +1,60 @@
+import asyncio
+
+from src.models.device_event_generator import DeviceEventGenerator
+from src.services.device_event_pipeline import DeviceEventPipeline
+from src.services.in_memory_nosql_service import InMemoryNoSQLService
+from src.services.load_driver import LoadDriver
+
+# pytest -v tests/test_load_driver.py
+
+
+def test_parse_stages_and_arrival_schedule():
+    stages = LoadDriver.parse_stages("100:1, 0-200:2")
+    assert stages[0] == {"start_rate": 100.0, "end_rate": 100.0, "duration_seconds": 1.0}
+    assert stages[1] == {"start_rate": 0.0, "end_rate": 200.0, "duration_seconds": 2.0}
+    driver = LoadDriver(DeviceEventPipeline(None), None, stages, arrivals="constant")
+    schedule = list(driver.arrival_schedule())
+    first = [offset for idx, offset in schedule if idx == 0]
+    ramp = [offset for idx, offset in schedule if idx == 1]
+    assert len(first) == 99
+    assert 180 <= len(ramp) <= 200  # about the ramp's mean rate of 100/s
+    assert all([1.0 <= offset < 3.0 for offset in ramp])
+    # the ramp's arrivals get closer together as its rate increases
+    assert (ramp[10] - ramp[9]) > (ramp[-1] - ramp[-2])
+
+    driver = LoadDriver(DeviceEventPipeline(None), None, LoadDriver.parse_stages("1000:2"))
+    assert 1800 < len(list(driver.arrival_schedule())) < 2200
+
+
+def test_device_evt_times_are_increasing_per_device():
+    last_evt_times = dict()
+    times = [LoadDriver.device_evt_time(last_evt_times, "d1", 1000.0) for i in range(3)]
+    assert times == [1000.0, 1000.001, 1000.002]
+    assert LoadDriver.device_evt_time(last_evt_times, "d2", 1000.0) == 1000.0
+    assert LoadDriver.device_evt_time(last_evt_times, "d1", 1000.5) == 1000.5
+    assert LoadDriver.device_evt_time(last_evt_times, "d1", 999.0) == 1000.501
+
+
+def test_open_loop_run_against_the_in_memory_service():
+    async def run():
+        svc = InMemoryNoSQLService({"latency_ms": 1.0, "throttle_pct": 5.0, "seed": 7})
+        svc.set_container("DeviceState")
+        pipeline = DeviceEventPipeline(svc, workers=4, execute_operations=False)
+        pipeline.start()
+        events = DeviceEventGenerator(seed=42).events(1000)
+        driver = LoadDriver(pipeline, lambda: next(events), LoadDriver.parse_stages("400:0.5"))
+        await driver.run()
+        await pipeline.close()
+        return driver.get_stats(svc.metrics), svc
+
+    stats, svc = asyncio.run(run())
+    assert stats["submitted"] == stats["processed"] == stats["stages"][0]["processed"]
+    assert 150 < stats["submitted"] < 250
+    assert stats["errors"] == 0
+    assert stats["end_to_end_ms"]["count"] == stats["submitted"]
+    assert stats["end_to_end_ms"]["p50"] >= 1.0
+    assert stats["ru_per_event"] == 5.0
+    assert stats["operations"]["upsert_item"]["latency_ms"]["count"] == stats["submitted"]
+    assert 0.0 < stats["throttle_rate"] < 0.15
+    assert svc.get_stats()["throttled"] == stats["throttle_retries"]
+    assert len(svc.containers["DeviceState"]) == stats["submitted"]
@@ -0,0 +1,36 @@
+from src.util.lru_cache import LRUCache
+
+# pytest -v tests/test_lru_cache.py
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = LRUCache(capacity=2)
+    cache.put("a", {"id": "a"})
+    cache.put("b", {"id": "b"})
+    assert cache.get("a") == {"id": "a"}  # b is now the least-recently-used
+    cache.put("c", {"id": "c"})
+    assert "b" not in cache
+    assert "a" in cache
+    assert len(cache) == 2
+    stats = cache.get_stats()
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 1
+    assert stats["approx_bytes"] > 0
+
+
+def test_invalidation_and_ru_saved():
+    cache = LRUCache()
+    assert cache.get("d1") is None
+    cache.record_read_ru(1.0)
+    cache.put("d1", {"id": "d1", "_etag": "e1"})
+    cache.put("d1", {"id": "d1", "_etag": "e2"})
+    for i in range(3):
+        assert cache.get("d1")["_etag"] == "e2"
+    cache.invalidate("d1")
+    assert cache.get("d1") is None
+    stats = cache.get_stats()
+    assert stats["entries"] == 0
+    assert stats["approx_bytes"] == 0
+    assert stats["invalidations"] == 1
+    assert stats["hit_ratio"] == 0.6
+    assert stats["ru_saved"] == 3.0
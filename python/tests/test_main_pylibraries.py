@@ -0,0 +1,116 @@
+import asyncio
+import queue
+
+import main_pylibraries
+
+from src.util.operation_metrics import OperationMetrics
+from src.util.fs import FS
+
+# pytest -v tests/test_main_pylibraries.py
+
+
+class FakeNoSQLService:
+    """A stand-in for CosmosNoSQLService that records its lifecycle calls."""
+
+    def __init__(self, opts):
+        self.metrics = OperationMetrics()
+        self.closed = False
+
+    async def initialize(self):
+        pass
+
+    def set_db(self, dbname):
+        pass
+
+    def set_container(self, cname):
+        pass
+
+    def single_flight_stats(self):
+        return dict()
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeDependencyGraph:
+    """Records the library and depth of each traversal."""
+
+    traversals = list()
+
+    def __init__(self, nosql_svc, known_libs):
+        self.known_libs = known_libs
+
+    async def traverse_dependencies(self, libname, depth):
+        FakeDependencyGraph.traversals.append((libname, depth, sorted(self.known_libs)))
+        return {"elapsed_time": 0.0, "collected_libs": [libname], "request_units": 1.0}
+
+
+def test_traverse_dependencies_of_the_requested_library(monkeypatch):
+    written = list()
+    monkeypatch.setattr(main_pylibraries, "CosmosNoSQLService", FakeNoSQLService)
+    monkeypatch.setattr(main_pylibraries, "DependencyGraph", FakeDependencyGraph)
+    monkeypatch.setattr(main_pylibraries, "python_libs_datafile", lambda: "python_libs.json")
+    monkeypatch.setattr(
+        FS, "json_entries_iterator", staticmethod(lambda path: iter([("flask", {}), ("zope", {})])))
+    monkeypatch.setattr(FS, "write_json", staticmethod(lambda obj, path: written.append(path)))
+    FakeDependencyGraph.traversals = list()
+
+    asyncio.run(main_pylibraries.traverse_dependencies("graph", "graph", "flask", 2))
+    assert FakeDependencyGraph.traversals == [("flask", 2, ["flask", "zope"])]
+    assert written == ["traversals/flask_2.json"]
+
+
+def test_partition_key_batches():
+    docs = [{"id": str(i), "pk": "ab"[i % 3 == 0]} for i in range(30)]
+    batches = list(main_pylibraries.partition_key_batches(docs, batch_size=8))
+    assert [(number, pk, len(ops)) for number, pk, ops in batches] == [
+        (1, "a", 8), (1, "b", 8), (2, "a", 8), (3, "a", 4), (2, "b", 2)]
+    ids = [op[1][0]["id"] for number, pk, ops in batches for op in ops]
+    assert sorted(ids) == sorted([doc["id"] for doc in docs])
+    assert all([op[0] == "upsert" for number, pk, ops in batches for op in ops])
+
+
+def test_shard_max_docs():
+    assert [main_pylibraries.shard_max_docs(10, 4, idx) for idx in range(4)] == [3, 3, 2, 2]
+    assert [main_pylibraries.shard_max_docs(2, 3, idx) for idx in range(3)] == [1, 1, 0]
+
+
+def test_shards_load_their_own_byte_ranges(monkeypatch):
+    loaded = list()
+
+    async def fake_load_batch(nosql_svc, batch_number, batch_operations, pk):
+        loaded.extend([op[1][0]["id"] for op in batch_operations])
+        counter = main_pylibraries.Counter()
+        counter.increment_by("200", len(batch_operations))
+        return counter
+
+    monkeypatch.setattr(main_pylibraries, "CosmosNoSQLService", FakeNoSQLService)
+    monkeypatch.setattr(main_pylibraries, "load_batch", fake_load_batch)
+    libs = dict()
+    for i in range(60):
+        name = "lib{:02d}".format(i)
+        libs[name] = {"id": name, "pk": "ab"[i // 30], "summary": "ü, {} \"x\"".format(i)}
+    FS.write_json(libs, "tmp/test_sharded_libs.json", verbose=False)
+    ranges = FS.json_object_ranges("tmp/test_sharded_libs.json", 3)
+    assert len(ranges) == 3
+
+    progress_queue = queue.Queue()
+    results = list()
+    for idx, (start, end) in enumerate(ranges):
+        results.append(asyncio.run(main_pylibraries.load_shard_async(
+            "graph", "graph", idx, "tmp/test_sharded_libs.json", start, end, 100, progress_queue)))
+    assert sorted(loaded) == sorted(libs.keys())
+    assert [result["worker"] for result in results] == ["0", "1", "2"]
+    assert sum([result["docs"] for result in results]) == 60
+    assert sum([result["status_codes"]["200"] for result in results]) == 60
+    status_counter, worker_docs = main_pylibraries.Counter(), main_pylibraries.Counter()
+    main_pylibraries.merge_shard_progress(progress_queue, status_counter, worker_docs)
+    assert worker_docs.get_data() == dict([(r["worker"], r["docs"]) for r in results])
+
+    # each shard loads up to its share of max_docs
+    loaded.clear()
+    start, end = ranges[1]
+    result = asyncio.run(main_pylibraries.load_shard_async(
+        "graph", "graph", 1, "tmp/test_sharded_libs.json", start, end, 5))
+    assert result["docs"] == 5
+    assert len(loaded) == 5
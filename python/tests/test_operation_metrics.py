@@ -0,0 +1,66 @@
+import random
+
+from src.util.histogram import Histogram
+from src.util.operation_metrics import OperationMetrics, last_operation_capture
+
+# pytest -v tests/test_operation_metrics.py
+
+
+def test_histogram_percentiles():
+    random.seed(42)
+    values = [random.expovariate(1.0 / 10.0) for _ in range(50_000)]
+    h = Histogram()
+    for value in values:
+        h.record(value)
+    values.sort()
+    assert h.count == len(values)
+    assert h.min == values[0]
+    assert h.max == values[-1]
+    for pct in [50, 90, 99]:
+        exact = values[int(len(values) * pct / 100.0) - 1]
+        assert abs(h.percentile(pct) - exact) <= exact * 0.01
+    assert len(h.buckets) < 2000
+
+
+def test_histogram_zeros_and_merge():
+    h1, h2 = Histogram(), Histogram()
+    h1.record(0.0, 3)
+    h2.record(5.0)
+    h1.merge(h2)
+    assert h1.count == 4
+    assert h1.percentile(50) == 0.0
+    assert h1.percentile(100) == 5.0
+    assert Histogram().percentile(99) == 0.0
+
+
+def test_operation_capture():
+    metrics = OperationMetrics()
+    with metrics.capture("point_read") as capture:
+        headers = {"x-ms-request-charge": "1.5", "x-ms-throttle-retry-count": "2"}
+        capture.response_hook(headers, None)
+    assert last_operation_capture.get() is capture
+    assert capture.request_charge == 1.5
+    assert capture.retry_count == 2
+    assert capture.latency_ms >= 0.0
+
+    try:
+        with metrics.capture("point_read") as capture:
+            raise KeyError("missing")
+    except KeyError:
+        pass
+    data = metrics.to_dict()
+    assert data["point_read"]["status_counts"] == {"ok": 1, "KeyError": 1}
+    assert data["point_read"]["request_units"]["sum"] == 1.5
+    assert data["point_read"]["retry_count"] == 2
+
+
+def test_operation_metrics_prometheus():
+    metrics = OperationMetrics()
+    for ru in [1.0, 2.0, 3.0]:
+        with metrics.capture("upsert_item") as capture:
+            capture.response_hook({"x-ms-request-charge": str(ru)}, None)
+    text = metrics.to_prometheus()
+    assert 'cosmos_operation_request_units_sum{operation="upsert_item"} 6.0' in text
+    assert 'cosmos_operation_latency_ms_count{operation="upsert_item"} 3' in text
+    assert 'cosmos_operation_status_total{operation="upsert_item",status="ok"} 3' in text
+    assert metrics.total_request_charge() == 6.0
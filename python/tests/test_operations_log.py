@@ -0,0 +1,65 @@
+import json
+import os
+
+from src.models.device_data import DeviceData
+from src.util.doc_size import DocSize
+from src.util.operations_log import OperationAggregates, OperationsLog
+
+# pytest -v tests/test_operations_log.py
+
+DeviceData.initialize()
+
+
+def remove_files(basename):
+    dirname = os.path.dirname(basename)
+    for name in os.listdir(dirname):
+        if name.startswith(os.path.basename(basename)):
+            os.remove(os.path.join(dirname, name))
+
+
+def test_log_rotation_and_read_back():
+    for fmt in ["csv", "ndjson"]:
+        basename = "tmp/test_operations_log_{}".format(fmt)
+        os.makedirs("tmp", exist_ok=True)
+        remove_files(basename)
+        log = OperationsLog(basename, fmt=fmt, max_bytes=1000)
+        entries = list()
+        for i in range(100):
+            entry = {"event_id": "e{}".format(i // 4), "did": "d1",
+                     "operation": "read, device {}".format(i % 4), "ru": 1.5 * i, "doc_size": i}
+            entries.append(entry)
+            log.write(entry)
+        log.close()
+        assert log.count == 100
+        assert len(log.paths) > 3
+        assert log.paths[0] == "{}-00001.{}".format(basename, fmt)
+        for path in log.paths[:-1]:
+            assert os.path.getsize(path) < 1100
+        read = list()
+        for path in log.paths:
+            read.extend(OperationsLog.read(path))
+        assert [dict(entry) for entry in read] == entries
+
+
+def test_doc_size_estimate_and_aggregates():
+    for i in range(20):
+        doc = DeviceData.random_device_state()
+        doc["dids"] = ["d1", "d2"]
+        doc["nested"] = {"a": None, "b": True, "c": 1.25, "d": []}
+        assert DocSize.estimate(doc) == len(json.dumps(doc))
+    assert DocSize.estimate({}) == 2
+
+    aggregates = OperationAggregates()
+    for ru in [1.0, 2.0, 3.0, 10.0]:
+        aggregates.record("read", ru, 100)
+    aggregates.record("write", 5.0, 400)
+    another = OperationAggregates()
+    another.record("write", 7.0, 600)
+    aggregates.merge(another)
+    data = aggregates.to_dict()
+    assert data["read"]["count"] == 4
+    assert data["read"]["total_ru"] == 16.0
+    assert data["read"]["ru"]["min"] == 1.0
+    assert data["read"]["ru"]["max"] == 10.0
+    assert data["write"]["mean_ru"] == 6.0
+    assert data["write"]["doc_size"]["max"] == 600.0
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+from src.dao.device_state_history import DeviceStateHistory
+from src.models.partition_key_strategy import PartitionKeyStrategy
+
+# pytest -v tests/test_partition_key_strategy.py
+
+MIDNIGHT = 1728000000  # 2024-10-04 00:00:00 UTC
+
+
+class RecordingNoSQLService:
+    """Records the single-partition queries, and returns the DeviceStates of the pk."""
+
+    def __init__(self, docs: list):
+        self.docs = docs
+        self.pks = list()
+
+    async def query_partition(self, sql, pk, parameters=None, max_items=100):
+        self.pks.append(pk)
+        docs = [doc for doc in self.docs if doc["pk"] == pk]
+        return sorted(docs, key=lambda doc: doc["evt_time"], reverse=True)[0:max_items]
+
+    def last_request_charge(self):
+        return 1.0
+
+
+def test_partition_keys_and_routing():
+    doc = {"id": "e1", "did": "abc", "evt_time": MIDNIGHT + 3600 + 5}
+    assert PartitionKeyStrategy().assign(doc) == "abc"
+    assert PartitionKeyStrategy("did_day").assign(doc) == "abc-20241004"
+    assert doc["pk"] == "abc-20241004"
+    assert PartitionKeyStrategy("did_hour").partition_key(doc) == "abc-2024100401"
+    hashed = PartitionKeyStrategy.parse("did_hash:4")
+    assert hashed.spec() == "did_hash:4"
+    assert hashed.partition_key(doc) in hashed.hash_keys("abc")
+    assert len(set([hashed.key_for("abc", 0, i) for i in range(100)])) == 4
+    with pytest.raises(ValueError):
+        PartitionKeyStrategy.parse("did_minute")
+
+    day = PartitionKeyStrategy("did_day", max_lookback_buckets=3, max_range_buckets=5)
+    assert day.keys_for_range("abc", MIDNIGHT - 1, MIDNIGHT + 86400) == [
+        "abc-20241003", "abc-20241004", "abc-20241005"]
+    assert day.keys_before("abc", MIDNIGHT + 10) == ["abc-20241004", "abc-20241003", "abc-20241002"]
+    with pytest.raises(ValueError):
+        day.keys_for_range("abc", MIDNIGHT, MIDNIGHT + (86400 * 5))
+    assert PartitionKeyStrategy().keys_for_range("abc", 0, MIDNIGHT) == ["abc"]
+    assert hashed.keys_before("abc", MIDNIGHT) == ["abc-0", "abc-1", "abc-2", "abc-3"]
+
+
+def test_history_fans_out_and_merges_in_time_order():
+    strategy = PartitionKeyStrategy("did_day", max_lookback_buckets=30)
+    docs = list()
+    for i, t in enumerate([MIDNIGHT - 86400, MIDNIGHT - 10, MIDNIGHT + 20, MIDNIGHT + 30]):
+        doc = {"id": "s{}".format(i), "did": "abc", "evt_time": t, "until": -1}
+        strategy.assign(doc)
+        docs.append(doc)
+    nosql_svc = RecordingNoSQLService(docs)
+    history = DeviceStateHistory(nosql_svc, strategy, max_concurrency=4)
+
+    states = asyncio.run(history.history("abc", MIDNIGHT - 86400, MIDNIGHT + 86400))
+    assert [doc["id"] for doc in states] == ["s0", "s1", "s2", "s3"]
+    assert sorted(nosql_svc.pks) == ["abc-20241003", "abc-20241004", "abc-20241005"]
+
+    # the latest bucket has both of the most recent states
+    nosql_svc.pks = list()
+    recent = asyncio.run(history.recent_states("abc", MIDNIGHT + 30, "select", 2))
+    assert [doc["id"] for doc in recent] == ["s3", "s2"]
+    assert nosql_svc.pks == ["abc-20241004"]
+
+    # the windows double until enough states are found, newest bucket first
+    nosql_svc.pks = list()
+    state = asyncio.run(history.state_as_of("abc", MIDNIGHT + (86400 * 5)))
+    assert state["id"] == "s3"
+    assert len(nosql_svc.pks) == 7
+    assert nosql_svc.pks[0] == "abc-20241009"
+    assert history.query_count == 3 + 1 + 7
+
+
+def test_ingest_walk_stops_after_max_empty_buckets():
+    strategy = PartitionKeyStrategy("did_day", max_lookback_buckets=90, max_empty_buckets=7)
+    new_event = {"id": "new", "did": "abc", "evt_time": MIDNIGHT + 30, "until": -1}
+    old_state = {"id": "old", "did": "abc", "evt_time": MIDNIGHT - (86400 * 5), "until": -1}
+    for doc in [new_event, old_state]:
+        strategy.assign(doc)
+
+    # a device with no history; only the new event in the latest bucket
+    nosql_svc = RecordingNoSQLService([new_event])
+    history = DeviceStateHistory(nosql_svc, strategy)
+    recent = asyncio.run(history.recent_states("abc", MIDNIGHT + 30, "select", 2))
+    assert [doc["id"] for doc in recent] == ["new"]
+    assert len(nosql_svc.pks) == 1 + 7
+    assert history.query_count == 8
+    assert nosql_svc.pks[-1] == "abc-20240927"
+
+    # a previous state within the empty-bucket limit is still found
+    nosql_svc = RecordingNoSQLService([new_event, old_state])
+    history = DeviceStateHistory(nosql_svc, strategy)
+    recent = asyncio.run(history.recent_states("abc", MIDNIGHT + 30, "select", 2))
+    assert [doc["id"] for doc in recent] == ["new", "old"]
+    assert len(nosql_svc.pks) == 7
+
+    # state_as_of isn't on the ingest path, so it walks every lookback bucket
+    nosql_svc = RecordingNoSQLService(list())
+    history = DeviceStateHistory(nosql_svc, strategy)
+    assert asyncio.run(history.state_as_of("abc", MIDNIGHT + 30)) is None
+    assert len(nosql_svc.pks) == 90
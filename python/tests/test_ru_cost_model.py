@@ -0,0 +1,69 @@
+import os
+
+import pytest
+
+from src.models.ru_cost_model import RUCostModel
+from src.util.operations_log import OperationsLog
+
+# pytest -v tests/test_ru_cost_model.py
+
+
+def write_log(basename: str, event_count: int) -> list:
+    """
+    Write the operations of event_count events; every 4th event updates a
+    device attribute.  An upsert costs 5 RU plus 2 RU per KB of the doc.
+    """
+    os.makedirs("tmp", exist_ok=True)
+    for name in os.listdir("tmp"):
+        if name.startswith(os.path.basename(basename)):
+            os.remove(os.path.join("tmp", name))
+    log = OperationsLog(basename, max_bytes=4096)
+    for i in range(event_count):
+        event_id = "e{}".format(i)
+        size = 256 * (1 + (i % 8))
+        log.write({"event_id": event_id, "did": "d1", "operation": "insert device state",
+                   "ru": 5.0 + (2.0 * size / 1024.0), "doc_size": size})
+        log.write({"event_id": event_id, "did": "d1", "operation": "read device attribute",
+                   "ru": 1.0, "doc_size": 0})
+        if i % 4 == 0:
+            log.write({"event_id": event_id, "did": "d1", "operation": "update device attribute",
+                       "ru": 10.0, "doc_size": 200})
+    log.close()
+    return log.paths
+
+
+def models() -> list:
+    result = [RUCostModel(max_open_events=5, use_numpy=False)]
+    if RUCostModel().use_numpy:
+        result.append(RUCostModel(max_open_events=5, use_numpy=True))
+    return result
+
+
+def test_fits_and_event_costs_from_chunks():
+    paths = write_log("tmp/test_ru_cost_model", 400)
+    assert len(paths) > 1
+    for model in models():
+        model.process_files(paths, chunk_rows=50)
+        assert model.rows == 900
+        fits = model.fits()
+        insert = fits["insert device state"]
+        assert insert["count"] == 400
+        assert insert["intercept_ru"] == pytest.approx(5.0)
+        assert insert["ru_per_kb"] == pytest.approx(2.0)
+        assert insert["r2"] == pytest.approx(1.0)
+        assert fits["read device attribute"]["ru_per_kb"] == 0.0
+
+        report = model.capacity_report(1000, headroom=1.5)
+        assert report["events"] == 400
+        assert report["observed_change_rate"] == 0.25
+        changed, unchanged = report["event_ru"]["changed"], report["event_ru"]["unchanged"]
+        assert changed["count"] == 100 and unchanged["count"] == 300
+        mean_event_ru = (0.75 * unchanged["mean"]) + (0.25 * changed["mean"])
+        assert report["mean_event_ru"] == pytest.approx(mean_event_ru)
+        assert report["projected_ru_per_second"] == pytest.approx(1000 * mean_event_ru)
+        assert report["recommended_manual_ru_per_second"] >= 1.5 * report["projected_ru_per_second"]
+        assert report["operations"]["update device attribute"]["per_event"] == 0.25
+
+        # a given change rate overrides the observed rate
+        report = model.capacity_report(1000, change_rate=1.0)
+        assert report["mean_event_ru"] == pytest.approx(changed["mean"])
@@ -0,0 +1,46 @@
+from src.util.fs import FS
+from src.util.string_pool_file import StringPoolFile
+
+# pytest -v tests/test_string_pool_file.py
+
+
+def test_pools_round_trip():
+    pools = dict()
+    pools["empty"] = list()
+    pools["ids"] = ["a1", "", "b22", "c333"]
+    pools["unicode"] = ["zürich", "東京", "x" * 1000]
+    StringPoolFile.write("tmp/test_pools.bin", {"seed": 7, "sizes": [1, 2]}, pools)
+    metadata, read_pools = StringPoolFile.read("tmp/test_pools.bin")
+    assert metadata == {"seed": 7, "sizes": [1, 2]}
+    assert sorted(read_pools.keys()) == ["empty", "ids", "unicode"]
+    for name in pools.keys():
+        assert len(read_pools[name]) == len(pools[name])
+        assert list(read_pools[name]) == pools[name]
+    assert read_pools["ids"][-1] == "c333"
+    try:
+        read_pools["ids"][4]
+        assert False
+    except IndexError:
+        pass
+
+
+def test_missing_and_invalid_files():
+    assert StringPoolFile.read("tmp/missing_pools.bin") == (None, None)
+    FS.write("tmp/test_invalid_pools.bin", "not a pool file", verbose=False)
+    assert StringPoolFile.read("tmp/test_invalid_pools.bin") == (None, None)
+
+
+def test_close_unmaps_the_file():
+    StringPoolFile.write("tmp/test_close_pools.bin", {}, {"a": ["x", "y"], "b": ["z"]})
+    metadata, pools = StringPoolFile.read("tmp/test_close_pools.bin")
+    assert pools["b"][0] == "z"
+    assert not pools["a"].closed
+    StringPoolFile.close(pools)
+    assert pools["a"].closed and pools["b"].closed
+    try:
+        pools["a"][0]
+        assert False
+    except ValueError:
+        pass
+    StringPoolFile.close(pools)
+    StringPoolFile.close(None)
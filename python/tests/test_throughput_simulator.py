@@ -0,0 +1,65 @@
+import random
+
+import pytest
+
+from src.models.throughput_simulator import ThroughputSimulator
+from src.util.operations_log import OperationsLog
+
+# pytest -v tests/test_throughput_simulator.py
+
+
+def uniform_requests(rate: float, seconds: int, ru: float, seed: int = 7):
+    rng = random.Random(seed)
+    for i in range(int(rate * seconds)):
+        yield i / rate, "{:012x}".format(rng.getrandbits(48)), ru
+
+
+def test_token_bucket_throttling_and_backlog():
+    # 500 RU/s of demand fits in 1000 RU/s
+    stats = ThroughputSimulator(1000).run(uniform_requests(50, 10, 10.0))
+    assert stats["physical_partitions"] == 1
+    assert stats["requests"] == 500
+    assert stats["throttled"] == 0
+    assert stats["latency_ms"]["max"] == pytest.approx(5.0, rel=0.05)
+
+    # 2000 RU/s of demand is throttled to the provisioned 1000 RU/s
+    stats = ThroughputSimulator(1000, max_retries=1000).run(uniform_requests(200, 10, 10.0))
+    assert stats["requests"] == 2000
+    assert stats["throttled_pct"] > 10.0
+    assert stats["failed"] == 0
+    assert stats["ru_per_second"] == pytest.approx(1000, rel=0.1)  # plus the initial burst
+    curves = stats["curves"]
+    assert curves[9]["backlog"] > curves[1]["backlog"] > 0  # the backlog grows, then drains
+    assert curves[-1]["backlog"] < curves[9]["backlog"]
+    assert curves[-1]["p50_ms"] > curves[1]["p50_ms"]
+    assert sum([c["arrivals"] for c in curves]) == 2000
+
+    # with few retries, the throttled requests fail
+    stats = ThroughputSimulator(1000, max_retries=0).run(uniform_requests(200, 10, 10.0))
+    assert stats["failed"] == stats["throttled"] > 0
+
+
+def test_partition_schemes():
+    results = ThroughputSimulator.compare_schemes(
+        lambda: uniform_requests(1500, 10, 10.0), ["did", "first_letter"],
+        32000, physical_partitions=16)
+    did, first_letter = results["did"], results["first_letter"]
+    assert did["partition_keys"] > 10_000
+    assert first_letter["partition_keys"] == 16
+    assert len(did["partitions"]) == 16
+    assert did["throttled"] == 0
+    assert first_letter["hot_partition_ratio"] > did["hot_partition_ratio"]
+    assert first_letter["throttled"] > 0
+    with pytest.raises(ValueError):
+        ThroughputSimulator(1000, scheme="last_letter")
+
+
+def test_log_requests(tmpdir):
+    log = OperationsLog(str(tmpdir.join("ops")))
+    for event_id in ["e1", "e2"]:
+        for ru in [1.0, 5.0]:
+            log.write({"event_id": event_id, "did": "d" + event_id,
+                       "operation": "op", "ru": ru, "doc_size": 10})
+    log.close()
+    requests = list(ThroughputSimulator.log_requests(log.paths, 10))
+    assert requests == [(0.0, "de1", 1.0), (0.0, "de1", 5.0), (0.1, "de2", 1.0), (0.1, "de2", 5.0)]
@@ -0,0 +1,94 @@
+import asyncio
+
+from azure.cosmos.exceptions import CosmosBatchOperationError
+
+from src.services.write_batcher import WriteBatcher
+
+# pytest -v tests/test_write_batcher.py
+
+
+class FakeNoSQLService:
+    """A stand-in for CosmosNoSQLService that records the write requests."""
+
+    def __init__(self, failing_pk=None):
+        self.requests = list()
+        self.failing_pk = failing_pk
+
+    async def execute_item_batch(self, operations, pk):
+        self.requests.append(("batch", pk, len(operations)))
+        if pk == self.failing_pk:
+            raise CosmosBatchOperationError(
+                error_index=1, headers={}, status_code=409, message="conflict",
+                operation_responses=[])
+        return [{"statusCode": 200, "resourceBody": op[1][0]} for op in operations]
+
+    async def upsert_item(self, doc):
+        self.requests.append(("upsert", doc["id"]))
+        if doc["id"] == "invalid":
+            raise ValueError("invalid doc")
+        return doc
+
+    def last_request_charge(self):
+        return 10.0
+
+
+def test_writes_are_coalesced_by_partition():
+    async def run():
+        svc = FakeNoSQLService()
+        batcher = WriteBatcher(svc, max_batch_size=5, linger_ms=5)
+        futures = [batcher.upsert({"id": str(i)}, "pk{}".format(i % 2)) for i in range(14)]
+        results = await asyncio.gather(*futures)
+        await batcher.close()
+        return svc, batcher, results
+
+    svc, batcher, results = asyncio.run(run())
+    assert [r["doc"]["id"] for r in results] == [str(i) for i in range(14)]
+    assert results[0]["batch_size"] == 5
+    assert results[0]["ru"] == 2.0
+    assert sorted(svc.requests) == sorted(
+        [("batch", "pk0", 5), ("batch", "pk1", 5), ("batch", "pk0", 2), ("batch", "pk1", 2)])
+    assert batcher.get_stats()["items"] == 14
+    assert batcher.get_stats()["requests"] == 4
+
+
+def test_failed_batch_falls_back_to_individual_writes():
+    async def run():
+        svc = FakeNoSQLService(failing_pk="bad")
+        batcher = WriteBatcher(svc, linger_ms=1)
+        futures = [batcher.upsert({"id": "valid"}, "bad"), batcher.upsert({"id": "invalid"}, "bad")]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        await batcher.close()
+        return svc, batcher, results
+
+    svc, batcher, results = asyncio.run(run())
+    assert results[0]["doc"] == {"id": "valid"}
+    assert results[0]["batch_size"] == 1
+    assert isinstance(results[1], ValueError)
+    assert svc.requests == [("batch", "bad", 2), ("upsert", "valid"), ("upsert", "invalid")]
+    assert batcher.get_stats()["batch_failures"] == 1
+
+
+class SlowFirstBatchNoSQLService(FakeNoSQLService):
+    """The first batch is slower than the later ones."""
+
+    async def execute_item_batch(self, operations, pk):
+        await asyncio.sleep(0.05 if len(self.requests) == 0 else 0.0)
+        return await super().execute_item_batch(operations, pk)
+
+
+def test_flushes_of_a_partition_execute_in_order():
+    async def run():
+        svc = SlowFirstBatchNoSQLService()
+        batcher = WriteBatcher(svc, max_batch_size=2, linger_ms=1000)
+        futures = [batcher.upsert({"id": str(i)}, "pk") for i in range(5)]
+        batcher.flush_partition("pk")
+        order = list()
+        for future in asyncio.as_completed(futures):
+            order.append((await future)["doc"]["id"])
+        await batcher.close()
+        return svc, batcher, order
+
+    svc, batcher, order = asyncio.run(run())
+    assert order == ["0", "1", "2", "3", "4"]
+    assert svc.requests == [("batch", "pk", 2), ("batch", "pk", 2), ("upsert", "4")]
+    assert batcher.flushing == dict()